@@ -11,13 +11,20 @@ then
     echo "PostgreSQL started"
 fi
 
-if [ "$FLASK_ENV" = "development" ]
+# the web container sets up the schema, the job worker sets DATABASE_SETUP=0
+if [ "${DATABASE_SETUP:-1}" != "1" ]
+then
+    echo "Skipping database setup"
+elif [ "$FLASK_ENV" = "development" ]
 then
     echo "Creating the database tables..."
     python manage.py create_db
     echo "Tables created"
     echo "Making the shell context"
     python manage.py make_shell_context
+else
+    echo "Applying schema migrations..."
+    python manage.py upgrade
 fi
 
 exec "$@"
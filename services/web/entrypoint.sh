@@ -11,6 +11,10 @@ then
     echo "PostgreSQL started"
 fi
 
-python manage.py create_db
+# the web container sets up the schema, the job worker sets DATABASE_SETUP=0
+if [ "${DATABASE_SETUP:-1}" = "1" ]
+then
+    python manage.py create_db
+fi
 
 exec "$@"
\ No newline at end of file
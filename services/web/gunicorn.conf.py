@@ -0,0 +1,31 @@
+# gunicorn settings, read from the working directory on startup
+import os
+
+# "gevent" serves many slow clients, e.g. api polling, from one worker
+# GUNICORN_WORKER_CONNECTIONS bounds the clients each gevent worker holds
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# build the app once in the master, workers share it copy-on-write
+# GUNICORN_PRELOAD=0 builds it in each worker instead, e.g. for code reloads
+# gevent workers patch the standard library on boot, the app is built after that
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1' if worker_class == 'sync' else '0').lower() not in ('0', 'false', 'no', 'off')
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 waits on the gevent hub instead of blocking the worker
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            server.log.warning('psycogreen is not installed, database calls block the gevent worker')
+        else:
+            patch_psycopg()
+
+    # connections opened in the master must not be shared with the workers,
+    # each worker starts with an empty pool
+    if server.cfg.preload_app:
+        from project import db
+        from wsgi import app
+        with app.app_context():
+            db.engine.dispose()
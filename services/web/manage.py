@@ -1,25 +1,199 @@
 import click
+from flask import current_app
 from flask.cli import FlaskGroup
 
-from project import app, db
+from project import create_app, db
 
 # from previous command line control
 # from project import User
 
-cli = FlaskGroup(app)
+# the app is only built for commands that need it
+cli = FlaskGroup(create_app=create_app)
 
 @cli.command("create_db")
 def create_db():
     db.drop_all()
     db.create_all()
     db.session.commit()
+    # fresh schema already matches the latest migration
+    from project.migrations import stamp
+    stamp()
 
 
-# previous command line control 
-# @cli.command("seed_db")
-# def seed_db():
-#    db.session.add(User(email="test@test123.net"))
-#    db.session.commit()
+@cli.command("upgrade")
+def upgrade():
+    """Apply pending schema migrations, existing data is kept."""
+    from project.migrations import upgrade, current_version
+    applied = upgrade(echo=click.echo)
+    if not applied:
+        click.echo('schema already up to date')
+    click.echo('schema version %d' % current_version())
+
+
+@cli.command("rebuild_user_stats")
+def rebuild_user_stats():
+    """Recount the dashboard counters of every user in one INSERT ... SELECT."""
+    from project.userstats import rebuild_user_stats
+    count = rebuild_user_stats()
+    db.session.commit()
+    click.echo('counted %d users' % count)
+
+
+@cli.command("worker")
+@click.option("--concurrency", default=None, type=int, help="Threads running jobs, JOB_WORKER_CONCURRENCY by default.")
+@click.option("--once", is_flag=True, help="Run the jobs due now, then exit.")
+def worker(concurrency, once):
+    """Run background jobs from the jobs table until stopped with SIGTERM or ctrl-c."""
+    from project import job_queue
+    from project.jobs import Worker
+    if once:
+        count = job_queue.run_pending()
+        click.echo('ran %d jobs' % count)
+        return
+    Worker(current_app._get_current_object(), job_queue, concurrency=concurrency).run()
+
+
+@cli.command("jobs")
+@click.option("--retry-failed", is_flag=True, help="Queue every failed job again.")
+def jobs(retry_failed):
+    """Show the number of jobs by status."""
+    from project import job_queue
+    if retry_failed:
+        click.echo('queued %d failed jobs again' % job_queue.retry_failed())
+    counts = job_queue.counts()
+    for status in ('queued', 'running', 'failed'):
+        click.echo('%-8s %d' % (status, counts.get(status, 0)))
+
+
+@cli.command("compile_templates")
+def compile_templates():
+    """Compile every template into the bytecode cache, run at image build time."""
+    from project.templatecache import precompile_templates
+    count = precompile_templates(current_app)
+    click.echo('compiled %d templates into %s' % (
+        count, current_app.config.get('TEMPLATE_BYTECODE_DIR') or 'the default bytecode cache directory'))
+
+
+@cli.command("build_assets")
+def build_assets():
+    """Build fingerprinted, pre-compressed asset bundles, run at deploy time."""
+    from project import assets
+    from project.assets import build_static_assets, brotli
+    click.echo('building bundles into %s' % assets.directory)
+    build_static_assets(assets, echo=click.echo)
+    if brotli is None:
+        click.echo('brotli is not installed, only .gz variants were written')
+
+
+@cli.command("check_indexes")
+def check_indexes():
+    """EXPLAIN hot queries and fail if any of them scans a whole table."""
+    from project.indexcheck import check_indexes
+    failures = check_indexes(echo=click.echo)
+    if failures:
+        raise click.ClickException('full table scans in: ' + ', '.join(failures))
+
+
+@cli.command("seed_db")
+@click.option("--sponsors", default=10, help="Approved sponsor accounts, sponsor<n>@example.com.")
+@click.option("--editors", default=10, help="Approved editor accounts, editor<n>@example.com.")
+@click.option("--documents", default=1000, help="Documents, each with one retention.")
+@click.option("--yes", is_flag=True, help="Do not ask before dropping the tables.")
+def seed_db(sponsors, editors, documents, yes):
+    """Drop every table and seed accounts, documents and retentions."""
+    from project.benchmarks import seed, BENCH_PASSWORD
+    if not yes:
+        click.confirm('This drops and reseeds every table in the configured database, continue?', abort=True)
+    seed(sponsors, editors, documents)
+    click.echo('seeded, every account logs in with %s' % BENCH_PASSWORD)
+
+
+@cli.command("bench")
+@click.option("--sponsors", default=10, help="Sponsor accounts to seed.")
+@click.option("--editors", default=10, help="Editor accounts to seed.")
+@click.option("--documents", default=1000, help="Documents to seed.")
+@click.option("--iterations", default=100, help="User flows to run, every fifth is an admin.")
+@click.option("--concurrency", default=4, help="Flows run at the same time.")
+@click.option("--mode", type=click.Choice(['client', 'gunicorn']), default='client', help="In-process test client or a local gunicorn over HTTP.")
+@click.option("--workers", default=2, help="gunicorn workers in gunicorn mode.")
+@click.option("--output", default=None, help="Write the results as JSON to this file.")
+@click.option("--compare", default=None, help="JSON results of an earlier run to compare p95 against.")
+@click.option("--yes", is_flag=True, help="Do not ask before dropping the tables.")
+def bench(sponsors, editors, documents, iterations, concurrency, mode, workers, output, compare, yes):
+    """Seed the database and load test the login to document list flow."""
+    from project.benchmarks import bench_flow, format_summary, save_summary, load_summary
+    if not yes:
+        click.confirm('This drops and reseeds every table in the configured database, continue?', abort=True)
+    summary = bench_flow(current_app._get_current_object(), sponsors, editors, documents, iterations, concurrency,
+                         mode=mode, workers=workers, echo=click.echo)
+    click.echo(format_summary(summary, load_summary(compare) if compare else None))
+    if output:
+        save_summary(summary, output)
+        click.echo('results written to %s' % output)
+
+
+@cli.command("bench_listviews")
+@click.option("--sizes", default="100,1000,10000,100000", help="Comma separated row counts to grow the tables to.")
+@click.option("--yes", is_flag=True, help="Do not ask before dropping the tables.")
+def bench_listviews(sizes, yes):
+    """Check list views keep a constant query count as tables grow."""
+    from project.benchmarks import bench_listviews, query_count_regressions
+    if not yes:
+        click.confirm('This drops and reseeds every table in the configured database, continue?', abort=True)
+    results = bench_listviews(current_app._get_current_object(), [int(size) for size in sizes.split(',')], echo=click.echo)
+    regressions = query_count_regressions(results)
+    if regressions:
+        raise click.ClickException('query count grows with table size: ' + ', '.join(regressions))
+    click.echo('query counts constant across sizes')
+
+
+@cli.command("bench_login")
+@click.option("--settings", default="pbkdf2:sha256@150000,pbkdf2:sha256@260000,pbkdf2:sha512@260000,scrypt@16384,scrypt@32768",
+              help="Comma separated method@cost settings to compare.")
+@click.option("--logins", default=50, help="Logins per setting.")
+@click.option("--concurrency", default=4, help="Logins posted at the same time.")
+@click.option("--output", default=None, help="Write the results as JSON to this file.")
+@click.option("--yes", is_flag=True, help="Do not ask before dropping the tables.")
+def bench_login(settings, logins, concurrency, output, yes):
+    """Compare login throughput across password hash schemes and costs."""
+    from project.benchmarks import bench_login, parse_hash_settings, save_summary
+    if not yes:
+        click.confirm('This drops and reseeds every table in the configured database, continue?', abort=True)
+    click.echo('%d logins per setting, %d at a time, %d hashing threads' % (
+        logins, concurrency, current_app.config['PASSWORD_HASH_THREADS']))
+    results = bench_login(current_app._get_current_object(), parse_hash_settings(settings), logins, concurrency, echo=click.echo)
+    if output:
+        save_summary(results, output)
+        click.echo('results written to %s' % output)
+
+
+@cli.command("profile_import")
+@click.option("--top", default=15, help="Slowest modules to list.")
+@click.option("--output", default=None, help="Write the results as JSON to this file.")
+def profile_import(top, output):
+    """Time a cold import of the project package and one create_app call."""
+    from project.benchmarks import profile_import, save_summary
+    results = profile_import(top)
+    click.echo('import project: %.1f ms, create_app: %.1f ms' % (results['import_ms'], results['create_app_ms']))
+    for entry in results['modules']:
+        click.echo('  %8.1f ms  %s' % (entry['cumulative_ms'], entry['module']))
+    if output:
+        save_summary(results, output)
+        click.echo('results written to %s' % output)
+
+
+@cli.command("session_standin")
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=6379)
+def session_standin(host, port):
+    """Serve an in-memory Redis protocol stand-in for SESSION_BACKEND=redis and RATE_LIMIT_BACKEND=redis."""
+    from project.sessionstore import LocalRespServer
+    server = LocalRespServer(host, port)
+    click.echo('serving %s, ctrl-c to stop' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
 
 
 @cli.command("test_message")
@@ -7,14 +7,15 @@ from flask_login import LoginManager, current_user
 # import flask_assets
 from flask_assets import Environment, Bundle
 # import compile assets from assets.py
-from .assets import compile_static_assets
+from .assets import compile_static_assets, add_immutable_cache_headers
 # Importing Flask Principal
 from flask_principal import identity_loaded, Principal, Permission, UserNeed, RoleNeed
 # individual document access permission
 from .principalmanager import EditDocumentNeed
 
-# for printing to console
-import sys
+# structured logging through a background writer
+import logging
+from .logmanager import LogManager
 
 port = int(os.environ.get("PORT", 5000))
 
@@ -22,6 +23,11 @@ port = int(os.environ.get("PORT", 5000))
 db = SQLAlchemy()
 # set login manager name from flask_login
 login_manager = LoginManager()
+# Set environment for assets, bundles are built by manage.py build_assets
+assets = Environment()
+# serve the static folder ahead of flask, one mount for every blueprint
+from .staticfiles import StaticFiles
+static_files = StaticFiles()
 
 # setup Flask Principal
 principals = Principal()
@@ -47,19 +53,79 @@ notapproved_role = RoleNeed('notapproved')
 # setting up an approved permission
 notapproved_permission = Permission(notapproved_role)
 
+# setup logging, records are written to stderr by a background thread
+log_manager = LogManager()
+logger = logging.getLogger(__name__)
+
+# setup per-request query and latency instrumentation
+from .metrics import RequestMetrics
+request_metrics = RequestMetrics()
+
+# setup password hashing, checks run in a bounded thread pool
+from .passwordhasher import PasswordHasher
+password_hasher = PasswordHasher()
+
+# setup login rate limits, per client address and per email
+from .ratelimit import RateLimiter
+rate_limiter = RateLimiter()
+
+# setup per-process cache of identity needs, keyed by user id
+from .identitycache import IdentityCache, load_identity_needs, register_invalidation_hooks
+identity_cache = IdentityCache()
+# drop cached needs whenever retentions or user status are committed
+register_invalidation_hooks(identity_cache)
+
+# setup server-side sessions and cached user snapshots for load_user
+from .sessionstore import SessionStore
+session_store = SessionStore()
+# snapshots carry user_status and user_type, drop them on the same commits
+register_invalidation_hooks(session_store)
+
+# setup template bytecode cache and per-user fragment caching
+from .templatecache import FragmentCache, precompile_templates, register_fragment_invalidation
+fragment_cache = FragmentCache()
+# new version for a user's fragments whenever their users, retentions or documents change
+register_fragment_invalidation(fragment_cache)
+
+# setup document body storage, chunked and compressed outside the documents table
+from .bodystore import BodyStore
+body_store = BodyStore()
+
+# setup document revision history, deltas between saves and periodic snapshots
+from .revisions import RevisionStore
+revision_store = RevisionStore()
+
+# setup full-text search, a tsvector on postgresql and an inverted index elsewhere
+from .search import SearchIndex
+search_index = SearchIndex()
+
+# setup background jobs, queued in the database and run by manage.py worker
+from .jobs import JobQueue
+job_queue = JobQueue()
+
+# setup dashboard counters, updated by the same flushes that change them
+from .userstats import register_stats_hooks
+register_stats_hooks()
 
 
 def create_app():
+    """Build a configured app, without touching the database or building assets.
+
+    Schema changes run through manage.py create_db / upgrade and bundles
+    through manage.py build_assets, so starting a worker, or a manage.py
+    command, only pays for configuration and route registration.
+    """
     # construct core app object, __name__ is the default value.
     app = Flask(__name__)
     # pull the config file, per flask documentation
     # Application configuration
     app.config.from_object("project.config.Config")
-    # auto reload templates
-    app.config['TEMPLATES_AUTO_RELOAD'] = True
 
-    # Set environment for assets
-    assets = Environment()
+    # initialize logging before anything logs
+    log_manager.init_app(app)
+
+    # initialize request instrumentation before other plugins hook requests
+    request_metrics.init_app(app)
 
     # initialize database plugin
     db.init_app(app)
@@ -72,11 +138,44 @@ def create_app():
 
     # initialize principals/roles plugin
     principals.init_app(app)
+    # add identity needs whenever flask principal loads an identity
+    identity_loaded.connect(on_identity_loaded, app)
+
+    # initialize identity needs cache
+    identity_cache.init_app(app)
+
+    # initialize password hashing scheme and pool
+    password_hasher.init_app(app)
+
+    # initialize login rate limits, their counters are served with the request metrics
+    rate_limiter.init_app(app)
+    request_metrics.add_collector(rate_limiter.metric_lines)
+
+    # initialize session backend and user snapshots
+    session_store.init_app(app)
+
+    # initialize template bytecode cache, fragments share the session backend
+    fragment_cache.init_app(app, session_store.backend)
+
+    # initialize document body chunking and compression
+    body_store.init_app(app)
+
+    # initialize revision snapshots and the rebuilt revision cache
+    revision_store.init_app(app)
+
+    # initialize search language and body indexing limit
+    search_index.init_app(app)
+
+    # initialize job retries, leases and worker concurrency
+    job_queue.init_app(app)
 
     # initialize routes
     with app.app_context():
         from . import routes
         from . import auth
+        from . import api
+        # job handlers, registered for manage.py worker
+        from . import tasks
         from .assets import compile_static_assets
         # Register Blueprints
         app.register_blueprint(routes.main_bp)
@@ -84,145 +183,91 @@ def create_app():
         app.register_blueprint(routes.sponsor_bp)
         app.register_blueprint(routes.editor_bp)
         app.register_blueprint(routes.admin_bp)
+        app.register_blueprint(api.api_bp)
 
-        # import model class
-        from . import models
-
-        # Create Database Models
-        db.create_all()
+        # compile every template up front, workers forked afterwards share them
+        if app.config.get('TEMPLATE_PRECOMPILE'):
+            precompile_templates(app)
 
-        # Compile static assets
+        # Register static asset bundles, nothing is built here
         compile_static_assets(assets)
-      
+        # far-future cache headers for fingerprinted bundles
+        app.after_request(add_immutable_cache_headers)
+
+    # python shell context processor
+    app.shell_context_processor(make_shell_context)
+    # Apply Content Security Policy to All
+    app.after_request(add_security_headers)
+
+    #  Cookie Protection - SameSite
+    app.config.update(
+        # Forces cookie on HTTPS only
+        # SESSION_COOKIE_SECURE=True,
+        # Prevents cookie from being read via javascript code.
+        SESSION_COOKIE_HTTPONLY=True,
+        # won’t allow sending cookies from another sites when doing requests other than GET
+        SESSION_COOKIE_SAMESITE='Lax',
+    )
+
+    # initialize static file serving, wraps the finished wsgi app
+    static_files.init_app(app)
+
     return app
 
-# Physically create the app now
-app = create_app()
+
+def __getattr__(name):
+    """Build project.app on first access, importing the package builds nothing.
+
+    Kept for "from project import app" and FLASK_APP=project/__init__.py,
+    gunicorn loads wsgi:app.
+    """
+    if name == 'app':
+        app = globals()['app'] = create_app()
+        return app
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 # Identity Loading Factory from flask_principal
 # identity_loaded adds any additional information to the Identity instance such as roles.
 # then, needs are added and brought along with that user for various permissions functions
 # Signal sent when the identity has been initialised for a request.
-# @identity_loaded is a decorator, connect_via sender "app" with weak signals via blinker
-@identity_loaded.connect_via(app)
+# connected to each app in create_app, sender "app" with weak signals via blinker
 def on_identity_loaded(sender, identity):
 
     # Set the identity user object
     # basically pass current_user object to identity.user
     identity.user = current_user
 
-    # Add the UserNeed to the identity
+    # Add the UserNeed, RoleNeeds and EditDocumentNeeds to the identity
     # ensure current_user has attribute identity "id"
     if hasattr(current_user, 'id'):
-        # specifically, need to have current_user.id
-        # Query user type given user.id
-        # printing the fact that we are querying db
-        print('Querying Database for user_type!', file=sys.stderr)
-        current_user_type = User.query.filter(User.id==current_user.id)[0].user_type
-
-        print('Querying Database for user_status!', file=sys.stderr)
-        current_user_status = User.query.filter(User.id==current_user.id)[0].user_status
-
-        # print userid to console
-        print('Providing ID: ',current_user.id,' ...to Identity', file=sys.stderr)
-        # provide userid to identity
-        identity.provides.add(UserNeed(current_user.id))
-
-        # print user_type to console
-        print('Providing Role: ',current_user_type,' ...to Identity', file=sys.stderr)
-        # provide user_type to identity
-        identity.provides.add(RoleNeed(current_user_type))
-
-        # print user_status to console
-        print('Providing Role: ',current_user_status,' ...to Identity', file=sys.stderr)
-        # provide user_type to identity
-        identity.provides.add(RoleNeed(current_user_status))
-
-        # this is set up in such a way that multiple needs can be added to the same user
-        needs = []
-        
-        # append approved or notapproved roles depending upon status
-        # approved status role - pending and rejected goes to notapproved
-        if current_user_status == 'approved':
-            # append approved role to needs
-            needs.append(approved_role)
-        elif current_user_status == 'pending' or current_user_status == 'rejected':
-            # append approved role to needs
-            needs.append(notapproved_role)
-
-        # append sponsor and editor roles depending upon user
-        # if current_user_type is sponsor
-        if current_user_type == 'sponsor':
-            # add sponsor_role, RoleNeed to needs
-            needs.append(sponsor_role)
-            # query user's documents, filter documents by current sponsor user
-            # printing the fact that we are querying db
-            print('Querying Database for document_ids!', file=sys.stderr)
-            document_objects = db.session.query(Retention.sponsor_id,User.id,Retention.document_id,).join(Retention, User.id==Retention.sponsor_id).join(Document, Document.id==Retention.document_id).order_by(Retention.sponsor_id).filter(Retention.sponsor_id == current_user.id)
-            # get a count of the document objects
-            document_count = document_objects.count()
-            # blank list to fill with documentid's
-            document_id_list=[]
-            # loop through document objects to generate filled document_id_list
-            for counter in range(0,document_count):
-                # loop through document objects and append to list
-                document_id_list.append(document_objects[counter].document_id)
-                # provide the need mapping to the document for each document
-                identity.provides.add(EditDocumentNeed(str(document_objects[counter].document_id)))
-            # after for loop, show document id's appended to needs
-            print('appended document_ids to needs : ',document_id_list, file=sys.stderr)
-        # if current_user_type is editor
-        elif current_user_type == 'editor':
-            # add editor_role, RoleNeed to needs
-            needs.append(editor_role)
-            # query user's documents, filter documents by current sponsor user
-            # printing the fact that we are querying db
-            print('Querying Database for document_ids!', file=sys.stderr)
-            document_objects = db.session.query(Retention.editor_id,User.id,Retention.document_id,).join(Retention, User.id==Retention.editor_id).join(Document, Document.id==Retention.document_id).order_by(Retention.editor_id).filter(Retention.editor_id == current_user.id)
-            # get a count of the document objects
-            document_count = document_objects.count()
-            # blank list to fill with documentid's
-            document_id_list=[]
-            # loop through document objects to generate filled document_id_list
-            for counter in range(0,document_count):
-                # loop through document objects and append to list
-                document_id_list.append(document_objects[counter].document_id)
-                # provide the need mapping to the document for each document
-                identity.provides.add(EditDocumentNeed(str(document_objects[counter].document_id)))
-            # after for loop, show document id's appended to needs
-            print('appended document_ids to needs : ',document_id_list, file=sys.stderr)
-
-        # print everything appended to needs, documents and others
-        print('appended to needs : ',needs, file=sys.stderr)
-        # add all of the listed needs to current_user
-
-        for n in needs:
-            identity.provides.add(n)
+        # needs are cached per user id, only query the database on a miss
+        needs = identity_cache.get(current_user.id)
+        if needs is None:
+            # log the fact that we are querying db
+            logger.debug('identity needs cache miss', extra={'user_id': current_user.id})
+            # user_type, user_status and document_ids in a single query
+            needs = load_identity_needs(current_user.id)
+            identity_cache.set(current_user.id, needs)
+
+        # log everything provided to the identity, documents and others
+        # the needs list is only built when debug logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('providing needs to identity', extra={'user_id': current_user.id, 'needs': sorted(map(str, needs))})
+        # add all of the needs to current_user
+        identity.provides.update(needs)
 
 
 # create shell context processor
 from .models import db, Document, User, Retention
 # python shell context processor
-@app.shell_context_processor
 def make_shell_context():
     return {'db': db, 'User': User, 'Document': Document, 'Retention': Retention}
 
 # Apply Content Security Policy to All 
-@app.after_request
 def add_security_headers(resp):
     resp.headers['Content-Security-Policy']='default-src \'self\''
     return resp
 
-#  Cookie Protection - SameSite
-app.config.update(
-    # Forces cookie on HTTPS only
-    # SESSION_COOKIE_SECURE=True,
-    # Prevents cookie from being read via javascript code.
-    SESSION_COOKIE_HTTPONLY=True,
-    # won’t allow sending cookies from another sites when doing requests other than GET
-    SESSION_COOKIE_SAMESITE='Lax',
-)
-
 if __name__ == "__main__":
-   app.run(host='0.0.0.0',port=port)
+   create_app().run(host='0.0.0.0',port=port)
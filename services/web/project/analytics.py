@@ -0,0 +1,105 @@
+"""Admin analytics, user counts and signup trends from one aggregate query."""
+from datetime import datetime, timedelta
+import json
+
+from sqlalchemy import case, func
+
+from . import db, session_store
+from .models import User
+
+# signup trend buckets, the unit of date_trunc on postgresql
+BUCKETS = ('day', 'week', 'month')
+# strftime formats of the bucket start elsewhere, weeks start on monday
+SQLITE_BUCKETS = {
+    'day': lambda column: func.date(column),
+    'week': lambda column: func.date(column, 'weekday 0', '-6 days'),
+    'month': lambda column: func.strftime('%Y-%m-01', column),
+}
+
+
+def bucket_start(column, bucket):
+    """SQL expression of the start of the bucket holding column."""
+    if db.engine.dialect.name == 'postgresql':
+        return func.date_trunc(bucket, column)
+    return SQLITE_BUCKETS[bucket](column)
+
+
+def _sort_key(key):
+    """Sort key of a tuple that may hold None, None sorts first."""
+    return tuple((value is not None, value or '') for value in key)
+
+
+def _isoformat(value):
+    """Bucket start as YYYY-MM-DD, postgresql returns timestamps and sqlite strings."""
+    if value is None or isinstance(value, str):
+        return value
+    return value.date().isoformat()
+
+
+def user_analytics(bucket='day', days=30):
+    """Users by type, status and organization, and signups per bucket.
+
+    Both come from a single GROUP BY over users: the grouping carries the
+    signup bucket of users created in the last days days and a null bucket
+    for everyone else, the counts are the grouped rows summed over
+    buckets. Only aggregated rows leave the database.
+    """
+    since = datetime.utcnow() - timedelta(days=days)
+    signup_bucket = case([(User.created_on >= since, bucket_start(User.created_on, bucket))]).label('bucket')
+    rows = db.session.query(
+        User.user_type, User.user_status, User.organization, signup_bucket, func.count().label('users')
+    ).group_by(User.user_type, User.user_status, User.organization, signup_bucket).all()
+
+    counts = {}
+    totals = {}
+    signups = {}
+    for user_type, user_status, organization, start, users in rows:
+        key = (user_type, user_status, organization)
+        counts[key] = counts.get(key, 0) + users
+        # a null status is 'none', as in the users view filters
+        status = user_status if user_status is not None else 'none'
+        totals.setdefault(user_type, {})
+        totals[user_type][status] = totals[user_type].get(status, 0) + users
+        if start is not None:
+            key = (_isoformat(start), user_type)
+            signups[key] = signups.get(key, 0) + users
+
+    return {
+        'generated_on': datetime.utcnow().isoformat(),
+        'bucket': bucket,
+        'days': days,
+        'counts': [
+            {'user_type': key[0], 'user_status': key[1], 'organization': key[2], 'users': counts[key]}
+            for key in sorted(counts, key=_sort_key)
+        ],
+        'totals': totals,
+        'signups': [
+            {'bucket': key[0], 'user_type': key[1], 'users': signups[key]}
+            for key in sorted(signups, key=_sort_key)
+        ],
+    }
+
+
+def cached_user_analytics(bucket='day', days=30, ttl=30):
+    """user_analytics, computed at most once every ttl seconds per bucket and days.
+
+    The result is kept on the session store backend, shared between
+    workers with the filesystem and redis backends.
+    """
+    cached = session_store.backend.get(_cache_key(bucket, days))
+    if cached is not None:
+        return json.loads(cached.decode('utf-8'))
+    return refresh_user_analytics(bucket, days, ttl)
+
+
+def refresh_user_analytics(bucket='day', days=30, ttl=30):
+    """Compute user_analytics and store it for cached_user_analytics, returns it."""
+    result = user_analytics(bucket, days)
+    if ttl > 0:
+        session_store.backend.set(_cache_key(bucket, days), json.dumps(result).encode('utf-8'), ttl)
+    return result
+
+
+def _cache_key(bucket, days):
+    return 'analytics:users:%s:%d' % (bucket, days)
+
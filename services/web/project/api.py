@@ -0,0 +1,300 @@
+"""Versioned JSON API for the document lists."""
+import hashlib
+
+from flask import Blueprint, Response, current_app, json, jsonify, request, stream_with_context
+from flask_login import current_user, login_required
+
+from . import sponsor_permission, editor_permission, approved_permission
+from . import db, fragment_cache, body_store, revision_store, search_index
+from .assets import IMMUTABLE_MAX_AGE
+from .bodystore import BodyTooLarge, BodyNotText, BadPatch, read_stream
+from .documentmanager import replace_body, save_document, VersionConflict
+from .models import Document, DocumentRevision, Retention
+from .principalmanager import EditDocumentPermission
+from .revisions import RevisionNotFound
+from .search import search_args
+from .pagination import page_args, paginate_keyset
+from .queries import sponsor_documents_query, editor_documents_query, document_fields_query
+from .queries import SPONSOR_DOCUMENT_FIELDS, EDITOR_DOCUMENT_FIELDS
+
+# the version is part of every url, /api/v1/...
+api_bp = Blueprint('api_bp', __name__, url_prefix='/api/v1')
+
+# fields returned when ?fields= is not given, bodies are fetched from /documents/<id>/body
+SPONSOR_DEFAULT_FIELDS = ('id', 'document_id', 'document_name', 'version', 'editor_id', 'editor_name', 'editor_status')
+EDITOR_DEFAULT_FIELDS = ('id', 'document_id', 'document_name', 'version', 'sponsor_id')
+# fields read from the users table, their values change with any user
+USER_FIELDS = ('editor_name', 'editor_status')
+
+
+class FieldError(ValueError):
+    """?fields= names a field the list does not have."""
+
+
+def selected_fields(available, default):
+    """Fields asked for with ?fields=a,b, in the order given, always with id first."""
+    spec = request.args.get('fields')
+    if not spec:
+        return list(default)
+    fields = ['id']
+    for name in spec.split(','):
+        name = name.strip()
+        if not name or name in fields:
+            continue
+        if name not in available:
+            raise FieldError('unknown field %r, expected %s' % (name, ', '.join(sorted(available))))
+        fields.append(name)
+    return fields
+
+
+def document_page(name, user_id, query, columns, default_fields):
+    """Conditional JSON response for one page of a document list.
+
+    The serialised page is kept in the fragment cache, under the same user
+    scope as the HTML list, so a repeated request sends no query. The ETag
+    is the hash of the body, an If-None-Match match gets an empty 304.
+    With ?q= the page holds the matching documents, best first with their
+    rank, numbered by ?page= instead of cursors.
+    """
+    try:
+        fields = selected_fields(columns, default_fields)
+    except FieldError as error:
+        return jsonify(error=str(error)), 400
+
+    paging = page_args()
+    terms, page_number = search_args()
+    if terms:
+        parts = dict(q=terms, page=page_number, per_page=paging['per_page'], fields=','.join(fields))
+    else:
+        parts = dict(paging, fields=','.join(fields))
+    if fragment_cache.enabled and any(field in USER_FIELDS for field in fields):
+        # editor names and statuses are bumped under the users scope
+        parts['users'] = fragment_cache.version('users')
+    key = fragment_cache.key(name, 'user:%s' % user_id, **parts)
+
+    body = fragment_cache.get(key) if key is not None else None
+    cached = body is not None
+    if not cached and terms:
+        page = search_index.page(document_fields_query(query, fields, columns), terms, page_number, paging['per_page'])
+        body = json.dumps({
+            'data': [row._asdict() for row in page],
+            'fields': fields + ['rank'],
+            'q': terms,
+            'per_page': page.per_page,
+            'page': page.page,
+            'next_page': page.next_page,
+            'prev_page': page.prev_page
+        })
+    elif not cached:
+        page = paginate_keyset(document_fields_query(query, fields, columns), Retention.id, 'id', **paging)
+        body = json.dumps({
+            'data': [row._asdict() for row in page],
+            'fields': fields,
+            'per_page': page.per_page,
+            'next_cursor': page.next_cursor,
+            'prev_cursor': page.prev_cursor
+        })
+    if key is not None and not cached:
+        fragment_cache.set(key, body)
+
+    response = Response(body, mimetype=current_app.config.get('JSONIFY_MIMETYPE', 'application/json'))
+    response.set_etag(hashlib.sha1(body.encode('utf-8')).hexdigest())
+    # per user data, clients revalidate with If-None-Match every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+@api_bp.route('/sponsor/documents', methods=['GET'])
+@login_required
+@sponsor_permission.require(http_exception=403)
+@approved_permission.require(http_exception=403)
+def documentlist_sponsor():
+    """Documents retained by the logged-in sponsor, with their editor."""
+    user_id = current_user.id
+    return document_page(
+        'api_documentlist_sponsor', user_id, sponsor_documents_query(user_id),
+        SPONSOR_DOCUMENT_FIELDS, SPONSOR_DEFAULT_FIELDS
+    )
+
+
+@api_bp.route('/editor/documents', methods=['GET'])
+@login_required
+@editor_permission.require(http_exception=403)
+@approved_permission.require(http_exception=403)
+def documentlist_editor():
+    """Documents assigned to the logged-in editor."""
+    user_id = current_user.id
+    return document_page(
+        'api_documentlist_editor', user_id, editor_documents_query(user_id),
+        EDITOR_DOCUMENT_FIELDS, EDITOR_DEFAULT_FIELDS
+    )
+
+
+def document_etag(version):
+    return 'v%d' % version
+
+
+def if_match_version():
+    """Document version named by an If-Match header, None without one."""
+    for tag in request.if_match.as_set():
+        if tag.startswith('v') and tag[1:].isdigit():
+            return int(tag[1:])
+    return None
+
+
+def conflict_response(conflict):
+    return jsonify(error='document was saved by someone else', version=conflict.current_version), 409
+
+
+def load_document(document_id):
+    """(document, None) for a document the user retains, or (None, error response)."""
+    if not EditDocumentPermission(document_id).can():
+        return None, (jsonify(error='not your document'), 403)
+    document = Document.query.get(document_id)
+    if document is None:
+        return None, (jsonify(error='no such document'), 404)
+    return document, None
+
+
+@api_bp.route('/documents/<int:document_id>/body', methods=['GET'])
+@login_required
+@approved_permission.require(http_exception=403)
+def document_body(document_id):
+    """Stream the body of a document retained by the logged-in user, as UTF-8 text.
+
+    The ETag names the document version, pass it back in If-Match when
+    replacing the body.
+    """
+    document, error = load_document(document_id)
+    if error is not None:
+        return error
+    size = body_store.size(document_id)
+    # chunks are read and sent one at a time while the response streams
+    response = Response(
+        stream_with_context(body_store.chunks(document_id)),
+        mimetype='text/plain',
+        headers={'Content-Length': str(size), 'Cache-Control': 'private, no-cache'}
+    )
+    response.set_etag(document_etag(document.version))
+    return response.make_conditional(request)
+
+
+@api_bp.route('/documents/<int:document_id>/body', methods=['PUT'])
+@login_required
+@approved_permission.require(http_exception=403)
+def replace_document_body(document_id):
+    """Replace the body of a document with the UTF-8 request body, read as it arrives.
+
+    With If-Match the body is only replaced while the document is still at
+    that version, otherwise the response is a 409.
+    """
+    document, error = load_document(document_id)
+    if error is not None:
+        return error
+    if (request.content_length or 0) > body_store.max_size:
+        return jsonify(error='body is over %d bytes' % body_store.max_size), 413
+    try:
+        # the document row stays locked until the upload is stored and committed
+        version, size = replace_body(
+            document, if_match_version(), read_stream(request.stream, body_store.chunk_size), author_id=current_user.id
+        )
+    except VersionConflict as conflict:
+        return conflict_response(conflict)
+    except BodyTooLarge:
+        db.session.rollback()
+        return jsonify(error='body is over %d bytes' % body_store.max_size), 413
+    except BodyNotText:
+        db.session.rollback()
+        return jsonify(error='body must be UTF-8 text'), 400
+    db.session.commit()
+    response = jsonify(document_id=document_id, version=version, size=size)
+    response.set_etag(document_etag(version))
+    return response
+
+
+@api_bp.route('/documents/<int:document_id>', methods=['PATCH'])
+@login_required
+@approved_permission.require(http_exception=403)
+def patch_document(document_id):
+    """Save only what changed, a new name and text ranges of the body.
+
+    PATCH a JSON body {"version": 3, "document_name": "...", "body_patches":
+    [{"start": 10, "end": 14, "text": "..."}, ...]}, start and end are
+    character offsets into the body of that version. The save applies
+    only while the document is still at version, otherwise the response
+    is a 409 with the current version.
+    """
+    document, error = load_document(document_id)
+    if error is not None:
+        return error
+    payload = request.get_json(silent=True) or {}
+
+    # validate the shape of the request before touching the database
+    version = payload.get('version')
+    if not isinstance(version, int):
+        return jsonify(error='version must be an integer'), 400
+    document_name = payload.get('document_name')
+    if not isinstance(document_name, (str, type(None))):
+        return jsonify(error='document_name must be a string'), 400
+    patches = []
+    for patch in payload.get('body_patches') or []:
+        if not isinstance(patch, dict) or not all(isinstance(patch.get(key), int) for key in ('start', 'end')) \
+                or not isinstance(patch.get('text', ''), str):
+            return jsonify(error='body_patches are {"start": int, "end": int, "text": str}'), 400
+        patches.append((patch['start'], patch['end'], patch.get('text', '')))
+
+    try:
+        version = save_document(
+            document, version, document_name=document_name, body_patches=patches, author_id=current_user.id
+        )
+    except VersionConflict as conflict:
+        return conflict_response(conflict)
+    except BadPatch as bad_patch:
+        db.session.rollback()
+        return jsonify(error=bad_patch.description), 400
+    db.session.commit()
+    response = jsonify(document_id=document_id, version=version)
+    response.set_etag(document_etag(version))
+    return response
+
+
+@api_bp.route('/documents/<int:document_id>/revisions', methods=['GET'])
+@login_required
+@approved_permission.require(http_exception=403)
+def document_revisions(document_id):
+    """Saved versions of a document, oldest first, in keyset pages on version."""
+    document, error = load_document(document_id)
+    if error is not None:
+        return error
+    page = paginate_keyset(
+        revision_store.list_query(document_id), DocumentRevision.version, 'version', **page_args()
+    )
+    return jsonify(
+        data=[dict(row._asdict(), created_on=row.created_on.isoformat()) for row in page],
+        current_version=document.version,
+        per_page=page.per_page,
+        next_cursor=page.next_cursor,
+        prev_cursor=page.prev_cursor
+    )
+
+
+@api_bp.route('/documents/<int:document_id>/revisions/<int:version>', methods=['GET'])
+@login_required
+@approved_permission.require(http_exception=403)
+def document_revision(document_id, version):
+    """Body of a document as it was saved at version, as UTF-8 text.
+
+    A revision never changes, clients may keep it for as long as they like.
+    """
+    document, error = load_document(document_id)
+    if error is not None:
+        return error
+    try:
+        text = revision_store.text(document_id, version)
+    except RevisionNotFound:
+        return jsonify(error='no such revision'), 404
+    response = Response(text, mimetype='text/plain')
+    response.set_etag(document_etag(version))
+    response.headers['Cache-Control'] = 'private, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+    return response.make_conditional(request)
@@ -1,27 +1,97 @@
 """Compile static assets."""
+import glob
+import gzip
+import os
+import re
+
+from flask import request
 from flask_assets import Bundle
 
+# brotli is optional, .br variants are only written when it is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bundle outputs carry their content hash, e.g. dist/css/landing.1a2b3c4d.css
+FINGERPRINTED = re.compile(r'^dist/.+\.[0-9a-f]{8,}(\.min)?\.(css|js)$')
+# a fingerprinted name never changes content, cache it for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
 def compile_static_assets(assets):
-    """Configure and build asset bundles."""
+    """Configure asset bundles, built ahead of time by manage.py build_assets."""
 
     # Main asset bundles
     main_style_bundle = Bundle(
+        'css/bootstrap.min.css',
         filters='cssmin',
-        output='dist/css/landing.css',
+        output='dist/css/landing.%(version)s.css',
         extra={'rel': 'stylesheet/css'}
     )
     main_js_bundle = Bundle(
         'src/js/main.js',
         filters='jsmin',
-        output='dist/js/main.min.js'
+        output='dist/js/main.%(version)s.min.js'
     )
 
     # Admin asset bundleds
     admin_style_bundle = Bundle(
+        'css/bootstrap.min.css',
         filters='cssmin',
-        output='dist/css/account.css',
+        output='dist/css/account.%(version)s.css',
         extra={'rel': 'stylesheet/css'}
     )
     assets.register('main_styles', main_style_bundle)
     assets.register('main_js', main_js_bundle)
-    assets.register('admin_styles', admin_style_bundle)
\ No newline at end of file
+    assets.register('admin_styles', admin_style_bundle)
+
+
+def build_static_assets(assets, echo=print):
+    """Build every bundle, write .gz and .br siblings, remove older builds.
+
+    Versions go to the ASSETS_MANIFEST file, which is what templates read
+    at runtime, so nothing is built or checked while serving. Returns the
+    paths written.
+    """
+    written = []
+    for bundle in assets:
+        bundle.build(force=True)
+        path = bundle.resolve_output()
+        written.append(path)
+        written.extend(write_compressed(path))
+
+        # earlier builds of the same bundle are no longer referenced
+        pattern = os.path.join(assets.directory, bundle.output % {'version': '*'})
+        for stale in glob.glob(pattern) + glob.glob(pattern + '.gz') + glob.glob(pattern + '.br'):
+            if stale not in written:
+                os.remove(stale)
+        echo('  %s' % os.path.relpath(path, assets.directory))
+    return written
+
+
+def write_compressed(path):
+    """Write path.gz, and path.br when brotli is installed, returns their paths."""
+    with open(path, 'rb') as source:
+        data = source.read()
+    written = [path + '.gz']
+    # fixed mtime, the same input always gives the same file
+    with gzip.GzipFile(path + '.gz', 'wb', compresslevel=9, mtime=0) as output:
+        output.write(data)
+    if brotli is not None:
+        with open(path + '.br', 'wb') as output:
+            output.write(brotli.compress(data, quality=11))
+        written.append(path + '.br')
+    return written
+
+
+def add_immutable_cache_headers(response):
+    """Far-future caching for fingerprinted bundles served from any static route."""
+    endpoint = request.endpoint
+    if endpoint is None or endpoint.split('.')[-1] != 'static':
+        return response
+    filename = (request.view_args or {}).get('filename', '')
+    if response.status_code in (200, 206, 304) and FINGERPRINTED.match(filename):
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        response.headers.pop('Expires', None)
+    return response
@@ -1,22 +1,28 @@
 """Routes for user authentication."""
-from flask import Blueprint, redirect, render_template, flash, request, session, url_for
+from datetime import datetime
+from flask import Blueprint, redirect, render_template, flash, request, session, url_for, jsonify
 from flask import g, current_app, abort, request
 from flask_login import login_required, current_user, login_user
 from .forms import LoginForm, SignupForm
 from .models import db, User
-from . import login_manager
+from . import login_manager, session_store, rate_limiter
+from .passwordhasher import HasherBusy
+from .sessionstore import UserSnapshot
+from .tasks import enqueue_signup
 from .routes import sponsor_bp, editor_bp, admin_bp
 # for identifitaction and permission management
 from flask_principal import Identity, identity_changed
-# for printing system messages
-import sys
+# for logging system messages
+import logging
+
+# module logger, a child of the project logger
+logger = logging.getLogger(__name__)
 
 
 # Blueprint Configuration
 auth_bp = Blueprint(
     'auth_bp', __name__,
-    template_folder='templates',
-    static_folder='static'
+    template_folder='templates'
 )
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
@@ -27,14 +33,20 @@ def login():
     GET requests serve Log-in page.
     POST requests validate and redirect user to dashboard.
     """
+    # throttle attempts per address and per email before any form or database work
+    if request.method == 'POST':
+        limited = rate_limiter.check_login(request)
+        if limited is not None:
+            logger.warning('login rate limited', extra={'limit': limited.name, 'retry_after': limited.retry_after})
+            flash('Too many log in attempts, please try again later.')
+            return login_page_response(LoginForm(), 429, limited.retry_after_header)
+
     # Bypass if user is logged in already
     if current_user.is_authenticated:
         # if current user actually has id, which they all should
         if hasattr(current_user, 'id'):
-            # get user id number
-            user_id = current_user.id
-            # filter for user to get user type as a string
-            current_user_type = User.query.filter(User.id==current_user.id)[0].user_type
+            # user type comes with the loaded user, no query needed
+            current_user_type = current_user.user_type
             # based upon user type, route to location
             if current_user_type=='sponsor':
                 return redirect(url_for('sponsor_bp.dashboard_sponsor'))
@@ -47,17 +59,26 @@ def login():
     # Validate login attempt
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user and user.check_password(password=form.password.data):
+        try:
+            valid = user is not None and user.check_password(password=form.password.data)
+        except HasherBusy:
+            # every hashing slot is taken, turn the login away instead of queueing it
+            logger.warning('password check pool full', extra={'email': form.email.data})
+            flash('Too many people are logging in right now, please try again in a moment.')
+            return login_page_response(form, 503, '1')
+        if valid:
+            # check_password upgraded an outdated hash, store it
+            if db.session.is_modified(user):
+                db.session.commit()
+                logger.info('password rehashed', extra={'user_id': user.id})
             login_user(user)
              # send to next page
             next_page = request.args.get('next')
             # user should already have a type since they logged-in in the past
             # use identity_changed to send signal to flask_principal showing identity, user_type
             identity_changed.send(current_app._get_current_object(), identity=Identity(user.id,user.user_type))
-            # placing identity_object into variable for print/display
-            identity_object = Identity(user.id,user.user_type)
-            # printing identity_object to console for verification
-            print('Sent: ',identity_object,' ...to current_app', file=sys.stderr)
+            # log the identity sent to current_app
+            logger.info('identity changed', extra={'user_id': user.id, 'user_type': user.user_type})
             # check user type, if sponsor go to sponsor dashboard
             if user.user_type=='sponsor':
                 # redirect to sponsor dashboard
@@ -80,17 +101,41 @@ def login():
         body="Log in with your User account."
     )
 
+def login_page_response(form, status, retry_after):
+    """The log-in page sent back with an error status and a Retry-After header."""
+    response = current_app.make_response(render_template(
+        'login.jinja2',
+        form=form,
+        title='Log in.',
+        template='login-page',
+        body="Log in with your User account."
+    ))
+    response.status_code = status
+    response.headers['Retry-After'] = retry_after
+    return response
+
 @login_manager.user_loader
 def load_user(user_id):
     """Check if user is logged-in on every page load."""
     if user_id is not None:
-        return User.query.get(user_id)
+        # read-only snapshot from the session store, the database only on a miss
+        snapshot = session_store.get_user(user_id)
+        if snapshot is None:
+            user = User.query.get(user_id)
+            if user is None:
+                return None
+            snapshot = UserSnapshot.from_user(user)
+            session_store.set_user(snapshot)
+        return snapshot
     return None
 
 
 @login_manager.unauthorized_handler
 def unauthorized():
     """Redirect unauthorized users to Login page."""
+    if request.blueprint == 'api_bp':
+        # api clients get a status, not a login page
+        return jsonify(error='login required'), 401
     flash('You must be logged in to view that page.')
     return redirect(url_for('auth_bp.login'))
 
@@ -117,12 +162,18 @@ def signupsponsor():
                 email=form.email.data,
                 organization=form.organization.data,
                 user_type='sponsor',
-                user_status='pending'
+                user_status='pending',
+                # signup trends on the admin analytics are bucketed on it
+                created_on=datetime.utcnow()
             )
             # use our set_password method
             user.set_password(form.password.data)
             # commit our new user record and log the user in
             db.session.add(user)
+            # the id is needed by the jobs, queued in the same transaction as the user
+            db.session.flush()
+            # admin notifications and the analytics refresh run in the worker
+            enqueue_signup(user.id)
             db.session.commit()  # Create new user
             login_user(user, remember=False, duration=None, force=False, fresh=True)
             # if everything goes well, they will be redirected to the main application
@@ -130,10 +181,8 @@ def signupsponsor():
             # new user now has a type, extract and send to permissions signal
             # use identity_changed to send signal to flask_principal showing identity, user_type
             identity_changed.send(current_app._get_current_object(), identity=Identity(user.id,user.user_type))
-            # placing identity_object into variable for print/display
-            identity_object = Identity(user.id,user.user_type)
-            # printing identity_object to console for verification
-            print('Sent: ',identity_object,' ...to current_app', file=sys.stderr)
+            # log the identity sent to current_app
+            logger.info('identity changed', extra={'user_id': user.id, 'user_type': user.user_type})
 
 
             return redirect(url_for('sponsor_bp.dashboard_sponsor'))
@@ -169,21 +218,25 @@ def signupeditor():
                 email=form.email.data,
                 organization=form.organization.data,
                 user_type='editor',
-                user_status='pending'
+                user_status='pending',
+                # signup trends on the admin analytics are bucketed on it
+                created_on=datetime.utcnow()
             )
             # use our set_password method
             user.set_password(form.password.data)
             # commit our new user record and log the user in
             db.session.add(user)
+            # the id is needed by the jobs, queued in the same transaction as the user
+            db.session.flush()
+            # admin notifications and the analytics refresh run in the worker
+            enqueue_signup(user.id)
             db.session.commit()  # Create new user
 
             # new user now has a type, extract and send to permissions signal
             # use identity_changed to send signal to flask_principal showing identity, user_type
             identity_changed.send(current_app._get_current_object(), identity=Identity(user.id,user.user_type))
-            # placing identity_object into variable for print/display
-            identity_object = Identity(user.id,user.user_type)
-            # printing identity_object to console for verification
-            print('Sent: ',identity_object,' ...to current_app', file=sys.stderr)
+            # log the identity sent to current_app
+            logger.info('identity changed', extra={'user_id': user.id, 'user_type': user.user_type})
 
             login_user(user, remember=False, duration=None, force=False, fresh=True)
             # if everything goes well, they will be redirected to the main application
@@ -0,0 +1,606 @@
+"""Benchmarks run through manage.py."""
+from contextlib import contextmanager
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+from sqlalchemy import event
+
+from . import db, identity_cache, password_hasher, rate_limiter, session_store
+from .models import User, Document, Retention
+from .userstats import rebuild_user_stats
+
+# password shared by every benchmark account
+BENCH_PASSWORD = 'benchpassword'
+
+# list views checked by the list view regression benchmark, (login email, url)
+LIST_VIEWS = (
+    ('bench-sponsor@example.com', '/sponsor/documents'),
+    ('bench-editor@example.com', '/editor/documents'),
+    ('bench-admin@example.com', '/admin/signuprequests'),
+    ('bench-admin@example.com', '/admin/usersview'),
+)
+
+
+class QueryCounter(object):
+    """Counts statements sent to the database."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+@contextmanager
+def count_queries(engine):
+    """Count every statement executed on engine inside the block."""
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter)
+
+
+def reset_schema():
+    """Drop and recreate every table, same as manage.py create_db."""
+    db.drop_all()
+    db.create_all()
+    db.session.commit()
+
+
+def create_bench_accounts():
+    """Create the approved sponsor, editor and admin used to log in."""
+    accounts = {}
+    for user_type in ('sponsor', 'editor', 'admin'):
+        user = User(
+            name='bench ' + user_type,
+            email='bench-%s@example.com' % user_type,
+            user_type=user_type,
+            user_status='approved'
+        )
+        user.set_password(BENCH_PASSWORD)
+        db.session.add(user)
+        accounts[user_type] = user
+    db.session.commit()
+    return dict((user_type, user.id) for user_type, user in accounts.items())
+
+
+def grow_tables(size, accounts, batch_size=5000):
+    """Grow users, documents and retentions to size rows each.
+
+    Rows are added with executemany inserts, the ORM is bypassed so seeding
+    100k rows stays quick. Every document is retained by the benchmark
+    sponsor and editor so their list views grow with the table.
+    """
+    user_count = db.session.query(User.id).count()
+    document_count = db.session.query(Document.id).count()
+
+    # extra users cycle through the sections of the admin views
+    statuses = ('pending', 'approved', 'rejected', None)
+    user_types = ('sponsor', 'editor')
+    rows = []
+    for n in range(user_count, size):
+        rows.append({
+            'name': 'user %d' % n,
+            'email': 'user%d@example.com' % n,
+            'password': 'x',
+            'user_type': user_types[n % 2],
+            'user_status': statuses[n % 4],
+            'organization': 'org %d' % (n % 50)
+        })
+        if len(rows) == batch_size:
+            db.session.execute(User.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(User.__table__.insert(), rows)
+
+    for start in range(document_count, size, batch_size):
+        stop = min(start + batch_size, size)
+        db.session.execute(Document.__table__.insert(), [
+            {'document_name': 'document %d' % n}
+            for n in range(start, stop)
+        ])
+    db.session.commit()
+
+    # retain every document that has no retention yet
+    retained = db.session.query(Retention.document_id)
+    new_ids = [row.id for row in db.session.query(Document.id).filter(~Document.id.in_(retained))]
+    for start in range(0, len(new_ids), batch_size):
+        db.session.execute(Retention.__table__.insert(), [
+            {'sponsor_id': accounts['sponsor'], 'editor_id': accounts['editor'], 'document_id': document_id}
+            for document_id in new_ids[start:start + batch_size]
+        ])
+    # the inserts bypassed the stats hooks
+    rebuild_user_stats()
+    db.session.commit()
+
+
+def login(client, email):
+    response = client.post('/login', data={'email': email, 'password': BENCH_PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError('benchmark login failed for %s' % email)
+
+
+def measure_view(app, email, url):
+    """Return (query count, seconds) for one GET of url, body fully read."""
+    client = app.test_client()
+    login(client, email)
+    # warm up so identity needs are cached before measuring
+    client.get(url).get_data()
+    with count_queries(db.engine) as counter:
+        start = time.perf_counter()
+        response = client.get(url)
+        # streamed responses only run their queries while the body is read
+        response.get_data()
+        elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError('%s returned %d' % (url, response.status_code))
+    return counter.count, elapsed
+
+
+def bench_listviews(app, sizes, echo=print):
+    """Measure query count and latency of each list view as the tables grow.
+
+    Returns a dict url -> list of (size, query count, seconds). A list view
+    regresses when its query count changes with the table size.
+    """
+    results = dict((url, []) for email, url in LIST_VIEWS)
+    # forms are posted directly, no csrf token
+    app.config['WTF_CSRF_ENABLED'] = False
+    # every benchmark login comes from one address, often for one email
+    rate_limiter.enabled = False
+
+    with app.app_context():
+        reset_schema()
+        accounts = create_bench_accounts()
+        for size in sorted(sizes):
+            echo('seeding %d rows per table...' % size)
+            grow_tables(size, accounts)
+            # rows were inserted without the ORM, drop identities cached on the way
+            identity_cache.clear()
+            session_store.clear()
+            for email, url in LIST_VIEWS:
+                queries, elapsed = measure_view(app, email, url)
+                results[url].append((size, queries, elapsed))
+                echo('  %-24s rows=%-7d queries=%-3d %.3fs' % (url, size, queries, elapsed))
+        db.session.remove()
+    return results
+
+
+def query_count_regressions(results):
+    """List of urls whose query count is not constant across sizes."""
+    return [
+        url for url, measurements in results.items()
+        if len(set(queries for size, queries, elapsed in measurements)) > 1
+    ]
+
+
+# ---------- login to dashboard to document list flow ----------
+
+# (step name, url) requested by each virtual sponsor after logging in,
+# {document_id} is one of the sponsor's own documents
+SPONSOR_FLOW = (
+    ('dashboard_sponsor', '/sponsor/dashboard'),
+    ('documentlist_sponsor', '/sponsor/documents'),
+    ('documentedit_sponsor', '/sponsor/documents/{document_id}'),
+)
+ADMIN_FLOW = (
+    ('dashboard_admin', '/admin/dashboard'),
+    ('usersview_admin', '/admin/usersview'),
+    ('signuprequests_admin', '/admin/signuprequests'),
+)
+
+# query count reported by the Server-Timing header
+SERVER_TIMING_QUERIES = re.compile(r'desc="(\d+) queries"')
+# hidden field rendered by form.csrf_token on the login page
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def seed(sponsors, editors, documents, batch_size=5000):
+    """Reset the schema and seed approved accounts, documents and retentions.
+
+    Accounts are sponsor<n>@example.com, editor<n>@example.com and
+    bench-admin@example.com, all with BENCH_PASSWORD. Documents are spread
+    round robin over the sponsors, each with a random editor. Returns
+    {sponsor email: [document ids]}.
+    """
+    reset_schema()
+
+    # hash once, every account shares the password
+    hashed = User(password='')
+    hashed.set_password(BENCH_PASSWORD)
+    accounts = [('admin', 'bench-admin@example.com')]
+    accounts += [('sponsor', 'sponsor%d@example.com' % n) for n in range(sponsors)]
+    accounts += [('editor', 'editor%d@example.com' % n) for n in range(editors)]
+    db.session.execute(User.__table__.insert(), [
+        {'name': email.split('@')[0], 'email': email, 'user_type': user_type,
+         'user_status': 'approved', 'password': hashed.password}
+        for user_type, email in accounts
+    ])
+    db.session.commit()
+
+    sponsor_ids = [row.id for row in db.session.query(User.id).filter(User.user_type == 'sponsor').order_by(User.id)]
+    editor_ids = [row.id for row in db.session.query(User.id).filter(User.user_type == 'editor').order_by(User.id)]
+    for start in range(0, documents, batch_size):
+        stop = min(start + batch_size, documents)
+        db.session.execute(Document.__table__.insert(), [
+            {'document_name': 'document %d' % n}
+            for n in range(start, stop)
+        ])
+    document_ids = [row.id for row in db.session.query(Document.id).order_by(Document.id)]
+
+    retentions = [
+        {'sponsor_id': sponsor_ids[n % len(sponsor_ids)], 'editor_id': random.choice(editor_ids), 'document_id': document_id}
+        for n, document_id in enumerate(document_ids)
+    ]
+    for start in range(0, len(retentions), batch_size):
+        db.session.execute(Retention.__table__.insert(), retentions[start:start + batch_size])
+    # the inserts bypassed the stats hooks
+    rebuild_user_stats()
+    db.session.commit()
+    # ids are reused after the reset, drop users cached under them
+    identity_cache.clear()
+    session_store.clear()
+
+    owned = dict(('sponsor%d@example.com' % n, []) for n in range(sponsors))
+    for n, document_id in enumerate(document_ids):
+        owned['sponsor%d@example.com' % (n % len(sponsor_ids))].append(document_id)
+    return owned
+
+
+class TestClientDriver(object):
+    """Sends requests through the Flask test client, in process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, data=None):
+        """Return (status, seconds, queries, body) with the body fully read."""
+        start = time.perf_counter()
+        response = self.client.open(url, method=method, data=data, buffered=True)
+        elapsed = time.perf_counter() - start
+        return (response.status_code, elapsed, _header_queries(response.headers.get('Server-Timing')),
+                response.get_data(as_text=True))
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpDriver(object):
+    """Sends requests over HTTP to a running server, with its own cookie jar."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect())
+
+    def request(self, method, url, data=None):
+        body = urlencode(data).encode() if data is not None else None
+        start = time.perf_counter()
+        try:
+            response = self.opener.open(urllib.request.Request(self.base_url + url, data=body, method=method))
+        except HTTPError as error:
+            # redirects and error statuses arrive as exceptions
+            response = error
+        body = response.read()
+        elapsed = time.perf_counter() - start
+        return (response.status, elapsed, _header_queries(response.headers.get('Server-Timing')),
+                body.decode('utf-8', 'replace'))
+
+
+def _header_queries(server_timing):
+    match = SERVER_TIMING_QUERIES.search(server_timing or '')
+    return int(match.group(1)) if match else None
+
+
+def run_user_flow(driver, email, steps, samples):
+    """Log in as email, request every step, log out. Appends to samples."""
+    status, elapsed, queries, body = driver.request('GET', '/login')
+    samples.append(('login_page', status, elapsed, queries))
+    form = {'email': email, 'password': BENCH_PASSWORD}
+    match = CSRF_TOKEN.search(body)
+    if match:
+        form['csrf_token'] = match.group(1)
+    status, elapsed, queries, body = driver.request('POST', '/login', form)
+    samples.append(('login', status, elapsed, queries))
+    if status != 302:
+        raise RuntimeError('benchmark login failed for %s' % email)
+
+    for name, url in steps:
+        status, elapsed, queries, body = driver.request('GET', url)
+        samples.append((name, status, elapsed, queries))
+    logout = '/admin/logout' if email.startswith('bench-admin') else '/sponsor/logout'
+    status, elapsed, queries, body = driver.request('GET', logout)
+    samples.append(('logout', status, elapsed, queries))
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    index = max(0, int(math.ceil(fraction * len(ordered))) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def summarize(samples, wall_seconds):
+    """Per-step latency percentiles in ms, mean queries, error counts and overall rps."""
+    steps = {}
+    for name, status, elapsed, queries in samples:
+        steps.setdefault(name, []).append((status, elapsed, queries))
+    summary = {
+        'requests': len(samples),
+        'wall_seconds': round(wall_seconds, 3),
+        'requests_per_second': round(len(samples) / wall_seconds, 2) if wall_seconds else None,
+        'steps': {}
+    }
+    for name, measurements in sorted(steps.items()):
+        latencies = [elapsed * 1000 for status, elapsed, queries in measurements]
+        queries = [queries for status, elapsed, queries in measurements if queries is not None]
+        summary['steps'][name] = {
+            'count': len(measurements),
+            'errors': sum(1 for status, elapsed, queries in measurements if status >= 400),
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'queries_per_request': round(sum(queries) / float(len(queries)), 2) if queries else None
+        }
+    return summary
+
+
+def drive(make_driver, owned, iterations, concurrency):
+    """Run iterations user flows spread over concurrency threads."""
+    sponsor_emails = sorted(owned)
+    samples = []
+    lock = threading.Lock()
+
+    def worker(worker_number):
+        driver = make_driver()
+        local = []
+        for iteration in range(worker_number, iterations, concurrency):
+            if iteration % 5 == 4:
+                # every fifth flow is an admin reviewing users
+                run_user_flow(driver, 'bench-admin@example.com', ADMIN_FLOW, local)
+            else:
+                email = sponsor_emails[iteration % len(sponsor_emails)]
+                document_id = random.choice(owned[email]) if owned[email] else 0
+                steps = [(name, url.format(document_id=document_id)) for name, url in SPONSOR_FLOW]
+                run_user_flow(driver, email, steps, local)
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@contextmanager
+def gunicorn_server(workers, cwd):
+    """Start gunicorn on wsgi:app against the same database, yield its base url."""
+    port = _free_port()
+    env = dict(os.environ, SERVER_TIMING='1')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', '127.0.0.1:%d' % port, '--workers', str(workers), 'wsgi:app'],
+        cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.1)
+        yield 'http://127.0.0.1:%d' % port
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def bench_flow(app, sponsors, editors, documents, iterations, concurrency, mode='client', workers=2, echo=print):
+    """Seed the database and time the login to document list flow.
+
+    mode 'client' drives the Flask test client in process, 'gunicorn'
+    starts a local gunicorn and drives it over HTTP. Returns the summary
+    with the run parameters.
+    """
+    # forms are posted directly, no csrf token
+    app.config['WTF_CSRF_ENABLED'] = False
+    # every benchmark login comes from one address, often for one email
+    rate_limiter.enabled = False
+    app.config['SERVER_TIMING'] = True
+
+    with app.app_context():
+        echo('seeding %d sponsors, %d editors, %d documents...' % (sponsors, editors, documents))
+        owned = seed(sponsors, editors, documents)
+        db.session.remove()
+
+    if mode == 'gunicorn':
+        cwd = os.path.dirname(app.root_path)
+        with gunicorn_server(workers, cwd) as base_url:
+            echo('driving %s with %d threads...' % (base_url, concurrency))
+            samples, wall_seconds = drive(lambda: HttpDriver(base_url), owned, iterations, concurrency)
+    else:
+        echo('driving the test client with %d threads...' % concurrency)
+        samples, wall_seconds = drive(lambda: TestClientDriver(app), owned, iterations, concurrency)
+
+    summary = summarize(samples, wall_seconds)
+    summary['parameters'] = {
+        'mode': mode, 'sponsors': sponsors, 'editors': editors, 'documents': documents,
+        'iterations': iterations, 'concurrency': concurrency, 'workers': workers if mode == 'gunicorn' else None,
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0]
+    }
+    return summary
+
+
+def format_summary(summary, baseline=None):
+    """Text table of a summary, with p95 change against a baseline summary."""
+    lines = ['%-22s %6s %6s %9s %9s %9s %8s %s' % (
+        'step', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'p95 vs baseline')]
+    for name, step in sorted(summary['steps'].items()):
+        change = ''
+        if baseline and name in baseline.get('steps', {}):
+            before = baseline['steps'][name]['p95_ms']
+            if before:
+                change = '%+.1f%%' % ((step['p95_ms'] - before) / before * 100)
+        lines.append('%-22s %6d %6d %9.2f %9.2f %9.2f %8s %s' % (
+            name, step['count'], step['errors'], step['p50_ms'], step['p95_ms'], step['p99_ms'],
+            step['queries_per_request'], change))
+    lines.append('%d requests in %.2fs, %.2f requests/s' % (
+        summary['requests'], summary['wall_seconds'], summary['requests_per_second'] or 0))
+    return '\n'.join(lines)
+
+
+# run in a fresh interpreter, nothing is imported yet
+_PROFILE_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import project
+imported = time.perf_counter()
+project.create_app()
+built = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'create_app_ms': (built - imported) * 1000}))
+"""
+
+
+def profile_import(top=15):
+    """Cold import time of the project package, from python -X importtime.
+
+    Returns total import and create_app times and the top modules by
+    cumulative import time, modules imported by create_app included.
+    """
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _PROFILE_SCRIPT],
+        cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'import failed')
+
+    modules = []
+    # "import time: self [us] | cumulative | imported package"
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        modules.append({
+            'module': name.strip(),
+            'self_ms': int(self_us) / 1000.0,
+            'cumulative_ms': int(cumulative_us) / 1000.0
+        })
+    modules.sort(key=lambda entry: entry['cumulative_ms'], reverse=True)
+
+    results = json.loads(process.stdout.strip().splitlines()[-1])
+    results['modules'] = modules[:top]
+    return results
+
+
+def save_summary(summary, path):
+    with open(path, 'w') as output:
+        json.dump(summary, output, indent=2, sort_keys=True)
+
+
+def load_summary(path):
+    with open(path) as source:
+        return json.load(source)
+
+
+# ---------- login throughput per password hash setting ----------
+
+def parse_hash_settings(spec):
+    """Pairs of (method, cost) from "pbkdf2:sha256@260000,scrypt@16384", cost optional."""
+    settings = []
+    for item in spec.split(','):
+        item = item.strip()
+        if item:
+            method, _, cost = item.partition('@')
+            settings.append((method, int(cost) if cost else None))
+    return settings
+
+
+def bench_login(app, settings, logins, concurrency, echo=print):
+    """Login throughput and latency for each (method, cost) setting.
+
+    Every setting reseeds the benchmark accounts with its hashes, then
+    concurrency threads post logins through the test client. Logins turned
+    away because the hashing pool was full are counted as busy. The hasher
+    is put back to the app configuration afterwards.
+    """
+    app.config['WTF_CSRF_ENABLED'] = False
+    # every benchmark login comes from one address, often for one email
+    rate_limiter.enabled = False
+    results = []
+    try:
+        for method, cost in settings:
+            password_hasher.configure(method, cost)
+            with app.app_context():
+                reset_schema()
+                create_bench_accounts()
+                db.session.remove()
+
+            samples = []
+            lock = threading.Lock()
+
+            def worker(worker_number):
+                local = []
+                for n in range(worker_number, logins, concurrency):
+                    # a fresh client per login, an existing session skips the password check
+                    client = app.test_client()
+                    start = time.perf_counter()
+                    response = client.post('/login', data={'email': 'bench-sponsor@example.com', 'password': BENCH_PASSWORD})
+                    local.append((response.status_code, time.perf_counter() - start))
+                with lock:
+                    samples.extend(local)
+
+            threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wall_seconds = time.perf_counter() - start
+
+            latencies = [elapsed * 1000 for status, elapsed in samples if status == 302]
+            result = {
+                'method': password_hasher.method_string,
+                'logins': len(latencies),
+                'busy': sum(1 for status, elapsed in samples if status == 503),
+                'failed': sum(1 for status, elapsed in samples if status not in (302, 503)),
+                'logins_per_second': round(len(latencies) / wall_seconds, 2),
+                'p50_ms': round(percentile(latencies, 0.50), 3) if latencies else None,
+                'p95_ms': round(percentile(latencies, 0.95), 3) if latencies else None
+            }
+            results.append(result)
+            echo('  %-28s %8.2f logins/s  p50=%sms p95=%sms busy=%d failed=%d' % (
+                result['method'], result['logins_per_second'], result['p50_ms'], result['p95_ms'],
+                result['busy'], result['failed']))
+    finally:
+        password_hasher.init_app(app)
+        rate_limiter.init_app(app)
+    return results
@@ -0,0 +1,267 @@
+"""Document bodies, stored in compressed chunks outside the documents table."""
+import codecs
+import zlib
+
+from sqlalchemy import func
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+from . import db
+from .models import DocumentBodyChunk
+from .resultstream import stream_rows
+
+
+class BodyTooLarge(RequestEntityTooLarge):
+    """The body is over DOCUMENT_BODY_MAX_SIZE bytes, a 413 when not caught."""
+
+
+class BodyNotText(BadRequest):
+    """The body is not valid UTF-8, a 400 when not caught."""
+
+
+class BadPatch(BadRequest):
+    """Patches overlap, are out of order or reach past the end of the body."""
+
+
+# chunks are numbered 0, SEQ_STRIDE, 2 * SEQ_STRIDE..., a patch that grows a
+# chunk puts the extra chunks in the gap before the next one
+SEQ_STRIDE = 1024
+
+
+class BodyStore(object):
+    """Reads and writes document bodies chunk by chunk.
+
+    A body is UTF-8 text split into DOCUMENT_BODY_CHUNK_SIZE byte rows of
+    document_body_chunks, each zlib compressed when that makes it smaller.
+    Chunks end on character boundaries, each one decodes on its own.
+    Lists and permission checks never read the table, only the edit views
+    and the body download do. Writes and reads go one chunk at a time, so a
+    streamed upload or download never holds the whole body in memory.
+    """
+
+    def __init__(self, app=None):
+        self.chunk_size = 256 * 1024
+        self.compress_level = 6
+        self.max_size = 64 * 1024 * 1024
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.chunk_size = app.config.get('DOCUMENT_BODY_CHUNK_SIZE', self.chunk_size)
+        # 0 stores chunks uncompressed
+        self.compress_level = app.config.get('DOCUMENT_BODY_COMPRESS_LEVEL', self.compress_level)
+        self.max_size = app.config.get('DOCUMENT_BODY_MAX_SIZE', self.max_size)
+
+    # ---------- writing ----------
+
+    def rows(self, document_id, pieces):
+        """document_body_chunks rows for a body given as pieces of bytes.
+
+        Pieces may be of any size, they are regrouped into chunk_size
+        chunks. Raises BodyTooLarge past max_size and BodyNotText when the
+        bytes are not UTF-8.
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        size = 0
+        seq = 0
+        buffer = b''
+        for piece in pieces:
+            size += len(piece)
+            if size > self.max_size:
+                raise BodyTooLarge()
+            try:
+                decoder.decode(piece)
+            except UnicodeDecodeError:
+                raise BodyNotText()
+            buffer += piece
+            while len(buffer) >= self.chunk_size:
+                cut = _character_boundary(buffer, self.chunk_size)
+                yield self._row(document_id, seq, buffer[:cut])
+                buffer = buffer[cut:]
+                seq += SEQ_STRIDE
+        try:
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            raise BodyNotText()
+        if buffer:
+            yield self._row(document_id, seq, buffer)
+
+    def _row(self, document_id, seq, raw):
+        data, compressed = raw, False
+        if self.compress_level:
+            packed = zlib.compress(raw, self.compress_level)
+            # short or already compressed chunks are kept as they are
+            if len(packed) < len(raw):
+                data, compressed = packed, True
+        return {'document_id': document_id, 'seq': seq, 'size': len(raw), 'compressed': compressed, 'data': data}
+
+    def write(self, document_id, pieces):
+        """Replace the body of a document, returns its size in bytes.
+
+        Each chunk is inserted as soon as it is complete. Runs in the
+        current transaction, the caller commits.
+        """
+        self.delete(document_id)
+        size = 0
+        for row in self.rows(document_id, pieces):
+            db.session.execute(DocumentBodyChunk.__table__.insert(), row)
+            size += row['size']
+        return size
+
+    def write_text(self, document_id, body):
+        """Replace the body of a document with a string, None leaves it empty."""
+        return self.write(document_id, [body.encode('utf-8')] if body else [])
+
+    def insert_many(self, bodies, batch_size=500):
+        """Insert the bodies of new documents, bodies is a list of (document_id, text)."""
+        rows = []
+        for document_id, body in bodies:
+            if body:
+                rows.extend(self.rows(document_id, [body.encode('utf-8')]))
+            if len(rows) >= batch_size:
+                db.session.execute(DocumentBodyChunk.__table__.insert(), rows)
+                rows = []
+        if rows:
+            db.session.execute(DocumentBodyChunk.__table__.insert(), rows)
+
+    def patch(self, document_id, patches):
+        """Apply text range patches to a body, returns its new size in bytes.
+
+        patches are (start, end, text) tuples, start and end are character
+        offsets into the current body, not overlapping, inserts at the same
+        offset go in the order given. Only
+        the chunks a patch touches are read and rewritten, reading stops
+        after the last one. Runs in the current transaction, the caller
+        commits. Raises BadPatch when a range is out of order or past the
+        end of the body.
+        """
+        patches = sorted_patches(patches)
+        previous_end = 0
+        for start, end, text in patches:
+            if start < previous_end or end < start:
+                raise BadPatch('patches must be in order and must not overlap')
+            previous_end = end
+
+        rewrites = []
+        for first_seq, next_seq, text, offset, run_patches in self._touched_runs(document_id, patches):
+            rows = list(self.rows(document_id, [_apply(text, run_patches, offset).encode('utf-8')]))
+            if next_seq is not None and next_seq - first_seq < len(rows):
+                # no free sequence numbers left before the next chunk, rewrite everything
+                return self.write_text(document_id, _apply(self.read_text(document_id), patches, 0))
+            # spread the new chunks over the free sequence numbers
+            step = SEQ_STRIDE if next_seq is None else (next_seq - first_seq) // max(len(rows), 1)
+            for index, row in enumerate(rows):
+                row['seq'] = first_seq + index * step
+            rewrites.append((first_seq, next_seq, rows))
+
+        chunks = DocumentBodyChunk.__table__
+        for first_seq, next_seq, rows in rewrites:
+            delete = chunks.delete().where(chunks.c.document_id == document_id).where(chunks.c.seq >= first_seq)
+            if next_seq is not None:
+                delete = delete.where(chunks.c.seq < next_seq)
+            db.session.execute(delete)
+            if rows:
+                db.session.execute(chunks.insert(), rows)
+        return self.size(document_id)
+
+    def _touched_runs(self, document_id, patches):
+        """Runs of neighbouring chunks touched by patches.
+
+        Returns a list of (seq of the first chunk, seq of the chunk after
+        the run or None, text of the run, character offset of the run,
+        patches falling in the run).
+        """
+        pending = list(patches)
+        runs = []
+        run = None
+        position = 0
+        query = db.session.query(DocumentBodyChunk.seq, DocumentBodyChunk.compressed, DocumentBodyChunk.data).\
+            filter(DocumentBodyChunk.document_id == document_id).\
+            order_by(DocumentBodyChunk.seq)
+        for seq, compressed, data in stream_rows(query, batch_size=1):
+            if run is None and not pending:
+                # every patch is placed, the rest of the body is left alone
+                return runs
+            text = (zlib.decompress(data) if compressed else bytes(data)).decode('utf-8')
+            start, end = position, position + len(text)
+            position = end
+            mine = []
+            while pending and pending[0][0] <= end:
+                mine.append(pending.pop(0))
+            if run is not None and not mine and start >= run['reach']:
+                # the run ends before this chunk
+                runs.append((run['first_seq'], seq, ''.join(run['texts']), run['offset'], run['patches']))
+                run = None
+            if mine:
+                if run is None:
+                    # reach is the furthest patch end, chunks before it belong to the run
+                    run = {'first_seq': seq, 'texts': [], 'offset': start, 'patches': [], 'reach': 0}
+                run['patches'].extend(mine)
+                run['reach'] = max([run['reach']] + [patch[1] for patch in mine])
+            if run is not None:
+                run['texts'].append(text)
+
+        if pending and position == 0 and all(patch[:2] == (0, 0) for patch in pending):
+            # an empty body, the inserts start it
+            run = {'first_seq': 0, 'texts': [], 'offset': 0, 'patches': pending, 'reach': 0}
+        elif pending or (run is not None and run['reach'] > position):
+            raise BadPatch('patch past the end of the body')
+        if run is not None:
+            runs.append((run['first_seq'], None, ''.join(run['texts']), run['offset'], run['patches']))
+        return runs
+
+    def delete(self, document_id):
+        chunks = DocumentBodyChunk.__table__
+        db.session.execute(chunks.delete().where(chunks.c.document_id == document_id))
+
+    # ---------- reading ----------
+
+    def size(self, document_id):
+        """Size of the body in bytes, 0 when there is none."""
+        return db.session.query(func.coalesce(func.sum(DocumentBodyChunk.size), 0)).\
+            filter(DocumentBodyChunk.document_id == document_id).scalar()
+
+    def chunks(self, document_id):
+        """Yield the body as bytes, one decompressed chunk at a time."""
+        query = db.session.query(DocumentBodyChunk.compressed, DocumentBodyChunk.data).\
+            filter(DocumentBodyChunk.document_id == document_id).\
+            order_by(DocumentBodyChunk.seq)
+        # one chunk per fetch, a server-side cursor on postgres
+        for compressed, data in stream_rows(query, batch_size=1):
+            yield zlib.decompress(data) if compressed else bytes(data)
+
+    def read_text(self, document_id):
+        """The whole body as a string, empty when there is none."""
+        return b''.join(self.chunks(document_id)).decode('utf-8')
+
+
+def sorted_patches(patches):
+    """patches ordered by range, stable, so inserts at one offset keep their order."""
+    return sorted(patches, key=lambda patch: (patch[0], patch[1]))
+
+
+def read_stream(stream, size):
+    """Yield a request body stream in pieces of at most size bytes."""
+    while True:
+        piece = stream.read(size)
+        if not piece:
+            break
+        yield piece
+
+
+def _character_boundary(data, limit):
+    """Largest cut at or below limit that does not split a UTF-8 character."""
+    if len(data) <= limit:
+        return len(data)
+    cut = limit
+    # continuation bytes are 10xxxxxx, a character is at most 4 bytes
+    while cut > limit - 4 and cut > 0 and (data[cut] & 0xC0) == 0x80:
+        cut -= 1
+    return cut if cut > 0 else limit
+
+
+def _apply(text, patches, offset):
+    """text with patches applied, their offsets counted from offset."""
+    for start, end, replacement in reversed(patches):
+        start, end = start - offset, end - offset
+        text = text[:start] + replacement + text[end:]
+    return text
@@ -5,11 +5,46 @@ from os import environ, path
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-# False means Flask-Assets will bundle our static files while we're running Flask in debug mode. 
-ASSETS_DEBUG = False
+def env_flag(name, default=False):
+    """Boolean environment variable, 1/true/yes/on are true."""
+    value = environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def engine_options(database_uri):
+    """create_engine options for database_uri, sized from the environment.
+
+    Every gunicorn worker holds its own pool, so the most connections a
+    deployment opens is workers * (DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW).
+    """
+    # sqlite has no connection pool to size
+    if database_uri.startswith('sqlite'):
+        return {}
+
+    options = {
+        'pool_size': int(environ.get('DATABASE_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('DATABASE_MAX_OVERFLOW', 10)),
+        # seconds to wait for a free connection before erroring
+        'pool_timeout': int(environ.get('DATABASE_POOL_TIMEOUT', 30)),
+        # seconds after which a connection is replaced, -1 never
+        'pool_recycle': int(environ.get('DATABASE_POOL_RECYCLE', 1800)),
+        # test connections on checkout, stale ones after a postgres restart are replaced
+        'pool_pre_ping': env_flag('DATABASE_POOL_PRE_PING', True),
+    }
+
+    # milliseconds, 0 leaves the server default
+    statement_timeout = int(environ.get('DATABASE_STATEMENT_TIMEOUT', 0))
+    # pgbouncer in transaction pooling rejects startup options, there
+    # statement_timeout has to be set on the database role instead.
+    # psycopg2 never prepares statements on the server, so that is all
+    # pgbouncer mode changes here.
+    if statement_timeout and database_uri.startswith('postgres') and not env_flag('DATABASE_PGBOUNCER'):
+        options['connect_args'] = {'options': '-c statement_timeout=%d' % statement_timeout}
+
+    return options
 
-# tell Flask to build our bundles of assets when Flask starts up
-ASSETS_AUTO_BUILD = True
 
 # environment specific configuration variables
 class Config(object):
@@ -19,6 +54,15 @@ class Config(object):
 
     # Flask-Assets
     #ASSETS_DEBUG = environ.get('ASSETS_DEBUG')
+    # False means Flask-Assets will bundle our static files while we're running Flask in debug mode.
+    ASSETS_DEBUG = False
+    # rebuild changed bundles on render, development only, production runs manage.py build_assets
+    ASSETS_AUTO_BUILD = env_flag('ASSETS_AUTO_BUILD', FLASK_ENV == 'development')
+    # bundle file names carry a content hash, looked up in the manifest at runtime
+    ASSETS_VERSIONS = 'hash'
+    ASSETS_MANIFEST = 'json:dist/manifest.json'
+    ASSETS_URL_EXPIRE = False
+    ASSETS_CACHE = env_flag('ASSETS_CACHE', FLASK_ENV == 'development')
 
     # Static Assets
     STATIC_FOLDER = 'static'
@@ -29,4 +73,158 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL_PROD", "postgresql://")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ECHO = False
+    # pool sizing, pre-ping and statement timeout, see engine_options
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    # running behind pgbouncer transaction pooling, no server-side cursors
+    DATABASE_PGBOUNCER = env_flag('DATABASE_PGBOUNCER')
+
+    # Password hashing
+    # pbkdf2:sha256, pbkdf2:sha512 or scrypt, older hashes are upgraded at login
+    PASSWORD_HASH_METHOD = environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+    # pbkdf2 iterations or scrypt work factor, empty uses the scheme default
+    PASSWORD_HASH_COST = environ.get('PASSWORD_HASH_COST')
+    # threads checking passwords per worker, 0 checks in the request thread
+    PASSWORD_HASH_THREADS = int(environ.get('PASSWORD_HASH_THREADS', 2))
+    # checks allowed to wait for a thread, logins beyond that get a 503
+    PASSWORD_HASH_QUEUE = int(environ.get('PASSWORD_HASH_QUEUE', 16))
+    # seconds a login waits for its check
+    PASSWORD_HASH_TIMEOUT = float(environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+    # Login rate limits, see ratelimit.py
+    # checked on every login POST before the form is validated or the database is queried
+    RATE_LIMIT_ENABLED = env_flag('RATE_LIMIT_ENABLED', True)
+    # "<attempts>/<seconds>", empty turns a limit off
+    RATE_LIMIT_LOGIN_IP = environ.get('RATE_LIMIT_LOGIN_IP', '20/60')
+    RATE_LIMIT_LOGIN_EMAIL = environ.get('RATE_LIMIT_LOGIN_EMAIL', '5/300')
+    # shared keeps token buckets in memory shared by the workers of a host,
+    # redis keeps sliding window counters on a server shared by every host
+    RATE_LIMIT_BACKEND = environ.get('RATE_LIMIT_BACKEND', 'shared')
+    # file of the shared backend, empty uses /dev/shm or the system temp directory
+    RATE_LIMIT_SHM_PATH = environ.get('RATE_LIMIT_SHM_PATH')
+    # buckets held by the shared backend, 24 bytes each
+    RATE_LIMIT_SHM_SLOTS = int(environ.get('RATE_LIMIT_SHM_SLOTS', 65536))
+    # any Redis protocol server, manage.py session_standin for development
+    RATE_LIMIT_REDIS_URL = environ.get('RATE_LIMIT_REDIS_URL', environ.get('SESSION_REDIS_URL', 'redis://localhost:6379/0'))
+    # proxies in front of the app, the client address is read from X-Forwarded-For past them
+    RATE_LIMIT_TRUSTED_PROXIES = int(environ.get('RATE_LIMIT_TRUSTED_PROXIES', 0))
+
+    # Sessions and user snapshots
+    # cookie keeps Flask's signed cookie sessions, memory (single worker only),
+    # filesystem and redis keep session data server-side
+    SESSION_BACKEND = environ.get('SESSION_BACKEND', 'cookie')
+    # entries held by the memory backend
+    SESSION_STORE_SIZE = int(environ.get('SESSION_STORE_SIZE', 10000))
+    # directory of the filesystem backend, empty uses the system temp directory
+    SESSION_FILE_DIR = environ.get('SESSION_FILE_DIR')
+    # any Redis protocol server, redis://[:password@]host:port/db
+    SESSION_REDIS_URL = environ.get('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+    # seconds a session that is not permanent is kept after its last change
+    SESSION_STORE_TTL = int(environ.get('SESSION_STORE_TTL', 86400))
+    # seconds load_user serves a cached user snapshot, 0 always queries
+    USER_SNAPSHOT_TTL = int(environ.get('USER_SNAPSHOT_TTL', 60))
+
+    # Static files
+    # serve /static before flask, with sendfile, ETags, ranges and .br/.gz variants
+    STATIC_MIDDLEWARE = env_flag('STATIC_MIDDLEWARE', True)
+    # seconds browsers cache static files without a content hash in their name
+    STATIC_MAX_AGE = int(environ.get('STATIC_MAX_AGE', 43200))
+
+    # Templates
+    # re-stat templates on each render, development only unless set explicitly
+    TEMPLATES_AUTO_RELOAD = env_flag('TEMPLATES_AUTO_RELOAD', FLASK_ENV == 'development')
+    # keep compiled templates on disk between restarts, see manage.py compile_templates
+    TEMPLATE_BYTECODE_CACHE = env_flag('TEMPLATE_BYTECODE_CACHE', True)
+    # empty uses a per-user directory under the system temp directory
+    TEMPLATE_BYTECODE_DIR = environ.get('TEMPLATE_BYTECODE_DIR')
+    # compile every template in create_app instead of on first render
+    TEMPLATE_PRECOMPILE = env_flag('TEMPLATE_PRECOMPILE', not TEMPLATES_AUTO_RELOAD)
+    # {% cache %} blocks of dashboards and lists, stored on the session backend
+    FRAGMENT_CACHE_ENABLED = env_flag('FRAGMENT_CACHE_ENABLED', True)
+    # seconds a fragment is kept, also how stale other workers can be with a per-process backend
+    FRAGMENT_CACHE_TTL = int(environ.get('FRAGMENT_CACHE_TTL', 60))
+
+    # Identity needs cache, per worker process
+    # maximum number of users held, 0 disables the cache
+    IDENTITY_CACHE_SIZE = int(environ.get('IDENTITY_CACHE_SIZE', 1024))
+    # seconds before a cached identity is reloaded, picks up changes made by other workers
+    IDENTITY_CACHE_TTL = int(environ.get('IDENTITY_CACHE_TTL', 60))
+
+    # List views
+    # rows fetched per round trip when streaming list query results
+    RESULT_BATCH_SIZE = int(environ.get('RESULT_BATCH_SIZE', 500))
+    # template chunks grouped into each write of a streamed response
+    TEMPLATE_STREAM_BUFFER = int(environ.get('TEMPLATE_STREAM_BUFFER', 64))
+    # rows per page of sponsor, editor and admin lists, ?per_page= is capped at the maximum
+    LIST_PAGE_SIZE = int(environ.get('LIST_PAGE_SIZE', 50))
+    LIST_MAX_PAGE_SIZE = int(environ.get('LIST_MAX_PAGE_SIZE', 500))
+
+    # Admin analytics, see analytics.py
+    # seconds the grouped user counts are reused before being queried again
+    ADMIN_ANALYTICS_TTL = int(environ.get('ADMIN_ANALYTICS_TTL', 30))
+    # days of signups bucketed when ?days= is not given
+    ADMIN_ANALYTICS_DAYS = int(environ.get('ADMIN_ANALYTICS_DAYS', 30))
+
+    # Background jobs, see jobs.py, run by manage.py worker
+    # threads per worker process, each runs one job at a time
+    JOB_WORKER_CONCURRENCY = int(environ.get('JOB_WORKER_CONCURRENCY', 2))
+    # seconds an idle worker thread waits before looking for due jobs again
+    JOB_POLL_INTERVAL = float(environ.get('JOB_POLL_INTERVAL', 1.0))
+    # runs of a job before it is kept as failed
+    JOB_MAX_ATTEMPTS = int(environ.get('JOB_MAX_ATTEMPTS', 5))
+    # seconds before the first retry, doubled for each one after it up to the maximum
+    JOB_RETRY_BACKOFF = float(environ.get('JOB_RETRY_BACKOFF', 10))
+    JOB_RETRY_BACKOFF_MAX = float(environ.get('JOB_RETRY_BACKOFF_MAX', 3600))
+    # seconds a claimed job is leased, a job still running past it may be claimed again
+    JOB_LEASE_SECONDS = int(environ.get('JOB_LEASE_SECONDS', 300))
+
+    # Bulk document creation
+    # documents accepted by a single /sponsor/newdocuments request
+    BULK_CREATE_MAX_DOCUMENTS = int(environ.get('BULK_CREATE_MAX_DOCUMENTS', 1000))
+    # rows per insert statement
+    BULK_INSERT_BATCH_SIZE = int(environ.get('BULK_INSERT_BATCH_SIZE', 500))
+
+    # Document bodies, see bodystore.py
+    # bytes of body text per stored chunk, also the unit of streamed uploads and downloads
+    DOCUMENT_BODY_CHUNK_SIZE = int(environ.get('DOCUMENT_BODY_CHUNK_SIZE', 256 * 1024))
+    # zlib level for stored chunks, 0 stores them uncompressed
+    DOCUMENT_BODY_COMPRESS_LEVEL = int(environ.get('DOCUMENT_BODY_COMPRESS_LEVEL', 6))
+    # largest body accepted, in bytes
+    DOCUMENT_BODY_MAX_SIZE = int(environ.get('DOCUMENT_BODY_MAX_SIZE', 64 * 1024 * 1024))
+
+    # Document revisions, see revisions.py
+    # a full snapshot every this many versions, a rebuild applies at most as many deltas
+    DOCUMENT_REVISION_SNAPSHOT_EVERY = int(environ.get('DOCUMENT_REVISION_SNAPSHOT_EVERY', 20))
+    # rebuilt revision bodies kept per worker, and for how many seconds
+    DOCUMENT_REVISION_CACHE_SIZE = int(environ.get('DOCUMENT_REVISION_CACHE_SIZE', 256))
+    DOCUMENT_REVISION_CACHE_TTL = int(environ.get('DOCUMENT_REVISION_CACHE_TTL', 3600))
+
+    # Document search, see search.py
+    # postgresql text search configuration, stemming and stop words
+    SEARCH_LANGUAGE = environ.get('SEARCH_LANGUAGE', 'english')
+    # characters of each body that are indexed, a tsvector is limited to 1MB
+    SEARCH_BODY_LIMIT = int(environ.get('SEARCH_BODY_LIMIT', 500000))
+    # without postgresql, a word in the name ranks like this many in the body
+    SEARCH_NAME_WEIGHT = int(environ.get('SEARCH_NAME_WEIGHT', 10))
+
+    # Logging, JSON lines on stderr written by a background thread
+    # LOG_ENABLED=0 turns project logging off entirely
+    LOG_ENABLED = env_flag('LOG_ENABLED', True)
+    LOG_LEVEL = environ.get('LOG_LEVEL', 'INFO').upper()
+    # per-logger levels, e.g. "project.auth=DEBUG,project.routes=WARNING"
+    LOG_LEVELS = environ.get('LOG_LEVELS', '')
+    # fraction of debug and info records kept, warnings and errors are always kept
+    LOG_SAMPLE_RATE = float(environ.get('LOG_SAMPLE_RATE', 1.0))
+    # records waiting for the writer, more are dropped instead of blocking requests
+    LOG_QUEUE_SIZE = int(environ.get('LOG_QUEUE_SIZE', 10000))
 
+    # Request instrumentation
+    # per-endpoint query count, db time, render time and latency, per worker
+    METRICS_ENABLED = env_flag('METRICS_ENABLED', True)
+    # Prometheus text endpoint
+    METRICS_PATH = environ.get('METRICS_PATH', '/metrics')
+    # scrapers send "Authorization: Bearer <token>", empty accepts no token
+    METRICS_TOKEN = environ.get('METRICS_TOKEN', '')
+    # networks served without the token, comma separated, empty allows none
+    METRICS_ALLOWED_NETWORKS = environ.get('METRICS_ALLOWED_NETWORKS', '127.0.0.1/32,::1/128')
+    # add a Server-Timing header with db, render and total time to each response
+    SERVER_TIMING = env_flag('SERVER_TIMING', False)
@@ -0,0 +1,189 @@
+"""Document creation, single and in bulk, and versioned saves with their revisions."""
+from sqlalchemy import text
+from sqlalchemy.orm.exc import StaleDataError
+
+from . import db, identity_cache, fragment_cache, body_store, revision_store, search_index
+from .bodystore import sorted_patches
+from .models import Document, User, Retention
+from .revisions import patch_ops, text_ops
+from .userstats import retentions_added
+
+
+def create_document(sponsor_id, editor_id, document_name, document_body):
+    """Create a document, its body and its retention in a single commit.
+
+    The retention points at the document through its relationship, so the
+    flush inserts the document first and fills in the generated id, which
+    the body chunks and the first revision are stored under.
+    """
+    newdocument = Document(
+        document_name=document_name
+        )
+    newretention = Retention(
+        sponsor_id=sponsor_id,
+        editor_id=editor_id,
+        document=newdocument
+        )
+    db.session.add(newretention)
+    db.session.flush()
+    body_store.write_text(newdocument.id, document_body)
+    revision_store.record_new(newdocument.id, document_name, document_body, author_id=sponsor_id)
+    search_index.update(newdocument.id, document_name or '', document_body or '')
+    db.session.commit()
+    return newdocument
+
+
+def _allocate_document_ids(count):
+    """Draw count ids from the documents id sequence in one round trip, postgres only."""
+    rows = db.session.execute(
+        text("SELECT nextval(pg_get_serial_sequence('documents', 'id')) FROM generate_series(1, :count)"),
+        {'count': count}
+    )
+    return [row[0] for row in rows]
+
+
+def _insert_documents(rows):
+    """Insert a batch of document rows, return their ids in the same order."""
+    if db.engine.dialect.name == 'postgresql':
+        # ids are allocated up front so the batch is a single executemany
+        document_ids = _allocate_document_ids(len(rows))
+        db.session.execute(Document.__table__.insert(), [
+            dict(row, id=document_id) for row, document_id in zip(rows, document_ids)
+        ])
+        return document_ids
+    # without sequences the ids are only known once the ORM flushes
+    documents = [Document(**row) for row in rows]
+    db.session.add_all(documents)
+    db.session.flush()
+    return [document.id for document in documents]
+
+
+def invalid_editor_ids(editor_ids):
+    """Ids in editor_ids that do not belong to an editor."""
+    editor_ids = set(editor_ids)
+    found = db.session.query(User.id).filter(User.id.in_(editor_ids)).filter(User.user_type == 'editor')
+    return editor_ids - set(row.id for row in found)
+
+
+def bulk_create_documents(sponsor_id, items, batch_size=500):
+    """Create many documents and their retentions in one transaction.
+
+    items are dicts with document_name, document_body and editor_id.
+    Documents and retentions are inserted batch_size rows per statement.
+    Returns the new document ids in the order of items.
+    """
+    document_ids = []
+    try:
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            batch_ids = _insert_documents([
+                {'document_name': item.get('document_name')}
+                for item in batch
+            ])
+            body_store.insert_many(
+                [(document_id, item.get('document_body')) for item, document_id in zip(batch, batch_ids)],
+                batch_size=batch_size
+            )
+            revision_store.record_new_many(
+                [(document_id, item.get('document_name'), item.get('document_body'))
+                 for item, document_id in zip(batch, batch_ids)],
+                author_id=sponsor_id, batch_size=batch_size
+            )
+            search_index.update_many(
+                [(document_id, item.get('document_name'), item.get('document_body'))
+                 for item, document_id in zip(batch, batch_ids)],
+                batch_size=batch_size
+            )
+            db.session.execute(Retention.__table__.insert(), [
+                {'sponsor_id': sponsor_id, 'editor_id': item['editor_id'], 'document_id': document_id}
+                for item, document_id in zip(batch, batch_ids)
+            ])
+            retentions_added([(sponsor_id, item['editor_id']) for item in batch])
+            document_ids.extend(batch_ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    # retentions were inserted without the ORM, drop the cached identities and lists by hand
+    user_ids = set(item['editor_id'] for item in items) | {sponsor_id}
+    identity_cache.invalidate(*user_ids)
+    fragment_cache.invalidate(*user_ids)
+    return document_ids
+
+
+class VersionConflict(Exception):
+    """The document was saved by someone else since the version being edited."""
+
+    def __init__(self, current_version):
+        super(VersionConflict, self).__init__(current_version)
+        self.current_version = current_version
+
+
+def claim_version(document, expected_version=None):
+    """Move document to the next version, if it is still at expected_version.
+
+    Pending changes to the document go out in the same UPDATE, which only
+    matches the row while it still has the version that was loaded. It is
+    flushed right away, before any body chunks are written, so a conflict
+    costs nothing and the row lock is held from here to the commit. None
+    skips the comparison with the client's version. Raises VersionConflict
+    after rolling back.
+    """
+    if expected_version is not None and document.version != expected_version:
+        current_version = document.version
+        db.session.rollback()
+        raise VersionConflict(current_version)
+    document.version = document.version + 1
+    try:
+        db.session.flush()
+    except StaleDataError:
+        # saved by another request between loading and flushing
+        db.session.rollback()
+        raise VersionConflict(db.session.query(Document.version).filter(Document.id == document.id).scalar())
+    return document.version
+
+
+def save_document(document, expected_version, document_name=None, body=None, body_patches=None, author_id=None):
+    """Compare-and-swap save of a document, returns the new version.
+
+    Only the given parts are written, a name, a whole body or body_patches,
+    (start, end, text) character ranges of the body. The save is recorded
+    as a revision by author_id, a delta of what changed, and only the
+    changed fields are re-indexed for search. The caller commits.
+    """
+    previous_version, previous_name = document.version, document.document_name
+    if document_name is not None:
+        document.document_name = document_name
+    version = claim_version(document, expected_version)
+    revision_store.ensure_baseline(document.id, previous_version, previous_name)
+    indexed_body = body
+    if body is not None:
+        # the delta is taken against the body being replaced
+        ops = text_ops(body_store.read_text(document.id), body)
+        body_store.write_text(document.id, body)
+    elif body_patches:
+        body_store.patch(document.id, body_patches)
+        ops = patch_ops(sorted_patches(body_patches))
+        indexed_body = search_index.stored_body(document.id)
+    else:
+        ops = patch_ops([])
+    revision_store.record(document.id, version, document.document_name, author_id=author_id, ops=ops)
+    search_index.update(document.id, document_name=document_name, body=indexed_body)
+    return version
+
+
+def replace_body(document, expected_version, pieces, author_id=None):
+    """Compare-and-swap replacement of a body given as pieces of bytes.
+
+    Returns (new version, size in bytes). The new body is recorded as a
+    snapshot revision, nothing of the old one is kept in memory. The
+    caller commits.
+    """
+    previous_version = document.version
+    version = claim_version(document, expected_version)
+    revision_store.ensure_baseline(document.id, previous_version, document.document_name)
+    size = body_store.write(document.id, pieces)
+    revision_store.record(document.id, version, document.document_name, author_id=author_id)
+    search_index.update(document.id, body=search_index.stored_body(document.id))
+    return version, size
@@ -1,6 +1,6 @@
 """Sign-up & log-in forms."""
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, SelectField
+from wtforms import StringField, PasswordField, SubmitField, SelectField, HiddenField
 import email_validator
 from wtforms.validators import (
     DataRequired,
@@ -91,4 +91,6 @@ class DocumentForm(FlaskForm):
         allow_blank=True, 
         get_label='name'
     )
+    # document version the edit started from, see documentmanager.claim_version
+    version = HiddenField()
     submit = SubmitField('Submit')
\ No newline at end of file
@@ -0,0 +1,154 @@
+"""Identity needs resolution and per-process cache."""
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from flask_principal import UserNeed, RoleNeed
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from .models import User, Retention
+from .queries import identity_needs_query
+from .principalmanager import EditDocumentNeed
+
+
+class IdentityCache(object):
+    """Bounded LRU cache of user_id -> frozenset of flask_principal needs.
+
+    The cache lives in each worker process. Entries are dropped when the
+    Retention rows or the status of a user change, and also expire after
+    IDENTITY_CACHE_TTL seconds so that changes committed by another worker
+    are picked up.
+    """
+
+    def __init__(self, app=None):
+        self.maxsize = 1024
+        self.ttl = 60
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # size and ttl come from Config, 0 disables the cache entirely
+        self.maxsize = app.config.get('IDENTITY_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('IDENTITY_CACHE_TTL', self.ttl)
+        self.clear()
+
+    def get(self, user_id):
+        """Return the cached needs for user_id, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            needs, expires = entry
+            if expires < time.monotonic():
+                # expired, drop it and report a miss
+                del self._entries[user_id]
+                return None
+            # mark as most recently used
+            self._entries.move_to_end(user_id)
+            return needs
+
+    def set(self, user_id, needs):
+        """Store needs for user_id, evicting the least recently used entry."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (frozenset(needs), time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        """Drop the cached needs of the given users."""
+        with self._lock:
+            for user_id in user_ids:
+                if user_id is not None:
+                    self._entries.pop(int(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def load_identity_needs(user_id):
+    """Build every need for a user with a single query.
+
+    user_type, user_status and all document ids come back in one round
+    trip, see identity_needs_query.
+    """
+    rows = identity_needs_query(user_id).all()
+
+    # unknown user, nothing to provide
+    if not rows:
+        return frozenset()
+
+    user_type, user_status = rows[0].user_type, rows[0].user_status
+
+    needs = set()
+    # user id, user_type and user_status are provided as-is
+    needs.add(UserNeed(user_id))
+    needs.add(RoleNeed(user_type))
+    needs.add(RoleNeed(user_status))
+
+    # approved status role - pending and rejected goes to notapproved
+    if user_status == 'approved':
+        needs.add(RoleNeed('approved'))
+    elif user_status == 'pending' or user_status == 'rejected':
+        needs.add(RoleNeed('notapproved'))
+
+    # one EditDocumentNeed for each retained document
+    for row in rows:
+        if row.document_id is not None:
+            needs.add(EditDocumentNeed(str(row.document_id)))
+
+    return frozenset(needs)
+
+
+# ---------- cache invalidation ----------
+
+# key in session.info holding user ids to invalidate once the transaction commits,
+# paired with the cache, every registered cache collects and drops its own set
+_PENDING_KEY = 'identity_cache_pending'
+
+
+def _retention_user_ids(retention):
+    """User ids referenced by a Retention, including replaced values."""
+    user_ids = set()
+    for attribute in ('sponsor_id', 'editor_id'):
+        history = get_history(retention, attribute)
+        for value in list(history.added) + list(history.unchanged) + list(history.deleted):
+            if value is not None:
+                user_ids.add(value)
+    return user_ids
+
+
+def register_invalidation_hooks(cache):
+    """Invalidate cache entries when Retention rows or user status change."""
+    pending_key = (_PENDING_KEY, id(cache))
+
+    @event.listens_for(Session, 'after_flush')
+    def collect_changed_users(session, flush_context):
+        pending = session.info.setdefault(pending_key, set())
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Retention):
+                pending.update(_retention_user_ids(obj))
+            elif isinstance(obj, User):
+                if obj in session.deleted or get_history(obj, 'user_status').has_changes() \
+                        or get_history(obj, 'user_type').has_changes():
+                    pending.add(obj.id)
+
+    @event.listens_for(Session, 'after_commit')
+    def invalidate_changed_users(session):
+        pending = session.info.pop(pending_key, None)
+        if pending:
+            cache.invalidate(*pending)
+
+    @event.listens_for(Session, 'after_rollback')
+    def discard_changed_users(session):
+        session.info.pop(pending_key, None)
@@ -0,0 +1,79 @@
+"""EXPLAIN based check that hot queries are served by indexes."""
+import re
+
+from . import db
+from .models import User, Retention
+from .pagination import keyset_query
+from .queries import (
+    identity_needs_query,
+    sponsor_documents_query,
+    editor_documents_query,
+    users_section_query,
+    users_section_count_query,
+    document_retention_query,
+    editor_choices_query
+)
+
+# postgres plan node reading a whole table
+POSTGRES_FULL_SCAN = re.compile(r'Seq Scan on (\w+)')
+# sqlite plan step reading a whole table, SEARCH steps use an index
+SQLITE_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+
+def hot_queries():
+    """(name, query, tables that must not be fully scanned) for every hot query."""
+    return [
+        ('on_identity_loaded', identity_needs_query(1), ('users', 'retentions')),
+        ('documentlist_sponsor', keyset_query(sponsor_documents_query(1), Retention.id, after=1), ('users', 'retentions', 'documents')),
+        ('documentlist_editor', keyset_query(editor_documents_query(1), Retention.id, after=1), ('retentions', 'documents')),
+        ('usersview_admin', keyset_query(users_section_query('sponsor', 'pending'), User.id, after=1), ('users',)),
+        ('usersview_admin null status', keyset_query(users_section_query('editor', 'none'), User.id, after=1), ('users',)),
+        ('usersview_admin section total', users_section_count_query('sponsor', 'pending'), ('users',)),
+        ('documentedit_sponsor', document_retention_query(1), ('users', 'retentions')),
+        ('editor choices', editor_choices_query(), ('users',)),
+    ]
+
+
+def explain(query):
+    """Return the plan of query as a list of lines."""
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+
+    with db.engine.connect() as conn:
+        if db.engine.dialect.name == 'postgresql':
+            # tiny tables are cheaper to read sequentially, make the planner
+            # use an index whenever one can serve the query
+            conn.execute('SET enable_seqscan = off')
+            rows = conn.execute('EXPLAIN ' + str(compiled), params)
+            return [row[0] for row in rows]
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+        # (id, parent, notused, detail)
+        return [row[-1] for row in rows]
+
+
+def full_scans(plan):
+    """Tables read in full by a plan."""
+    pattern = POSTGRES_FULL_SCAN if db.engine.dialect.name == 'postgresql' else SQLITE_FULL_SCAN
+    tables = set()
+    for line in plan:
+        match = pattern.search(line.strip())
+        if match:
+            tables.add(match.group(1))
+    return tables
+
+
+def check_indexes(echo=print):
+    """Explain every hot query, return the names of those doing full scans."""
+    failures = []
+    for name, query, tables in hot_queries():
+        plan = explain(query)
+        scanned = full_scans(plan) & set(tables)
+        echo('%s: %s' % (name, 'FULL SCAN of ' + ', '.join(sorted(scanned)) if scanned else 'ok'))
+        for line in plan:
+            echo('    ' + line)
+        if scanned:
+            failures.append(name)
+    return failures
@@ -0,0 +1,272 @@
+"""Background jobs, queued in the jobs table and run by manage.py worker."""
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import threading
+import traceback
+
+from . import db
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FAILED = 'failed'
+
+# characters of a traceback kept in last_error
+MAX_ERROR_LENGTH = 4000
+
+
+class UnknownJob(Exception):
+    """No handler is registered under the job's name, it fails without a retry."""
+
+
+class ClaimedJob(object):
+    """A job claimed by a worker, with the attempt number it was claimed at."""
+
+    def __init__(self, id, name, payload, attempts, max_attempts):
+        self.id = id
+        self.name = name
+        self.payload = json.loads(payload)
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+
+
+class JobQueue(object):
+    """Jobs kept in a database table, claimed with SELECT ... FOR UPDATE SKIP LOCKED.
+
+    enqueue() inserts a row in the caller's transaction, so a job exists
+    exactly when the request's own changes are committed. Workers claim
+    due jobs on postgresql with an UPDATE over a SKIP LOCKED select,
+    concurrent workers never wait on, or get, each other's rows. Elsewhere
+    a claim is a compare-and-swap UPDATE on the row as it was read. A
+    claimed job is leased for JOB_LEASE_SECONDS, a worker that dies with
+    it leaves it to be claimed again once the lease runs out.
+
+    A job that raises is retried JOB_MAX_ATTEMPTS times in all, after
+    JOB_RETRY_BACKOFF seconds doubled on every attempt up to
+    JOB_RETRY_BACKOFF_MAX, with jitter, then kept as failed. A job that
+    succeeds is deleted in the same transaction as its handler's writes.
+    Jobs run at least once, a handler may run again after a lost lease, so
+    handlers are written to be safe to repeat.
+    """
+
+    def __init__(self, app=None):
+        self.handlers = {}
+        self.max_attempts = 5
+        self.backoff = 10.0
+        self.backoff_max = 3600.0
+        self.lease = 300
+        self.concurrency = 2
+        self.poll_interval = 1.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff = app.config.get('JOB_RETRY_BACKOFF', self.backoff)
+        self.backoff_max = app.config.get('JOB_RETRY_BACKOFF_MAX', self.backoff_max)
+        self.lease = app.config.get('JOB_LEASE_SECONDS', self.lease)
+        self.concurrency = app.config.get('JOB_WORKER_CONCURRENCY', self.concurrency)
+        self.poll_interval = app.config.get('JOB_POLL_INTERVAL', self.poll_interval)
+
+    def handler(self, name):
+        """Register the decorated function as the handler of jobs named name."""
+        def register(function):
+            self.handlers[name] = function
+            return function
+        return register
+
+    # ---------- queueing ----------
+
+    def enqueue(self, name, payload=None, delay=0, max_attempts=None, unique=False):
+        """Queue a job in the current transaction, the caller commits.
+
+        payload is a dict of JSON values, passed to the handler as keyword
+        arguments. With unique, nothing is queued when a job with the same
+        name and payload is still waiting to run. Returns the id of the
+        job, None when unique found one already queued.
+        """
+        payload = json.dumps(payload or {}, sort_keys=True)
+        jobs = Job.__table__
+        if unique:
+            waiting = db.session.query(Job.id).filter(Job.status == QUEUED).\
+                filter(Job.name == name).filter(Job.payload == payload).first()
+            if waiting is not None:
+                return None
+        now = datetime.utcnow()
+        result = db.session.execute(jobs.insert().values(
+            name=name,
+            payload=payload,
+            status=QUEUED,
+            run_at=now + timedelta(seconds=delay),
+            attempts=0,
+            max_attempts=max_attempts or self.max_attempts,
+            created_on=now
+        ))
+        return result.inserted_primary_key[0]
+
+    # ---------- claiming and running ----------
+
+    def claim(self, worker_id, limit=1):
+        """Claim up to limit due jobs for worker_id and commit, returns ClaimedJobs.
+
+        Due jobs are queued ones whose run_at has passed and running ones
+        whose lease has run out.
+        """
+        jobs = Job.__table__
+        now = datetime.utcnow()
+        due = db.and_(jobs.c.status.in_([QUEUED, RUNNING]), jobs.c.run_at <= now)
+        claimed = {
+            'status': RUNNING,
+            'run_at': now + timedelta(seconds=self.lease),
+            'attempts': jobs.c.attempts + 1,
+            'locked_by': worker_id
+        }
+        columns = (jobs.c.id, jobs.c.name, jobs.c.payload, jobs.c.attempts, jobs.c.max_attempts)
+
+        if db.engine.dialect.name == 'postgresql':
+            # rows locked by another worker's claim are skipped, not waited for
+            candidates = db.select([jobs.c.id]).where(due).order_by(jobs.c.run_at, jobs.c.id).\
+                limit(limit).with_for_update(skip_locked=True)
+            rows = db.session.execute(
+                jobs.update().where(jobs.c.id.in_(candidates)).values(**claimed).returning(*columns)
+            ).fetchall()
+        else:
+            rows = []
+            candidates = db.session.execute(
+                db.select([jobs.c.id, jobs.c.status, jobs.c.run_at, jobs.c.attempts]).where(due).
+                order_by(jobs.c.run_at, jobs.c.id).limit(limit)
+            ).fetchall()
+            for candidate in candidates:
+                # only claimed when no other worker changed the row since it was read
+                result = db.session.execute(
+                    jobs.update().where(jobs.c.id == candidate.id).
+                    where(jobs.c.status == candidate.status).
+                    where(jobs.c.run_at == candidate.run_at).
+                    where(jobs.c.attempts == candidate.attempts).values(**claimed)
+                )
+                if result.rowcount == 1:
+                    rows.extend(db.session.execute(db.select(columns).where(jobs.c.id == candidate.id)).fetchall())
+        db.session.commit()
+        return [ClaimedJob(*row) for row in rows]
+
+    def run(self, job):
+        """Run a claimed job, then delete it, or schedule its retry, or mark it failed.
+
+        Returns True when the handler succeeded.
+        """
+        jobs = Job.__table__
+        # statements on the job only touch it while this worker's claim holds
+        mine = db.and_(jobs.c.id == job.id, jobs.c.attempts == job.attempts, jobs.c.status == RUNNING)
+        try:
+            if job.attempts > job.max_attempts:
+                # claimed again after the worker of the last attempt died with it
+                raise RuntimeError('lease of the last attempt ran out')
+            handler = self.handlers.get(job.name)
+            if handler is None:
+                raise UnknownJob('no handler for job %r' % job.name)
+            handler(**job.payload)
+            db.session.execute(jobs.delete().where(mine))
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            final = isinstance(error, UnknownJob) or job.attempts >= job.max_attempts
+            values = {'last_error': traceback.format_exc()[-MAX_ERROR_LENGTH:]}
+            if final:
+                values.update(status=FAILED)
+            else:
+                values.update(status=QUEUED, run_at=datetime.utcnow() + timedelta(seconds=self.retry_delay(job.attempts)))
+            db.session.execute(jobs.update().where(mine).values(**values))
+            db.session.commit()
+            logger.warning('job failed', exc_info=True, extra={
+                'job_id': job.id, 'job': job.name, 'attempts': job.attempts, 'final': final})
+            return False
+        logger.info('job done', extra={'job_id': job.id, 'job': job.name, 'attempts': job.attempts})
+        return True
+
+    def retry_delay(self, attempts):
+        """Seconds before the retry following attempt number attempts, with up to 25% jitter."""
+        delay = min(self.backoff * (2 ** (attempts - 1)), self.backoff_max)
+        return delay * random.uniform(0.75, 1.0)
+
+    def run_pending(self, worker_id='inline', limit=100):
+        """Claim and run due jobs until none is left or limit have run, returns the number run."""
+        count = 0
+        while count < limit:
+            claimed = self.claim(worker_id)
+            if not claimed:
+                break
+            for job in claimed:
+                self.run(job)
+                count += 1
+        return count
+
+    # ---------- bookkeeping ----------
+
+    def counts(self):
+        """{status: jobs} over the whole table, one grouped query."""
+        return dict(db.session.query(Job.status, db.func.count()).group_by(Job.status).all())
+
+    def retry_failed(self):
+        """Queue every failed job again with a fresh set of attempts, returns how many."""
+        jobs = Job.__table__
+        result = db.session.execute(jobs.update().where(jobs.c.status == FAILED).values(
+            status=QUEUED, run_at=datetime.utcnow(), attempts=0
+        ))
+        db.session.commit()
+        return result.rowcount
+
+
+class Worker(object):
+    """Runs jobs of a queue in concurrency threads until stopped.
+
+    Each thread claims one job at a time in its own app context and
+    session. Idle threads poll every poll_interval seconds. SIGTERM and
+    SIGINT let every thread finish the job it is running, then stop.
+    """
+
+    def __init__(self, app, queue, concurrency=None, poll_interval=None):
+        self.app = app
+        self.queue = queue
+        self.concurrency = concurrency or queue.concurrency
+        self.poll_interval = poll_interval if poll_interval is not None else queue.poll_interval
+        self.stopping = threading.Event()
+        self.name = '%s:%d' % (socket.gethostname(), os.getpid())
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def loop(self, number):
+        worker_id = '%s:%d' % (self.name, number)
+        while not self.stopping.is_set():
+            try:
+                with self.app.app_context():
+                    claimed = self.queue.claim(worker_id)
+                    for job in claimed:
+                        self.queue.run(job)
+            except Exception:
+                # a lost database connection, for example, the next poll tries again
+                logger.exception('job worker error', extra={'worker': worker_id})
+                claimed = []
+            if not claimed:
+                self.stopping.wait(self.poll_interval)
+
+    def run(self, install_signals=True):
+        if install_signals:
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        logger.info('job worker started', extra={'worker': self.name, 'concurrency': self.concurrency})
+        threads = [threading.Thread(target=self.loop, args=(number,), daemon=True) for number in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        # joined with a timeout, so the main thread stays free to take signals
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(0.5)
+        logger.info('job worker stopped', extra={'worker': self.name})
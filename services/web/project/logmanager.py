@@ -0,0 +1,142 @@
+"""Structured, sampled, queue-backed logging for the project package."""
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+
+# attributes every LogRecord has, anything else was passed through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any extra= fields at the top level."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of records below WARNING, warnings and errors always pass."""
+
+    def __init__(self, rate):
+        super(SamplingFilter, self).__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the request, records are dropped when the queue is full."""
+
+    def __init__(self, log_queue):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatting runs on the writer thread, only freeze the message here
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogManager(object):
+    """Routes records of the project loggers through a queue to a background writer.
+
+    Request handlers only pay for building the record and a non-blocking
+    queue put, formatting and the write to stderr happen on the listener
+    thread.
+    """
+
+    def __init__(self, app=None):
+        self.handler = None
+        self.listener = None
+        self._hooks_registered = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        logger = logging.getLogger(app.import_name)
+        # records stop here, no duplicates through the root logger
+        logger.propagate = False
+        # a repeated init_app replaces the writer thread of the last one
+        self.stop()
+        self.handler = None
+
+        if not app.config.get('LOG_ENABLED', True):
+            # every logging call returns at the level check
+            logger.handlers = []
+            logger.setLevel(logging.CRITICAL + 1)
+            return
+
+        logger.setLevel(app.config.get('LOG_LEVEL', 'INFO'))
+        # per-logger levels, LOG_LEVELS="project.auth=DEBUG,project.routes=WARNING"
+        for name, level in parse_levels(app.config.get('LOG_LEVELS', '')):
+            logging.getLogger(name).setLevel(level)
+
+        self.handler = DroppingQueueHandler(queue.Queue(app.config.get('LOG_QUEUE_SIZE', 10000)))
+        self.handler.addFilter(SamplingFilter(app.config.get('LOG_SAMPLE_RATE', 1.0)))
+        logger.handlers = [self.handler]
+
+        self.writer = logging.StreamHandler(sys.stderr)
+        self.writer.setFormatter(JsonFormatter())
+        self.start()
+
+        # flush what is queued on shutdown, restart the writer thread in forked workers,
+        # both hooks call whatever the latest init_app set up
+        if not self._hooks_registered:
+            atexit.register(self.stop)
+            if hasattr(os, 'register_at_fork'):
+                os.register_at_fork(after_in_child=self.start)
+            self._hooks_registered = True
+
+    def start(self):
+        """Start a fresh writer thread on the queue, nothing when logging is off."""
+        if self.handler is None:
+            self.listener = None
+            return
+        self.listener = QueueListener(self.handler.queue, self.writer, respect_handler_level=False)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    @property
+    def dropped(self):
+        return self.handler.dropped if self.handler is not None else 0
+
+
+def parse_levels(spec):
+    """Pairs of (logger name, level) from "name=LEVEL,name=LEVEL"."""
+    levels = []
+    for item in spec.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels.append((name.strip(), level.strip().upper()))
+    return levels
+
@@ -0,0 +1,239 @@
+"""Per-request query count and latency instrumentation."""
+from threading import Lock
+import hmac
+import ipaddress
+import time
+
+from flask import Response, abort, current_app, g, has_request_context, request
+from flask import request_started, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# request latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# statements per request histogram buckets, a growing count is an N+1 loop
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram(object):
+    """Cumulative bucket counts, sum and count, as Prometheus expects."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class EndpointStats(object):
+    """Totals for one endpoint."""
+
+    def __init__(self):
+        self.responses = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+
+
+class RequestTimings(object):
+    """Measurements of the request being served, kept on flask.g."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.render_start = None
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+def _current_timings():
+    if has_request_context():
+        return g.get('_request_timings')
+    return None
+
+
+# ---------- sqlalchemy engine events ----------
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _current_timings()
+    if timings is not None:
+        timings.queries += 1
+        timings.db_seconds += time.perf_counter() - context._metrics_query_start
+
+
+# ---------- flask template signals ----------
+
+def _before_render_template(sender, template, context, **extra):
+    timings = _current_timings()
+    if timings is not None:
+        timings.render_start = time.perf_counter()
+
+
+def _template_rendered(sender, template, context, **extra):
+    timings = _current_timings()
+    if timings is not None and timings.render_start is not None:
+        timings.render_seconds += time.perf_counter() - timings.render_start
+        timings.render_start = None
+
+
+class RequestMetrics(object):
+    """Records query count, DB time, render time and latency per endpoint.
+
+    Totals are per worker process and served in the Prometheus text format
+    on METRICS_PATH, to clients in METRICS_ALLOWED_NETWORKS or sending
+    METRICS_TOKEN as a bearer token, anyone else gets a 403. With SERVER_TIMING on, each response also carries a
+    Server-Timing header with its own db, render and total times.
+    """
+
+    def __init__(self, app=None):
+        self._lock = Lock()
+        self._endpoints = {}
+        # callables returning more exposition lines, e.g. the rate limiter's counters
+        self._collectors = []
+        self.token = ''
+        self.allowed_networks = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('METRICS_ENABLED', True):
+            return
+        self.token = app.config.get('METRICS_TOKEN', '')
+        self.allowed_networks = parse_networks(app.config.get('METRICS_ALLOWED_NETWORKS', '127.0.0.1/32,::1/128'))
+
+        # every engine, whenever it is created
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        before_render_template.connect(_before_render_template, app)
+        template_rendered.connect(_template_rendered, app)
+
+        # request_started fires ahead of every before_request function,
+        # so identity and user loading queries are counted too
+        request_started.connect(self._start_request, app)
+        app.after_request(self._finish_request)
+        app.add_url_rule(app.config.get('METRICS_PATH', '/metrics'), 'metrics', self.metrics_view)
+
+    def add_collector(self, collector):
+        """Serve the lines collector() returns after the request metrics."""
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def _start_request(self, sender, **extra):
+        g._request_timings = RequestTimings()
+
+    def _finish_request(self, response):
+        timings = g.get('_request_timings')
+        endpoint = request.endpoint
+        # the metrics endpoint and static files are not measured
+        if timings is None or endpoint is None or endpoint == 'metrics' or endpoint.split('.')[-1] == 'static':
+            return response
+
+        if current_app.config.get('SERVER_TIMING'):
+            # streamed bodies are still to be rendered, their header covers what ran so far
+            response.headers['Server-Timing'] = 'db;dur=%.3f;desc="%d queries", render;dur=%.3f, total;dur=%.3f' % (
+                timings.db_seconds * 1000, timings.queries, timings.render_seconds * 1000, timings.elapsed * 1000)
+
+        method, status = request.method, response.status_code
+        # recorded once the body has been sent, so streamed rendering is included
+        response.call_on_close(lambda: self.record(endpoint, method, status, timings))
+        return response
+
+    def record(self, endpoint, method, status, timings):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = EndpointStats()
+            key = (method, status)
+            stats.responses[key] = stats.responses.get(key, 0) + 1
+            stats.latency.observe(timings.elapsed)
+            stats.queries.observe(timings.queries)
+            stats.db_seconds += timings.db_seconds
+            stats.render_seconds += timings.render_seconds
+
+    def render(self):
+        """All totals in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+
+            lines.append('# HELP app_http_requests_total Responses sent, by endpoint, method and status.')
+            lines.append('# TYPE app_http_requests_total counter')
+            for endpoint, stats in endpoints:
+                for (method, status), count in sorted(stats.responses.items()):
+                    lines.append('app_http_requests_total{endpoint="%s",method="%s",status="%d"} %d' % (
+                        endpoint, method, status, count))
+
+            _histogram_lines(lines, 'app_http_request_duration_seconds',
+                'Request latency including streamed bodies.',
+                [(endpoint, stats.latency) for endpoint, stats in endpoints])
+            _histogram_lines(lines, 'app_db_queries_per_request',
+                'SQL statements executed per request.',
+                [(endpoint, stats.queries) for endpoint, stats in endpoints])
+
+            lines.append('# HELP app_db_duration_seconds_total Time spent executing SQL statements.')
+            lines.append('# TYPE app_db_duration_seconds_total counter')
+            for endpoint, stats in endpoints:
+                lines.append('app_db_duration_seconds_total{endpoint="%s"} %.6f' % (endpoint, stats.db_seconds))
+
+            lines.append('# HELP app_template_render_seconds_total Time spent rendering templates.')
+            lines.append('# TYPE app_template_render_seconds_total counter')
+            for endpoint, stats in endpoints:
+                lines.append('app_template_render_seconds_total{endpoint="%s"} %.6f' % (endpoint, stats.render_seconds))
+
+        for collector in self._collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+    def allowed(self, request):
+        """Whether request may read the metrics, by bearer token or client address."""
+        if self.token:
+            scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+            if scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip().encode('utf-8'), self.token.encode('utf-8')):
+                return True
+        try:
+            address = ipaddress.ip_address(request.remote_addr or '')
+        except ValueError:
+            return False
+        return any(address in network for network in self.allowed_networks)
+
+    def metrics_view(self):
+        if not self.allowed(request):
+            abort(403)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+def parse_networks(spec):
+    """ip_network objects of a comma separated list of addresses and networks."""
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in spec.split(',') if item.strip()]
+
+
+def _histogram_lines(lines, name, help_text, histograms):
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s histogram' % name)
+    for endpoint, histogram in histograms:
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (name, endpoint, bound, count))
+        lines.append('%s_bucket{endpoint="%s",le="+Inf"} %d' % (name, endpoint, histogram.count))
+        lines.append('%s_sum{endpoint="%s"} %.6f' % (name, endpoint, histogram.sum))
+        lines.append('%s_count{endpoint="%s"} %d' % (name, endpoint, histogram.count))
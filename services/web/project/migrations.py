@@ -0,0 +1,207 @@
+"""Versioned schema migrations, run with manage.py upgrade."""
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, inspect, text
+
+from . import db, body_store, search_index
+from .models import User, Retention, DocumentBodyChunk, DocumentRevision, DocumentSearch, DocumentSearchTerm, UserStat, Job
+from .userstats import rebuild_user_stats
+
+# applied versions are recorded in their own table, outside db.Model metadata
+migration_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', migration_metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(100), nullable=False),
+    Column('applied_on', DateTime, nullable=False)
+)
+
+Migration = namedtuple('Migration', ['version', 'name', 'upgrade'])
+
+
+def _autocommit_execute(statement):
+    """Run a statement outside a transaction, needed by CREATE INDEX CONCURRENTLY."""
+    with db.engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute(text(statement))
+
+
+def _create_index(index):
+    """Create a model Index if it is missing, without locking out writes on postgres."""
+    columns = ', '.join(column.name for column in index.columns)
+    if db.engine.dialect.name == 'postgresql':
+        # build the index without blocking inserts and updates on large tables
+        _autocommit_execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s (%s)' % (
+            index.name, index.table.name, columns))
+    else:
+        _autocommit_execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+            index.name, index.table.name, columns))
+
+
+# ---------- migrations, in order ----------
+
+def create_tables():
+    """Baseline schema, creates any missing table."""
+    db.create_all()
+
+
+def retention_primary_key():
+    """Make retentions.id the only primary key column.
+
+    retentions was created with a composite (id, sponsor_id, document_id)
+    primary key. id is unique on its own, and the composite key is useless
+    for lookups by sponsor or document.
+    """
+    primary_key = inspect(db.engine).get_pk_constraint('retentions')
+    if primary_key['constrained_columns'] == ['id']:
+        return
+    if db.engine.dialect.name != 'postgresql':
+        raise RuntimeError('retentions primary key can only be migrated on postgresql')
+    # one transaction, the table is never left without a primary key
+    with db.engine.begin() as conn:
+        conn.execute(text('ALTER TABLE retentions DROP CONSTRAINT %s' % primary_key['name']))
+        conn.execute(text('ALTER TABLE retentions ADD PRIMARY KEY (id)'))
+        conn.execute(text('ALTER TABLE retentions ALTER COLUMN sponsor_id DROP NOT NULL'))
+        conn.execute(text('ALTER TABLE retentions ALTER COLUMN document_id DROP NOT NULL'))
+
+
+def hot_column_indexes():
+    """Indexes on the columns filtered and joined by permission loads and list views."""
+    for model in (User, Retention):
+        for index in model.__table__.indexes:
+            _create_index(index)
+
+
+def document_body_chunks(batch_size=1000):
+    """Move document bodies out of documents.document_body into document_body_chunks.
+
+    Bodies are copied in batches of documents, keyed on id. The old column
+    is dropped on postgresql, elsewhere it is left in place, unused.
+    """
+    DocumentBodyChunk.__table__.create(db.engine, checkfirst=True)
+    if 'document_body' not in [column['name'] for column in inspect(db.engine).get_columns('documents')]:
+        return
+    # chunks left by an interrupted run are copied again
+    db.session.execute(DocumentBodyChunk.__table__.delete())
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            text('SELECT id, document_body FROM documents WHERE id > :last_id ORDER BY id LIMIT :limit'),
+            {'last_id': last_id, 'limit': batch_size}
+        ).fetchall()
+        if not rows:
+            break
+        body_store.insert_many([(row.id, row.document_body) for row in rows])
+        db.session.commit()
+        last_id = rows[-1].id
+    # the delete is still open when there was nothing to copy, it would block the ALTER
+    db.session.commit()
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE documents DROP COLUMN document_body'))
+
+
+def document_version():
+    """Add documents.version, the compare-and-swap token of document saves."""
+    if 'version' in [column['name'] for column in inspect(db.engine).get_columns('documents')]:
+        return
+    # a constant default fills existing rows without rewriting the table on postgres 11+
+    _autocommit_execute('ALTER TABLE documents ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+
+def document_revisions():
+    """Create document_revisions, existing documents get a baseline snapshot on their next save."""
+    DocumentRevision.__table__.create(db.engine, checkfirst=True)
+
+
+def document_search(batch_size=200):
+    """Create the search index tables and index every document, in batches keyed on id."""
+    DocumentSearch.__table__.create(db.engine, checkfirst=True)
+    DocumentSearchTerm.__table__.create(db.engine, checkfirst=True)
+    # documents indexed by an interrupted run are indexed again
+    db.session.execute(DocumentSearch.__table__.delete())
+    db.session.execute(DocumentSearchTerm.__table__.delete())
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            text('SELECT id, document_name FROM documents WHERE id > :last_id ORDER BY id LIMIT :limit'),
+            {'last_id': last_id, 'limit': batch_size}
+        ).fetchall()
+        if not rows:
+            break
+        search_index.update_many([(row.id, row.document_name, search_index.stored_body(row.id)) for row in rows])
+        db.session.commit()
+        last_id = rows[-1].id
+    # the deletes are still open when there was nothing to index
+    db.session.commit()
+
+
+def user_stats():
+    """Create user_stats and count every user."""
+    UserStat.__table__.create(db.engine, checkfirst=True)
+    rebuild_user_stats()
+    db.session.commit()
+
+
+def jobs():
+    """Create the jobs table of the background job queue."""
+    Job.__table__.create(db.engine, checkfirst=True)
+
+
+MIGRATIONS = (
+    Migration(1, 'create_tables', create_tables),
+    Migration(2, 'retention_primary_key', retention_primary_key),
+    Migration(3, 'hot_column_indexes', hot_column_indexes),
+    Migration(4, 'document_body_chunks', document_body_chunks),
+    Migration(5, 'document_version', document_version),
+    Migration(6, 'document_revisions', document_revisions),
+    Migration(7, 'document_search', document_search),
+    Migration(8, 'user_stats', user_stats),
+    Migration(9, 'jobs', jobs),
+)
+
+
+# ---------- runner ----------
+
+def applied_versions():
+    """Set of versions already applied to the database."""
+    migration_metadata.create_all(db.engine, checkfirst=True)
+    with db.engine.connect() as conn:
+        return set(row.version for row in conn.execute(schema_migrations.select()))
+
+
+def _record(conn, migration):
+    conn.execute(schema_migrations.insert().values(
+        version=migration.version,
+        name=migration.name,
+        applied_on=datetime.utcnow()
+    ))
+
+
+def upgrade(echo=print):
+    """Apply every pending migration in order, return the versions applied."""
+    applied = applied_versions()
+    done = []
+    for migration in MIGRATIONS:
+        if migration.version in applied:
+            continue
+        echo('applying %d %s' % (migration.version, migration.name))
+        migration.upgrade()
+        with db.engine.begin() as conn:
+            _record(conn, migration)
+        done.append(migration.version)
+    return done
+
+
+def stamp():
+    """Mark every migration as applied, used after creating a fresh schema."""
+    migration_metadata.create_all(db.engine, checkfirst=True)
+    with db.engine.begin() as conn:
+        conn.execute(schema_migrations.delete())
+        for migration in MIGRATIONS:
+            _record(conn, migration)
+
+
+def current_version():
+    applied = applied_versions()
+    return max(applied) if applied else 0
@@ -1,14 +1,14 @@
 """Database models."""
-from . import db
+from . import db, password_hasher
 from flask_login import UserMixin, _compat
 from flask_login._compat import text_type
-from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import relationship
 from sqlalchemy import Integer, ForeignKey, String, Column
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.postgresql import TSVECTOR
 
 
 """User Object"""
@@ -16,6 +16,10 @@ class User(db.Model):
     """User account model."""
 
     __tablename__ = 'users'
+    # user lists and editor choices filter on type and status, paged by id
+    __table_args__ = (
+        db.Index('ix_users_user_type_user_status_id', 'user_type', 'user_status', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -94,14 +98,17 @@ class User(db.Model):
     """Password Check Functions"""
     def set_password(self, password):
         """Create hashed password."""
-        self.password = generate_password_hash(
-            password,
-            method='sha256'
-        )
+        # scheme and cost come from PASSWORD_HASH_METHOD and PASSWORD_HASH_COST
+        self.password = password_hasher.hash(password)
 
     def check_password(self, password):
         """Check hashed password."""
-        return check_password_hash(self.password, password)
+        # runs in the hashing pool, raises HasherBusy when it is full
+        ok, new_hash = password_hasher.check(self.password, password)
+        if new_hash is not None:
+            # outdated scheme or cost, upgraded in place, the caller commits
+            self.password = new_hash
+        return ok
 
 """Document Object"""
 class Document(db.Model):
@@ -118,17 +125,24 @@ class Document(db.Model):
         unique=False,
         nullable=True
     )
-    document_body = db.Column(
-        db.String(1000),
-        unique=False,
-        nullable=True
-    )
     created_on = db.Column(
         db.DateTime,
         index=False,
         unique=False,
         nullable=True
     )
+    # bumped by every save, updates only apply to the version they were made on
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1'
+    )
+    # UPDATEs carry "WHERE version = <loaded version>", the new version is set by the caller
+    __mapper_args__ = {
+        'version_id_col': version,
+        'version_id_generator': False
+    }
     """backreferences User class on retentions table"""
     users = relationship(
         'Retention',
@@ -136,11 +150,245 @@ class Document(db.Model):
         )
 
 
+"""Document Body Chunks - bodies are stored, read and written chunk by chunk"""
+class DocumentBodyChunk(db.Model):
+    """Model for one piece of a document body, see bodystore.py"""
+    __tablename__ = 'document_body_chunks'
+
+    document_id = db.Column(
+        db.Integer,
+        db.ForeignKey('documents.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+    # position of the chunk in the body, from 0
+    seq = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False
+    )
+    # bytes of body text in the chunk, before compression
+    size = db.Column(
+        db.Integer,
+        nullable=False
+    )
+    compressed = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False
+    )
+    data = db.Column(
+        db.LargeBinary,
+        nullable=False
+    )
+
+
+"""Document Revisions - one row per save, see revisions.py"""
+class DocumentRevision(db.Model):
+    """Model for a saved version of a document, a full snapshot or a delta"""
+    __tablename__ = 'document_revisions'
+    # revisions are looked up and listed by document and version
+    __table_args__ = (
+        db.Index('ix_document_revisions_document_id_version', 'document_id', 'version', unique=True),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+    document_id = db.Column(
+        db.Integer,
+        db.ForeignKey('documents.id', ondelete='CASCADE'),
+        nullable=False
+    )
+    # documents.version right after the save
+    version = db.Column(
+        db.Integer,
+        nullable=False
+    )
+    # 'snapshot' holds the whole body, 'delta' the changes from the previous version
+    kind = db.Column(
+        db.String(10),
+        nullable=False
+    )
+    document_name = db.Column(
+        db.String(100),
+        nullable=True
+    )
+    # characters in the body of this version
+    length = db.Column(
+        db.Integer,
+        nullable=False
+    )
+    author_id = db.Column(
+        db.Integer,
+        nullable=True
+    )
+    created_on = db.Column(
+        db.DateTime,
+        nullable=False
+    )
+    # zlib compressed body or encoded delta
+    data = db.Column(
+        db.LargeBinary,
+        nullable=False
+    )
+
+
+"""Document Search - full-text index of names and bodies, see search.py"""
+class DocumentSearch(db.Model):
+    """Model for the tsvector of a document, used on postgresql"""
+    __tablename__ = 'document_search'
+    # matched with @@ through a GIN index
+    __table_args__ = (
+        db.Index('ix_document_search_search_vector', 'search_vector', postgresql_using='gin'),
+    )
+
+    document_id = db.Column(
+        db.Integer,
+        db.ForeignKey('documents.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+    # name lexemes carry weight A, body lexemes weight B
+    search_vector = db.Column(
+        db.Text().with_variant(TSVECTOR(), 'postgresql'),
+        nullable=False
+    )
+
+
+class DocumentSearchTerm(db.Model):
+    """Model for one term of a document, the inverted index used without postgresql"""
+    __tablename__ = 'document_search_terms'
+    # documents are re-indexed by document and field
+    __table_args__ = (
+        db.Index('ix_document_search_terms_document_id_field', 'document_id', 'field'),
+    )
+
+    term = db.Column(
+        db.String(64),
+        primary_key=True
+    )
+    document_id = db.Column(
+        db.Integer,
+        db.ForeignKey('documents.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+    # 'n' for the document name, 'b' for the body
+    field = db.Column(
+        db.String(1),
+        primary_key=True
+    )
+    # occurrences of the term in the field
+    count = db.Column(
+        db.Integer,
+        nullable=False
+    )
+
+
+"""User Stats - dashboard counters, see userstats.py"""
+class UserStat(db.Model):
+    """Model for the dashboard counters of one user, kept up to date on every write"""
+    __tablename__ = 'user_stats'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+        autoincrement=False
+    )
+    # retentions of documents with the user as sponsor
+    documents_owned = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+    # retentions of documents with the user as editor
+    documents_assigned = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+    # users waiting for approval, only counted for admins
+    pending_approvals = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+
+"""Jobs - background work queued by requests, see jobs.py"""
+class Job(db.Model):
+    """Model for one queued job, deleted once it has run"""
+    __tablename__ = 'jobs'
+    # workers claim the oldest due jobs of a status
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+    # name of the registered handler
+    name = db.Column(
+        db.String(100),
+        nullable=False
+    )
+    # JSON keyword arguments of the handler
+    payload = db.Column(
+        db.Text,
+        nullable=False
+    )
+    # 'queued', 'running' or 'failed', jobs that succeed are deleted
+    status = db.Column(
+        db.String(10),
+        nullable=False
+    )
+    # queued, when the job is due, running, when its lease runs out
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False
+    )
+    # runs started so far, including the current one
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False
+    )
+    created_on = db.Column(
+        db.DateTime,
+        nullable=False
+    )
+    # worker running the job, host:pid:thread
+    locked_by = db.Column(
+        db.String(100),
+        nullable=True
+    )
+    last_error = db.Column(
+        db.Text,
+        nullable=True
+    )
+
+
 """Association Object - User Retentions of Documents"""
 class Retention(db.Model):
     """Model for who retains which document"""
     """Associate database."""
     __tablename__ = 'retentions'
+    # permission loads and document lists filter on sponsor or editor, paged by id
+    # document edits look up the retention of a document
+    __table_args__ = (
+        db.Index('ix_retentions_sponsor_id_id', 'sponsor_id', 'id'),
+        db.Index('ix_retentions_editor_id_id', 'editor_id', 'id'),
+        db.Index('ix_retentions_document_id', 'document_id'),
+    )
 
     id = db.Column(
         db.Integer, 
@@ -151,7 +399,6 @@ class Retention(db.Model):
     sponsor_id = db.Column(
         db.Integer, 
         db.ForeignKey('users.id'),
-        primary_key=True,
         unique=False,
         nullable=True
     )
@@ -165,7 +412,6 @@ class Retention(db.Model):
     document_id = db.Column(
         db.Integer, 
         db.ForeignKey('documents.id'),
-        primary_key=True,
         unique=False,
         nullable=True
     )
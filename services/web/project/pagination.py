@@ -0,0 +1,86 @@
+"""Keyset pagination for list views."""
+from flask import current_app, request
+
+
+class KeysetPage(object):
+    """One page of rows ordered by an integer key.
+
+    next_cursor and prev_cursor are the keys passed back as ?after= and
+    ?before= to move forward or backward, None when there is no such page.
+    """
+
+    def __init__(self, items, key_name, per_page, has_next, has_prev):
+        self.items = items
+        self.key_name = key_name
+        self.per_page = per_page
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.items:
+            return getattr(self.items[-1], self.key_name)
+        return None
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.items:
+            return getattr(self.items[0], self.key_name)
+        return None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def page_args():
+    """Read after, before and per_page from the request query string.
+
+    per_page falls back to LIST_PAGE_SIZE and is capped at LIST_MAX_PAGE_SIZE.
+    """
+    per_page = request.args.get('per_page', type=int) or current_app.config.get('LIST_PAGE_SIZE', 50)
+    per_page = max(1, min(per_page, current_app.config.get('LIST_MAX_PAGE_SIZE', 500)))
+    return {
+        'after': request.args.get('after', type=int),
+        'before': request.args.get('before', type=int),
+        'per_page': per_page
+    }
+
+
+def keyset_query(query, column, after=None, before=None, per_page=50):
+    """query limited to the rows after or before a key, plus one.
+
+    Rows come back ascending by column, or descending when paging back
+    from before. The extra row tells whether another page follows.
+    """
+    # drop any ordering of the list query, the page is ordered by the key
+    query = query.order_by(None)
+    if before is not None:
+        return query.filter(column < before).order_by(column.desc()).limit(per_page + 1)
+    if after is not None:
+        query = query.filter(column > after)
+    return query.order_by(column).limit(per_page + 1)
+
+
+def paginate_keyset(query, column, key_name, after=None, before=None, per_page=50):
+    """Return the KeysetPage of query after or before a key.
+
+    column is the indexed column to seek on, key_name the attribute holding
+    its value on each row. A page costs a single LIMIT query whatever its
+    depth.
+    """
+    rows = keyset_query(query, column, after, before, per_page).all()
+
+    if before is not None:
+        # walked backwards from the cursor, restore ascending order
+        has_prev = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_next = True
+    else:
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev = after is not None
+
+    return KeysetPage(items, key_name, per_page, has_next, has_prev)
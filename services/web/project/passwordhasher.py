@@ -0,0 +1,152 @@
+"""Password hashing with a configurable scheme, verified in a bounded thread pool."""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+import hashlib
+import hmac
+import os
+
+from werkzeug.security import check_password_hash, gen_salt, generate_password_hash
+
+# PASSWORD_HASH_METHOD values, cost is pbkdf2 iterations or the scrypt work factor n
+SCHEMES = ('pbkdf2:sha256', 'pbkdf2:sha512', 'scrypt')
+DEFAULT_COSTS = {'pbkdf2:sha256': 260000, 'pbkdf2:sha512': 260000, 'scrypt': 32768}
+# scrypt block size and parallelism, the same as werkzeug uses
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+class HasherBusy(Exception):
+    """Every verification slot is taken, the login should be retried later."""
+
+
+class PasswordHasher(object):
+    """Hashes and checks passwords with the configured scheme.
+
+    Hashes are stored as "<method>$<salt>$<hash>", the method part records
+    scheme and cost, so hashes made under an older setting, including the
+    original salted sha256, still verify and are flagged by needs_rehash.
+    check() runs in a pool of PASSWORD_HASH_THREADS threads, at most
+    PASSWORD_HASH_QUEUE more wait for a thread, further calls raise
+    HasherBusy instead of tying up the request worker.
+    """
+
+    def __init__(self, app=None):
+        self.method = 'pbkdf2:sha256'
+        self.cost = DEFAULT_COSTS[self.method]
+        self.threads = 2
+        self.queue = 16
+        self.timeout = 10.0
+        self._lock = Lock()
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(
+            app.config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256'),
+            app.config.get('PASSWORD_HASH_COST'),
+            threads=app.config.get('PASSWORD_HASH_THREADS', 2),
+            queue=app.config.get('PASSWORD_HASH_QUEUE', 16),
+            timeout=app.config.get('PASSWORD_HASH_TIMEOUT', 10.0)
+        )
+
+    def configure(self, method, cost=None, threads=None, queue=None, timeout=None):
+        """Switch scheme, cost or pool size, the pool is rebuilt on next use."""
+        if method not in SCHEMES:
+            raise ValueError('unknown password hash method %r, expected one of %s' % (method, ', '.join(SCHEMES)))
+        self.method = method
+        self.cost = int(cost) if cost else DEFAULT_COSTS[method]
+        if threads is not None:
+            self.threads = int(threads)
+        if queue is not None:
+            self.queue = int(queue)
+        if timeout is not None:
+            self.timeout = float(timeout)
+        self.shutdown()
+
+    @property
+    def method_string(self):
+        """Method part of hashes made with the current setting."""
+        if self.method == 'scrypt':
+            return 'scrypt:%d:%d:%d' % (self.cost, SCRYPT_R, SCRYPT_P)
+        return '%s:%d' % (self.method, self.cost)
+
+    def hash(self, password):
+        """Hash password with the configured scheme and a fresh salt."""
+        if self.method == 'scrypt':
+            salt = gen_salt(16)
+            return '%s$%s$%s' % (self.method_string, salt, _scrypt(password, salt, self.cost, SCRYPT_R, SCRYPT_P))
+        return generate_password_hash(password, method=self.method_string, salt_length=16)
+
+    def verify(self, pwhash, password):
+        """Check password against pwhash in the calling thread."""
+        if not pwhash:
+            return False
+        if pwhash.startswith('scrypt:'):
+            try:
+                method, salt, expected = pwhash.split('$', 2)
+                n, r, p = [int(part) for part in method.split(':')[1:]]
+            except ValueError:
+                return False
+            return hmac.compare_digest(_scrypt(password, salt, n, r, p), expected)
+        # pbkdf2 and the legacy salted sha256 hashes
+        return check_password_hash(pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True when pwhash was not made with the current scheme and cost."""
+        return pwhash.split('$', 1)[0] != self.method_string
+
+    def check(self, pwhash, password):
+        """Verify in the pool, returns (ok, new hash or None).
+
+        When the password is right but pwhash is outdated, the replacement
+        hash is computed in the same pool job. Raises HasherBusy when no
+        slot is free or the job does not finish within PASSWORD_HASH_TIMEOUT.
+        """
+        if self.threads <= 0:
+            return self._check(pwhash, password)
+
+        executor, slots = self._pool()
+        if not slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = executor.submit(self._check, pwhash, password)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda done: slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+
+    def _check(self, pwhash, password):
+        if not self.verify(pwhash, password):
+            return False, None
+        if self.needs_rehash(pwhash):
+            return True, self.hash(password)
+        return True, None
+
+    def _pool(self):
+        with self._lock:
+            # threads do not survive a fork, forked workers start their own pool
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='password-hash')
+                self._slots = BoundedSemaphore(self.threads + self.queue)
+                self._pid = os.getpid()
+            return self._executor, self._slots
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def _scrypt(password, salt, n, r, p):
+    # memory needed is 128 * n * r * p bytes, allow a little over
+    return hashlib.scrypt(
+        password.encode('utf-8'), salt=salt.encode('utf-8'), n=n, r=r, p=p, maxmem=132 * n * r * p, dklen=64
+    ).hex()
@@ -0,0 +1,96 @@
+"""Hot queries shared by routes, identity loading and the index check."""
+from sqlalchemy import func, or_
+
+from . import db
+from .models import Document, User, Retention
+
+
+def identity_needs_query(user_id):
+    """user_type, user_status and every retained document_id of a user.
+
+    Sponsors retain documents through sponsor_id and editors through
+    editor_id. Each branch of the union joins on a single indexed column,
+    and a user without documents still comes back as one row with a null
+    document_id.
+    """
+    sponsor_rows = db.session.query(User.user_type, User.user_status, Retention.document_id).\
+        outerjoin(Retention, (Retention.sponsor_id == User.id) & (User.user_type == 'sponsor')).\
+        filter(User.id == user_id)
+    editor_rows = db.session.query(User.user_type, User.user_status, Retention.document_id).\
+        join(Retention, (Retention.editor_id == User.id) & (User.user_type == 'editor')).\
+        filter(User.id == user_id)
+    return sponsor_rows.union_all(editor_rows)
+
+
+def sponsor_documents_query(user_id):
+    """Documents retained by a sponsor, with their editor name, bodies are not read."""
+    return db.session.query(Retention.id.label('retention_id'),Retention.sponsor_id,User.id,Retention.editor_id,Retention.document_id,User.name,Document.document_name).\
+    join(Retention, User.id==Retention.editor_id).\
+    join(Document, Document.id==Retention.document_id).\
+    filter(Retention.sponsor_id == user_id)
+
+
+def editor_documents_query(user_id):
+    """Documents assigned to an editor, bodies are not read."""
+    return db.session.query(Retention.id.label('retention_id'),Document.id,Document.document_name).\
+    join(Retention, Retention.document_id == Document.id).\
+    filter(Retention.editor_id == user_id)
+
+
+def user_status_filter(status):
+    """SQL filter for a usersview status, 'none' is any status outside the known ones."""
+    if status == 'none':
+        return or_(User.user_status.is_(None), User.user_status.notin_(['pending', 'approved', 'rejected']))
+    return User.user_status == status
+
+
+def users_section_query(user_type, user_status):
+    """Users of one type and status, as listed in the admin users view."""
+    return db.session.query(User.id,User.email,User.user_type,User.user_status,User.name,User.organization).\
+    filter(User.user_type == user_type).\
+    filter(user_status_filter(user_status))
+
+
+def users_section_count_query(user_type, user_status):
+    """Number of users in a users view section, counted on the (user_type, user_status, id) index."""
+    return db.session.query(func.count(User.id)).\
+    filter(User.user_type == user_type).\
+    filter(user_status_filter(user_status))
+
+
+def document_retention_query(document_id):
+    """The retention, and so the editor, of a document."""
+    return db.session.query(Retention).join(User, User.id == Retention.editor_id).filter(Retention.document_id == document_id)
+
+
+def editor_choices_query():
+    """Every editor, offered as a choice on document forms."""
+    return User.query.filter(User.user_type == 'editor')
+
+
+# fields of the document list API, name -> column, "id" is the retention id and page key
+SPONSOR_DOCUMENT_FIELDS = {
+    'id': Retention.id,
+    'document_id': Retention.document_id,
+    'document_name': Document.document_name,
+    'version': Document.version,
+    'editor_id': Retention.editor_id,
+    'editor_name': User.name,
+    'editor_status': User.user_status,
+}
+EDITOR_DOCUMENT_FIELDS = {
+    'id': Retention.id,
+    'document_id': Document.id,
+    'document_name': Document.document_name,
+    'version': Document.version,
+    'sponsor_id': Retention.sponsor_id,
+}
+
+
+def document_fields_query(query, fields, columns):
+    """query selecting only the given fields, labelled by field name.
+
+    The joins and filters of query are kept, so only the selected columns
+    are read.
+    """
+    return query.with_entities(*[columns[name].label(name) for name in fields])
@@ -0,0 +1,308 @@
+"""Login rate limits per client address and per email, checked before any database work."""
+from threading import Lock
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from .sessionstore import RedisBackend, RedisError
+
+logger = logging.getLogger(__name__)
+
+# limits checked on a login POST, in order, with their default "attempts/seconds"
+LOGIN_LIMITS = (
+    ('login_ip', '20/60'),
+    ('login_email', '5/300'),
+)
+
+# shared memory slot, key hash, tokens left and time of the last update
+SLOT = struct.Struct('<Qdd')
+# slots looked at for a key before the least recently used one is reused
+PROBES = 8
+
+
+def parse_limit(value):
+    """(attempts, seconds) of a "<attempts>/<seconds>" limit, None when it is empty or 0."""
+    if not value:
+        return None
+    attempts, _, seconds = str(value).partition('/')
+    attempts, seconds = int(attempts), float(seconds or 1)
+    if attempts <= 0 or seconds <= 0:
+        return None
+    return attempts, seconds
+
+
+def key_hash(key):
+    """64 bit hash of a key, never 0, which marks an empty slot."""
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+# ---------- backends, hit() returns (allowed, seconds until the next attempt is allowed) ----------
+
+class SharedMemoryBackend(object):
+    """Token buckets in a memory mapped file, shared by the workers of a host.
+
+    The file holds a fixed table of slots, a key is looked up in the
+    PROBES slots after its hash and takes the least recently updated one
+    when it is not there, a bucket that has not been touched for a while
+    is full again anyway. Updates hold a thread lock and an flock on the
+    file, both only for the few microseconds of the update.
+    """
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self._lock = Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        # forked workers reopen the file, an inherited descriptor shares its flock with the parent
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.slots * SLOT.size
+        if os.fstat(fd).st_size != size:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                # checked again under the lock, another worker may have just sized it
+                if os.fstat(fd).st_size != size:
+                    # resized tables start empty, slot positions depend on the slot count
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+
+    def hit(self, key, attempts, seconds, now=None):
+        now = time.time() if now is None else now
+        rate = attempts / seconds
+        wanted = key_hash(key)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset = self._find(wanted)
+                if offset is None:
+                    # a new bucket starts full
+                    offset, tokens = self._slot(wanted), attempts
+                else:
+                    stored, tokens, updated = SLOT.unpack_from(self._map, offset)
+                    tokens = min(attempts, tokens + max(now - updated, 0) * rate)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                SLOT.pack_into(self._map, offset, wanted, tokens, now)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def _find(self, wanted):
+        """Offset of the slot holding wanted, None when it has none."""
+        for probe in range(PROBES):
+            offset = ((wanted + probe) % self.slots) * SLOT.size
+            if SLOT.unpack_from(self._map, offset)[0] == wanted:
+                return offset
+        return None
+
+    def _slot(self, wanted):
+        """Offset of an empty slot for wanted, or of the least recently updated one."""
+        oldest, oldest_updated = None, None
+        for probe in range(PROBES):
+            offset = ((wanted + probe) % self.slots) * SLOT.size
+            stored, tokens, updated = SLOT.unpack_from(self._map, offset)
+            if stored == 0:
+                return offset
+            if oldest is None or updated < oldest_updated:
+                oldest, oldest_updated = offset, updated
+        return oldest
+
+    def clear(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self._map[:] = bytes(len(self._map))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class RedisLimitBackend(object):
+    """Sliding window counters on a Redis protocol server, shared by every host.
+
+    Attempts are counted per fixed window of the limit's length, INCR
+    being atomic on every such server without scripting. The estimate of
+    the sliding window is the current count plus the previous window's
+    count weighted by how much of it the sliding window still covers. The
+    INCR, PEXPIRE and GET of a hit go out in one round trip, a rejected
+    attempt is taken back with DECR, so only allowed attempts count, as
+    with the token buckets.
+    """
+
+    def __init__(self, url, timeout=0.5):
+        self.client = RedisBackend(url, timeout=timeout)
+
+    def hit(self, key, attempts, seconds, now=None):
+        now = time.time() if now is None else now
+        window = int(now // seconds)
+        elapsed = now - window * seconds
+        current = 'ratelimit:%s:%d' % (key, window)
+        count, _, previous = self.client.pipeline(
+            ('INCR', current),
+            # the count is still read as the previous window during the next one
+            ('PEXPIRE', current, int(seconds * 2000) + 1000),
+            ('GET', 'ratelimit:%s:%d' % (key, window - 1))
+        )
+        previous = int(previous or 0)
+        weight = 1 - elapsed / seconds
+        if previous * weight + count <= attempts:
+            return True, 0.0
+        self.client.command('DECR', current)
+        if count > attempts or not previous:
+            # the current window alone is full
+            return False, seconds - elapsed
+        # the previous window has to fade until one more attempt fits
+        return False, max(seconds * (1 - (attempts - count) / previous) - elapsed, 0.0)
+
+    def clear(self):
+        self.client.clear()
+
+
+def default_shm_path():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'project-ratelimit')
+
+
+def make_limit_backend(name, app):
+    """Backend named by RATE_LIMIT_BACKEND."""
+    if name == 'shared':
+        return SharedMemoryBackend(
+            app.config.get('RATE_LIMIT_SHM_PATH') or default_shm_path(),
+            app.config.get('RATE_LIMIT_SHM_SLOTS', 65536)
+        )
+    if name == 'redis':
+        return RedisLimitBackend(app.config.get('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0'))
+    raise ValueError('unknown RATE_LIMIT_BACKEND %r, expected shared or redis' % name)
+
+
+# ---------- limiter ----------
+
+class RateLimited(object):
+    """A rejected attempt, the limit it broke and when to come back."""
+
+    def __init__(self, name, retry_after):
+        self.name = name
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        """Whole seconds for the Retry-After header, at least 1."""
+        return str(max(1, int(math.ceil(self.retry_after))))
+
+
+class RateLimiter(object):
+    """Named attempts/seconds limits on a shared backend.
+
+    RATE_LIMIT_BACKEND shared keeps token buckets in a memory mapped file
+    for the workers of one host, redis keeps sliding window counters on
+    any Redis protocol server, LocalRespServer included. Each limit is
+    "<attempts>/<seconds>", empty turns it off. Hits and rejects are
+    counted per worker and served on the metrics endpoint. A backend that
+    cannot be reached lets attempts through and counts an error.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.backend = None
+        self.limits = {}
+        self.trusted_proxies = 0
+        self._lock = Lock()
+        self._counts = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RATE_LIMIT_ENABLED', True)
+        self.backend = make_limit_backend(app.config.get('RATE_LIMIT_BACKEND', 'shared'), app)
+        self.limits = dict(
+            (name, parse_limit(app.config.get('RATE_LIMIT_' + name.upper(), default)))
+            for name, default in LOGIN_LIMITS
+        )
+        # proxies in front of the app, each appends to X-Forwarded-For
+        self.trusted_proxies = app.config.get('RATE_LIMIT_TRUSTED_PROXIES', 0)
+
+    def _count(self, name, outcome):
+        with self._lock:
+            key = (name, outcome)
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def hit(self, name, identity):
+        """Count an attempt against limit name, returns RateLimited when it is over."""
+        limit = self.limits.get(name)
+        if not self.enabled or limit is None or not identity:
+            return None
+        try:
+            allowed, retry_after = self.backend.hit('%s:%s' % (name, identity), *limit)
+        except (OSError, EOFError, RedisError):
+            # an unreachable store lets logins through rather than locking everyone out
+            logger.warning('rate limit store unavailable', exc_info=True)
+            self._count(name, 'error')
+            return None
+        self._count(name, 'hit' if allowed else 'reject')
+        return None if allowed else RateLimited(name, retry_after)
+
+    def check_login(self, request):
+        """Count a login POST against the address and email limits.
+
+        Reads the raw form field, nothing is validated or queried. An
+        address over its limit is turned away without counting against the
+        email, so one client cannot lock out an account it is guessing at
+        any faster than its own limit allows.
+        """
+        rejected = self.hit('login_ip', self.client_address(request))
+        if rejected is None:
+            email = (request.form.get('email') or '').strip().lower()
+            if email:
+                # emails are not kept in the store as they are
+                rejected = self.hit('login_email', hashlib.sha256(email.encode('utf-8')).hexdigest()[:32])
+        return rejected
+
+    def client_address(self, request):
+        """Address of the client, X-Forwarded-For is only read past trusted proxies."""
+        if self.trusted_proxies:
+            forwarded = [part.strip() for part in request.headers.get('X-Forwarded-For', '').split(',') if part.strip()]
+            if len(forwarded) >= self.trusted_proxies:
+                return forwarded[-self.trusted_proxies]
+        return request.remote_addr
+
+    def counts(self):
+        """{(limit name, 'hit' | 'reject' | 'error'): count} of this worker."""
+        with self._lock:
+            return dict(self._counts)
+
+    def metric_lines(self):
+        """Counters in the Prometheus text format, for RequestMetrics."""
+        lines = [
+            '# HELP app_rate_limit_total Rate limited attempts, by limit and outcome.',
+            '# TYPE app_rate_limit_total counter',
+        ]
+        for (name, outcome), count in sorted(self.counts().items()):
+            lines.append('app_rate_limit_total{limit="%s",outcome="%s"} %d' % (name, outcome, count))
+        return lines
+
+    def reset(self):
+        """Empty every bucket and counter."""
+        self.backend.clear()
+        with self._lock:
+            self._counts.clear()
@@ -0,0 +1,45 @@
+"""Single-execution row streaming and streamed template rendering for list views."""
+from flask import current_app, stream_with_context, Response
+from flask import before_render_template, template_rendered
+
+
+def stream_rows(query, batch_size=None):
+    """Run query once and yield its rows batch by batch.
+
+    Rows are pulled from the cursor batch_size at a time, which on postgres
+    uses a server-side cursor, so the full result set never sits in memory.
+    The query is executed when iteration starts, so the result can only be
+    iterated once.
+    """
+    if batch_size is None:
+        batch_size = current_app.config.get('RESULT_BATCH_SIZE', 500)
+    query = query.yield_per(batch_size)
+    if current_app.config.get('DATABASE_PGBOUNCER'):
+        # named cursors cannot be relied on through pgbouncer, fetch client side
+        query = query.execution_options(stream_results=False)
+    return query
+
+
+def stream_template(template_name, **context):
+    """Render a template as a streamed response.
+
+    Rows handed in through stream_rows are rendered as they come off the
+    cursor instead of being collected first.
+    """
+    app = current_app._get_current_object()
+    # same context processors as render_template, url_for, current_user etc.
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    # group small template chunks into fewer, larger writes
+    stream = template.stream(context)
+    stream.enable_buffering(app.config.get('TEMPLATE_STREAM_BUFFER', 64))
+
+    def generate():
+        # same signals as render_template, sent around the whole stream
+        before_render_template.send(app, template=template, context=context)
+        for chunk in stream:
+            yield chunk
+        template_rendered.send(app, template=template, context=context)
+
+    # keep the request context, and db session, alive while streaming
+    return Response(stream_with_context(generate()))
@@ -0,0 +1,335 @@
+"""Document revision history, a delta per save and a full snapshot every so often."""
+from datetime import datetime
+import difflib
+import zlib
+
+from sqlalchemy import func
+from werkzeug.exceptions import NotFound
+
+from . import db, body_store
+from .models import DocumentRevision
+from .sessionstore import MemoryBackend
+
+SNAPSHOT = 'snapshot'
+DELTA = 'delta'
+
+# delta operations, applied in order to the previous version's body
+# COPY start length, INSERT text, COPY_REST start
+COPY = 0
+INSERT = 1
+COPY_REST = 2
+
+# a line diff of the changed middle of a body is skipped past this many lines
+MAX_DIFF_LINES = 20000
+
+
+class RevisionNotFound(NotFound):
+    """The document has no revision with that version, a 404 when not caught."""
+
+
+class RevisionStore(object):
+    """Records a revision on every document save and rebuilds any of them.
+
+    A save is stored as a delta from the previous version, copy and insert
+    operations on character ranges, so its size follows the size of the
+    change. Every DOCUMENT_REVISION_SNAPSHOT_EVERY versions the whole body is
+    stored instead, rebuilding a version applies at most that many deltas
+    to the nearest snapshot. Rebuilt bodies are kept in a per-process LRU of
+    DOCUMENT_REVISION_CACHE_SIZE entries, revisions never change, and a
+    rebuild starts from the newest cached version it can.
+    """
+
+    def __init__(self, app=None):
+        self.snapshot_every = 20
+        self.cache_ttl = 3600
+        self.cache = MemoryBackend(256)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.snapshot_every = app.config.get('DOCUMENT_REVISION_SNAPSHOT_EVERY', self.snapshot_every)
+        self.cache_ttl = app.config.get('DOCUMENT_REVISION_CACHE_TTL', self.cache_ttl)
+        self.cache = MemoryBackend(app.config.get('DOCUMENT_REVISION_CACHE_SIZE', 256))
+
+    # ---------- recording ----------
+
+    def record_new(self, document_id, document_name, body, author_id=None):
+        """First revision of a new document, a snapshot of body."""
+        self._insert([self._snapshot_row(document_id, 1, document_name, body or '', author_id)])
+
+    def record_new_many(self, documents, author_id=None, batch_size=500):
+        """First revisions of new documents, a list of (document_id, document_name, body)."""
+        for start in range(0, len(documents), batch_size):
+            self._insert([
+                self._snapshot_row(document_id, 1, document_name, body or '', author_id)
+                for document_id, document_name, body in documents[start:start + batch_size]
+            ])
+
+    def ensure_baseline(self, document_id, version, document_name):
+        """Snapshot the stored body as version, when the document has no revisions yet.
+
+        Documents from before revisions were recorded get their history
+        started with what they held before their first save.
+        """
+        exists = db.session.query(DocumentRevision.id).filter(DocumentRevision.document_id == document_id).first()
+        if exists is None:
+            self._insert([self._stored_snapshot_row(document_id, version, document_name, None)])
+
+    def record(self, document_id, version, document_name, author_id=None, ops=None):
+        """Record the save that produced version.
+
+        ops are the delta operations from the previous version's body,
+        None when they are not known, a whole new body for example. The
+        body already holds the new text, a snapshot is read from it when
+        ops is None, the previous version is missing or a snapshot is due.
+        """
+        previous = db.session.query(DocumentRevision.version, DocumentRevision.length).\
+            filter(DocumentRevision.document_id == document_id).\
+            order_by(DocumentRevision.version.desc()).first()
+        last_snapshot = db.session.query(func.max(DocumentRevision.version)).\
+            filter(DocumentRevision.document_id == document_id).\
+            filter(DocumentRevision.kind == SNAPSHOT).scalar()
+
+        if ops is None or previous is None or previous.version != version - 1 \
+                or last_snapshot is None or version - last_snapshot >= self.snapshot_every:
+            row = self._stored_snapshot_row(document_id, version, document_name, author_id)
+        else:
+            row = self._row(document_id, version, DELTA, document_name, delta_length(ops, previous.length),
+                            author_id, encode_delta(ops))
+        self._insert([row])
+
+    def _insert(self, rows):
+        if rows:
+            db.session.execute(DocumentRevision.__table__.insert(), rows)
+
+    def _row(self, document_id, version, kind, document_name, length, author_id, data):
+        return {
+            'document_id': document_id,
+            'version': version,
+            'kind': kind,
+            'document_name': document_name,
+            'length': length,
+            'author_id': author_id,
+            'created_on': datetime.utcnow(),
+            'data': data
+        }
+
+    def _snapshot_row(self, document_id, version, document_name, body, author_id):
+        return self._row(document_id, version, SNAPSHOT, document_name, len(body), author_id,
+                         zlib.compress(body.encode('utf-8')))
+
+    def _stored_snapshot_row(self, document_id, version, document_name, author_id):
+        """Snapshot of the stored body, compressed chunk by chunk as it is read."""
+        compressor = zlib.compressobj()
+        parts = []
+        length = 0
+        for chunk in body_store.chunks(document_id):
+            # chunks end on character boundaries
+            length += len(chunk.decode('utf-8'))
+            parts.append(compressor.compress(chunk))
+        parts.append(compressor.flush())
+        return self._row(document_id, version, SNAPSHOT, document_name, length, author_id, b''.join(parts))
+
+    # ---------- reading ----------
+
+    def list_query(self, document_id):
+        """Revisions of a document, without their data."""
+        return db.session.query(
+            DocumentRevision.version, DocumentRevision.kind, DocumentRevision.document_name,
+            DocumentRevision.length, DocumentRevision.author_id, DocumentRevision.created_on
+        ).filter(DocumentRevision.document_id == document_id)
+
+    def text(self, document_id, version):
+        """Body of a document at version, rebuilt from the nearest snapshot.
+
+        Raises RevisionNotFound when there is no such revision.
+        """
+        key = 'revision:%d:%d' % (document_id, version)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        # the newest snapshot at or before version, and every delta after it
+        snapshot_version = db.session.query(func.max(DocumentRevision.version)).\
+            filter(DocumentRevision.document_id == document_id).\
+            filter(DocumentRevision.kind == SNAPSHOT).\
+            filter(DocumentRevision.version <= version).scalar()
+        if snapshot_version is None:
+            raise RevisionNotFound()
+        chain = db.session.query(DocumentRevision.version, DocumentRevision.kind, DocumentRevision.data).\
+            filter(DocumentRevision.document_id == document_id).\
+            filter(DocumentRevision.version.between(snapshot_version, version)).\
+            order_by(DocumentRevision.version).all()
+        if chain[-1].version != version:
+            raise RevisionNotFound()
+
+        # start from the newest version already rebuilt, or the snapshot
+        text, start = None, 1
+        for index in range(len(chain) - 2, 0, -1):
+            text = self.cache.get('revision:%d:%d' % (document_id, chain[index].version))
+            if text is not None:
+                start = index + 1
+                break
+        if text is None:
+            text = zlib.decompress(chain[0].data).decode('utf-8')
+        for revision in chain[start:]:
+            text = apply_delta(text, decode_delta(revision.data))
+
+        self.cache.set(key, text, self.cache_ttl)
+        return text
+
+
+# ---------- deltas ----------
+
+def patch_ops(patches):
+    """Delta operations of (start, end, text) patches, sorted and not overlapping."""
+    ops = []
+    position = 0
+    for start, end, text in patches:
+        if start > position:
+            ops.append((COPY, position, start - position))
+        if text:
+            ops.append((INSERT, text))
+        position = end
+    ops.append((COPY_REST, position))
+    return ops
+
+
+def text_ops(old, new):
+    """Delta operations turning old into new.
+
+    The common prefix and suffix are copied, what is left in between is
+    compared line by line.
+    """
+    prefix = _common_prefix(old, new)
+    suffix = _common_suffix(old[prefix:], new[prefix:])
+    old_middle = old[prefix:len(old) - suffix]
+    new_middle = new[prefix:len(new) - suffix]
+
+    ops = []
+    if prefix:
+        ops.append((COPY, 0, prefix))
+    old_lines = old_middle.splitlines(True)
+    new_lines = new_middle.splitlines(True)
+    if len(old_lines) > MAX_DIFF_LINES or len(new_lines) > MAX_DIFF_LINES:
+        if new_middle:
+            ops.append((INSERT, new_middle))
+    else:
+        # character offset of each old line
+        offsets = [prefix]
+        for line in old_lines:
+            offsets.append(offsets[-1] + len(line))
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                ops.append((COPY, offsets[i1], offsets[i2] - offsets[i1]))
+            elif j2 > j1:
+                ops.append((INSERT, ''.join(new_lines[j1:j2])))
+    if suffix:
+        ops.append((COPY_REST, len(old) - suffix))
+    return ops
+
+
+def apply_delta(old, ops):
+    parts = []
+    for op in ops:
+        if op[0] == COPY:
+            parts.append(old[op[1]:op[1] + op[2]])
+        elif op[0] == INSERT:
+            parts.append(op[1])
+        else:
+            parts.append(old[op[1]:])
+    return ''.join(parts)
+
+
+def delta_length(ops, old_length):
+    """Characters in the body produced by ops from a body of old_length."""
+    length = 0
+    for op in ops:
+        if op[0] == COPY:
+            length += op[2]
+        elif op[0] == INSERT:
+            length += len(op[1])
+        else:
+            length += old_length - op[1]
+    return length
+
+
+def encode_delta(ops):
+    """Compressed bytes of ops, an opcode byte then varint arguments and UTF-8 text."""
+    out = bytearray()
+    for op in ops:
+        out.append(op[0])
+        if op[0] == COPY:
+            _write_varint(out, op[1])
+            _write_varint(out, op[2])
+        elif op[0] == INSERT:
+            raw = op[1].encode('utf-8')
+            _write_varint(out, len(raw))
+            out += raw
+        else:
+            _write_varint(out, op[1])
+    return zlib.compress(bytes(out))
+
+
+def decode_delta(data):
+    data = zlib.decompress(data)
+    ops = []
+    position = 0
+    while position < len(data):
+        opcode = data[position]
+        position += 1
+        if opcode == COPY:
+            start, position = _read_varint(data, position)
+            length, position = _read_varint(data, position)
+            ops.append((COPY, start, length))
+        elif opcode == INSERT:
+            size, position = _read_varint(data, position)
+            ops.append((INSERT, data[position:position + size].decode('utf-8')))
+            position += size
+        else:
+            start, position = _read_varint(data, position)
+            ops.append((COPY_REST, start))
+    return ops
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def _common_prefix(a, b):
+    """Length of the common prefix of a and b, by bisection on slice comparisons."""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _common_suffix(a, b):
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:] == b[len(b) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
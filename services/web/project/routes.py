@@ -1,5 +1,5 @@
 """Logged-in page routes."""
-from flask import Blueprint, redirect, render_template, flash, request, session, url_for
+from flask import Blueprint, redirect, render_template, flash, request, session, url_for, jsonify
 from flask import g, current_app, abort, request
 from flask_login import current_user, login_required
 from flask_login import logout_user
@@ -9,39 +9,77 @@ from wtforms_sqlalchemy.orm import QuerySelectField
 from . import sponsor_permission, editor_permission, admin_permission, approved_permission, notapproved_permission
 # for identifitaction and permission management
 from flask_principal import Identity, identity_changed, identity_loaded, AnonymousIdentity
-# for printing system messages
-import sys
+# for logging system messages
+import logging
+import os
 # individual document access permission
 from .principalmanager import EditDocumentPermission
+# list query execution and streamed rendering
+from .resultstream import stream_template
+# keyset pagination of list views
+from .pagination import page_args, paginate_keyset
+# document creation, single and bulk, and versioned saves
+from .documentmanager import create_document, bulk_create_documents, invalid_editor_ids
+from .documentmanager import save_document, VersionConflict
+# user status changes, single and bulk
+from .usermanager import set_user_status, USER_STATUSES
+# cached user snapshots and server-side sessions, revoked at logout
+from . import session_store
+# document bodies, read and written apart from the documents table
+from . import body_store
+from .bodystore import BodyTooLarge
+# full-text search of the document lists
+from . import search_index
+from .search import search_args
+# cached dashboard and list fragments
+from . import fragment_cache
+from .templatecache import Lazy
+# dashboard counters, one primary key lookup
+from .userstats import user_stats
+# grouped user counts and signup trends for admins
+from .analytics import BUCKETS, cached_user_analytics
+# list, permission and lookup queries
+from .queries import sponsor_documents_query, editor_documents_query, users_section_query, users_section_count_query, document_retention_query, editor_choices_query
+
+# module logger, a child of the project logger
+logger = logging.getLogger(__name__)
+
+# shown when a document edit started from an outdated version
+CONFLICT_MESSAGE = 'This document was saved by someone else while you were editing it. Your changes were not saved, the current version is shown below.'
+
+
+def form_version(form):
+    """Document version posted with an edit form, None when missing."""
+    try:
+        return int(form.version.data)
+    except (TypeError, ValueError):
+        return None
 
 
 # Blueprint Configuration
-# we define __name__ as the main blueprint, and the templates/static folder.
+# we define __name__ as the main blueprint, and the templates folder.
+# static files are served once, by the app static route, see staticfiles.py
 main_bp = Blueprint(
     'main_bp', __name__,
-    template_folder='templates',
-    static_folder='static'
+    template_folder='templates'
 )
 
 # Sponsor Blueprint
 sponsor_bp = Blueprint(
     'sponsor_bp', __name__,
-    template_folder='templates_sponsors',
-    static_folder='static'
+    template_folder='templates_sponsors'
 )
 
 # Editor Blueprint
 editor_bp = Blueprint(
     'editor_bp', __name__,
-    template_folder='templates_editors',
-    static_folder='static'
+    template_folder='templates_editors'
 )
 
 # Blueprint Configuration
 admin_bp = Blueprint(
     'admin_bp', __name__,
-    template_folder='templates_admins',
-    static_folder='static'
+    template_folder='templates_admins'
 )
 
 # when any user goes to /, they get redirected to /login
@@ -59,13 +97,13 @@ def logindefault():
 @sponsor_permission.require(http_exception=403)
 def logoutsponsor():
     """User log-out logic."""
+    # drop the cached user and the stored session before logging out
+    session_store.revoke(current_user.id)
     logout_user()
     # tell flask principal the user is annonymous
     identity_changed.send(current_app._get_current_object(),identity=AnonymousIdentity())
-    # print annonymousidentity to console
-    identity_object = AnonymousIdentity()
-    # printing identity_object to console for verification
-    print('Sent: ',identity_object,' ...to current_app', file=sys.stderr)
+    # log the anonymous identity sent to current_app
+    logger.info('identity changed to anonymous')
     return redirect(url_for('auth_bp.login'))
 
 @sponsor_bp.route('/sponsor/dashboard', methods=['GET','POST'])
@@ -74,9 +112,8 @@ def logoutsponsor():
 def dashboard_sponsor():
     """Logged-in User Dashboard."""
 
-    # Query user status
-    print('Querying Database for user_status!', file=sys.stderr)
-    current_user_status = User.query.filter(User.id==current_user.id)[0].user_status
+    # user status comes with the cached user snapshot, no query
+    current_user_status = current_user.user_status
 
     if current_user_status=='pending' or current_user_status=='rejected':
         flash('Your User Approval Status is either Pending or Rejected. Please contact the site administrator to gain Approved status.')
@@ -85,7 +122,10 @@ def dashboard_sponsor():
         'dashboard_sponsor.jinja2',
         title='Sponsor Dashboard',
         template='layout',
-        body="Welcome to the Sponsor Dashboard."
+        body="Welcome to the Sponsor Dashboard.",
+        # only looked up when the cached dashboard is missing or outdated
+        stats=Lazy(user_stats, current_user.id),
+        fragment_key=fragment_cache.key('dashboard_sponsor', 'user:%s' % current_user.id)
     )
 
 
@@ -99,50 +139,25 @@ def newdocument_sponsor():
     form = DocumentForm()
 
     # display choices from list of editors
-    form.editorchoice.query = User.query.filter(User.user_type == 'editor')
+    form.editorchoice.query = editor_choices_query()
 
     if form.validate_on_submit():
 
-        # Add New Document ------------
-        # take new document
-        # create new document
-        newdocument = Document(
-            document_name=form.document_name.data,
-            document_body=form.document_body.data
-            )
-
-        # add and commit new document
-        db.session.add(newdocument)
-        db.session.commit()
-
-        # after this document has just been added to the database, add retention
-        # query all documents in order, put into a python object
-        all_documents_ordered = Document.query.order_by(Document.id)
-        # query count of all documents, subtract 1 because python index starts at 0
-        document_index = Document.query.count() - 1
-        # last document object is document index, or count-1
-        last_document = all_documents_ordered[document_index]
-        # new document id for retentions database is indexed last documentid integer
-        newdocument_id = last_document.id
-
-
-        # Add Sponsor Retention ------------
+        # Add New Document and Sponsor Retention ------------
         # get the current userid
         user_id = current_user.id
 
         # extract the selected editor choice from the form
         selected_editor_id=int(form.editorchoice.data.id)
 
-        # create a new retention entry
-        newretention = Retention(
+        # document and retention are inserted together in one commit,
+        # the retention picks up the generated document id
+        create_document(
             sponsor_id=user_id,
             editor_id=selected_editor_id,
-            document_id=newdocument_id
+            document_name=form.document_name.data,
+            document_body=form.document_body.data
             )
-        
-        # add retention to session and commit to database
-        db.session.add(newretention)
-        db.session.commit()
 
          # message included in the route python function
         message = "New Document saved. Create another document if you would like."
@@ -152,6 +167,57 @@ def newdocument_sponsor():
     return render_template('newdocument_sponsor.jinja2',form=form)
 
 
+# length of the documents.document_name column
+DOCUMENT_NAME_LENGTH = Document.__table__.c.document_name.type.length
+
+
+@sponsor_bp.route('/sponsor/newdocuments', methods=['POST'])
+@login_required
+@sponsor_permission.require(http_exception=403)
+@approved_permission.require(http_exception=403)
+def newdocuments_sponsor():
+    """
+    Bulk document creation.
+
+    POST a JSON body {"documents": [{"document_name", "document_body", "editor_id"}, ...]},
+    every document is created in one transaction with batched inserts.
+    """
+    payload = request.get_json(silent=True) or {}
+    items = payload.get('documents')
+
+    # validate the shape of the request before touching the database
+    if not isinstance(items, list) or not items:
+        return jsonify(error='documents must be a non-empty list'), 400
+    max_documents = current_app.config['BULK_CREATE_MAX_DOCUMENTS']
+    if len(items) > max_documents:
+        return jsonify(error='at most %d documents per request' % max_documents), 400
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('editor_id'), int):
+            return jsonify(error='every document needs an integer editor_id'), 400
+        if not isinstance(item.get('document_body'), (str, type(None))):
+            return jsonify(error='document_body must be a string'), 400
+        # over-long names fail the insert on postgresql instead of being cut
+        document_name = item.get('document_name')
+        if not isinstance(document_name, (str, type(None))) or len(document_name or '') > DOCUMENT_NAME_LENGTH:
+            return jsonify(error='document_name must be a string of at most %d characters' % DOCUMENT_NAME_LENGTH), 400
+
+    # every editor_id must belong to an editor, checked with one query
+    unknown_editors = invalid_editor_ids(item['editor_id'] for item in items)
+    if unknown_editors:
+        return jsonify(error='not editors: %s' % sorted(unknown_editors)), 400
+
+    try:
+        document_ids = bulk_create_documents(
+            current_user.id,
+            items,
+            batch_size=current_app.config['BULK_INSERT_BATCH_SIZE']
+            )
+    except BodyTooLarge:
+        return jsonify(error='document_body is over %d bytes' % body_store.max_size), 413
+
+    return jsonify(created=len(document_ids), document_ids=document_ids), 201
+
+
 @sponsor_bp.route('/sponsor/documents', methods=['GET','POST'])
 @login_required
 @sponsor_permission.require(http_exception=403)
@@ -164,28 +230,27 @@ def documentlist_sponsor():
     # Document objects list which includes editors for all objects
     # this logic will only work if document_objects.count() = editor_objects.count()
     # get document objects filtered by the current user
-    document_objects=db.session.query(Retention.sponsor_id,User.id,Retention.editor_id,Retention.document_id,User.name,Document.document_name,Document.document_body).\
-    join(Retention, User.id==Retention.editor_id).\
-    join(Document, Document.id==Retention.document_id).\
-    order_by(Retention.sponsor_id).\
-    filter(Retention.sponsor_id == user_id)
-
-    # get a count of the document objects
-    document_count = document_objects.count()
-    
-    # blank list to append to for documents and editors
-    document_list=[]
-
-    # loop through document objects
-    for counter in range(0,document_count):
-        document_list.append(document_objects[counter])
-
-    # show list of document names
-    documents = document_list
-
-    return render_template(
+    document_objects = sponsor_documents_query(user_id)
+
+    # one page of documents, keyed on the retention id, ?after= / ?before= cursors
+    paging = page_args()
+    terms, page = search_args()
+    if terms:
+        # ?q= ranks the matching documents of the same list, ?page= numbers the result pages
+        documents = Lazy(search_index.page, document_objects, terms, page, paging['per_page'])
+        fragment_key = fragment_cache.key(
+            'documentlist_sponsor_search', 'user:%s' % user_id, page=page, per_page=paging['per_page'], q=terms
+        )
+    else:
+        # only queried when the cached table for this page is missing or outdated
+        documents = Lazy(paginate_keyset, document_objects, Retention.id, 'retention_id', **paging)
+        fragment_key = fragment_cache.key('documentlist_sponsor', 'user:%s' % user_id, **paging)
+
+    return stream_template(
         'documentlist_sponsor.jinja2',
         documents=documents,
+        search_terms=terms,
+        fragment_key=fragment_key
     )
 
 
@@ -210,7 +275,7 @@ def documentedit_sponsor(document_id):
 
         # Getting the Retention Object to Filter  for Editor ID
         # join query to get and display current editor id via the retention object
-        retention_object = db.session.query(Retention).join(User, User.id == Retention.editor_id).filter(Retention.document_id == document_id)[0]
+        retention_object = document_retention_query(document_id)[0]
         # get current editor_id from retention object
         current_editor_id = retention_object.editor_id
         
@@ -221,18 +286,35 @@ def documentedit_sponsor(document_id):
         editor = current_editor_object
 
         # display choices from list of editors
-        form.editorchoice.query = User.query.filter(User.user_type == 'editor')
+        form.editorchoice.query = editor_choices_query()
 
         if form.validate_on_submit():
-            # take new document
-            # edit document parameters
-            # index [0], which is the row in question for document name
-            document.document_name = form.document_name.data
-            document.document_body = form.document_body.data
-
             # grab the selected_editor_id from the form
             selected_editor_id=int(form.editorchoice.data.id)
 
+            try:
+                # take new document
+                # edit document parameters, only if nobody saved since this form was rendered
+                # the body is replaced chunk by chunk in the same transaction
+                save_document(
+                    document,
+                    form_version(form),
+                    document_name=form.document_name.data,
+                    body=form.document_body.data or '',
+                    author_id=current_user.id
+                    )
+            except VersionConflict as conflict:
+                # show the current document, the submitted values stay in the form
+                flash(CONFLICT_MESSAGE)
+                form.version.data = conflict.current_version
+                return render_template(
+                    'documentedit_sponsor.jinja2',
+                    form=form,
+                    document=document,
+                    document_body=body_store.read_text(document.id),
+                    editor=editor
+                    ), 409
+
             # add new retention
             retention_object.editor_id = selected_editor_id
 
@@ -242,10 +324,16 @@ def documentedit_sponsor(document_id):
             # redirect to document list after change
             return redirect(url_for('sponsor_bp.documentlist_sponsor'))
 
+        # saves are checked against the version the form was first rendered from
+        if not form.is_submitted():
+            form.version.data = document.version
+
         return render_template(
             'documentedit_sponsor.jinja2',
             form=form,
             document=document,
+            # the body is only read here, never by the lists
+            document_body=body_store.read_text(document.id),
             editor=editor
             )
 
@@ -262,13 +350,13 @@ def documentedit_sponsor(document_id):
 @editor_permission.require(http_exception=403)
 def logouteditor():
     """User log-out logic."""
+    # drop the cached user and the stored session before logging out
+    session_store.revoke(current_user.id)
     logout_user()
     # tell flask principal the user is annonymous
     identity_changed.send(current_app._get_current_object(),identity=AnonymousIdentity())
-    # print annonymousidentity to console
-    identity_object = AnonymousIdentity()
-    # printing identity_object to console for verification
-    print('Sent: ',identity_object,' ...to current_app', file=sys.stderr)
+    # log the anonymous identity sent to current_app
+    logger.info('identity changed to anonymous')
     return redirect(url_for('auth_bp.login'))
 
 @editor_bp.route('/editor/dashboard', methods=['GET'])
@@ -277,9 +365,8 @@ def logouteditor():
 def dashboard_editor():
     """Logged-in User Dashboard."""
 
-    # Query user status
-    print('Querying Database for user_status!', file=sys.stderr)
-    current_user_status = User.query.filter(User.id==current_user.id)[0].user_status
+    # user status comes with the cached user snapshot, no query
+    current_user_status = current_user.user_status
 
     if current_user_status=='pending' or current_user_status=='rejected':
         flash('Your User Approval Status is either Pending or Rejected. Please contact the site administrator to gain Approved status.')
@@ -288,7 +375,10 @@ def dashboard_editor():
         'dashboard_editor.jinja2',
         title='Editor Dashboard',
         template='layout',
-        body="Welcome to the Editor Dashboard."
+        body="Welcome to the Editor Dashboard.",
+        # only looked up when the cached dashboard is missing or outdated
+        stats=Lazy(user_stats, current_user.id),
+        fragment_key=fragment_cache.key('dashboard_editor', 'user:%s' % current_user.id)
     )
 
 @editor_bp.route('/editor/documents', methods=['GET','POST'])
@@ -303,25 +393,27 @@ def documentlist_editor():
     # Document objects and list, as well as Editor objects and list
     # this logic will only work if document_objects.count() = editor_objects.count()
     # get document objects filtered by the current user
-    document_objects = db.session.query(Document).join(Retention, Retention.document_id == Document.id).filter(Retention.editor_id == user_id)
-
-    # get a count of the document objects
-    document_count = document_objects.count()
-    
-    # blank list to append to for documents and editors
-    document_list=[]
-    
-    # loop through document objects
-    for counter in range(0,document_count):
-        document_list.append(document_objects[counter])
-    
-    # show list of document names
-    documents = document_list
-
-    
-    return render_template(
+    document_objects = editor_documents_query(user_id)
+
+    # one page of documents, keyed on the retention id, ?after= / ?before= cursors
+    paging = page_args()
+    terms, page = search_args()
+    if terms:
+        # ?q= ranks the matching documents of the same list, ?page= numbers the result pages
+        documents = Lazy(search_index.page, document_objects, terms, page, paging['per_page'])
+        fragment_key = fragment_cache.key(
+            'documentlist_editor_search', 'user:%s' % user_id, page=page, per_page=paging['per_page'], q=terms
+        )
+    else:
+        # only queried when the cached table for this page is missing or outdated
+        documents = Lazy(paginate_keyset, document_objects, Retention.id, 'retention_id', **paging)
+        fragment_key = fragment_cache.key('documentlist_editor', 'user:%s' % user_id, **paging)
+
+    return stream_template(
         'documentlist_editor.jinja2',
         documents=documents,
+        search_terms=terms,
+        fragment_key=fragment_key
     )
 
 
@@ -345,11 +437,27 @@ def documentedit_editor(document_id):
         document = db.session.query(Document).filter_by(id = document_id)[0]
         
         if form.validate_on_submit():
-            # take new document
-            # edit document parameters
-            # index [0], which is the row in question for document name
-            document.document_name = form.document_name.data
-            document.document_body = form.document_body.data
+            try:
+                # take new document
+                # edit document parameters, only if nobody saved since this form was rendered
+                # the body is replaced chunk by chunk in the same transaction
+                save_document(
+                    document,
+                    form_version(form),
+                    document_name=form.document_name.data,
+                    body=form.document_body.data or '',
+                    author_id=current_user.id
+                    )
+            except VersionConflict as conflict:
+                # show the current document, the submitted values stay in the form
+                flash(CONFLICT_MESSAGE)
+                form.version.data = conflict.current_version
+                return render_template(
+                    'documentedit_editor.jinja2',
+                    form=form,
+                    document=document,
+                    document_body=body_store.read_text(document.id),
+                    ), 409
 
             # commit changes
             db.session.commit()
@@ -357,11 +465,17 @@ def documentedit_editor(document_id):
             # redirect to document list after change
             return redirect(url_for('editor_bp.documentlist_editor'))
 
+        # saves are checked against the version the form was first rendered from
+        if not form.is_submitted():
+            form.version.data = document.version
+
 
         return render_template(
             'documentedit_editor.jinja2',
             form=form,
             document=document,
+            # the body is only read here, never by the lists
+            document_body=body_store.read_text(document.id),
             )
 
     # abort if permission not satisfied
@@ -376,13 +490,13 @@ def documentedit_editor(document_id):
 @admin_permission.require(http_exception=403)
 def logoutadmin():
     """User log-out logic."""
+    # drop the cached user and the stored session before logging out
+    session_store.revoke(current_user.id)
     logout_user()
     # tell flask principal the user is annonymous
     identity_changed.send(current_app._get_current_object(),identity=AnonymousIdentity())
-    # print annonymousidentity to console
-    identity_object = AnonymousIdentity()
-    # printing identity_object to console for verification
-    print('Sent: ',identity_object,' ...to current_app', file=sys.stderr)
+    # log the anonymous identity sent to current_app
+    logger.info('identity changed to anonymous')
     return redirect(url_for('auth_bp.login'))
 
 
@@ -396,9 +510,62 @@ def dashboard_admin():
         'dashboard_admin.jinja2',
         title='Admin Dashboard',
         template='layout',
-        body="Welcome to the Admin Dashboard."
+        body="Welcome to the Admin Dashboard.",
+        # only looked up when the cached dashboard is missing or outdated
+        stats=Lazy(user_stats, current_user.id),
+        # the pending count changes with any user, cached under the users scope
+        fragment_key=fragment_cache.key('dashboard_admin', 'users', admin=current_user.id)
     )
 
+# usersview sections, (group heading, user_status filter, user_type filter)
+USERSVIEW_SECTIONS = (
+    ('Pending', 'pending', 'sponsor'),
+    ('Pending', 'pending', 'editor'),
+    ('Approved', 'approved', 'sponsor'),
+    ('Approved', 'approved', 'editor'),
+    ('Rejected', 'rejected', 'sponsor'),
+    ('Rejected', 'rejected', 'editor'),
+    ('Null Status', 'none', 'sponsor'),
+    ('Null Status', 'none', 'editor'),
+)
+
+@admin_bp.route('/admin/poolstats', methods=['GET'])
+@login_required
+@admin_permission.require(http_exception=403)
+def poolstats_admin():
+    """Connection pool usage of the worker serving the request."""
+    pool = db.engine.pool
+    stats = {
+        'pid': os.getpid(),
+        'pool_class': type(pool).__name__,
+        'status': pool.status()
+    }
+    # queue pools report their sizing, sqlite pools do not
+    if hasattr(pool, 'checkedout'):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            # the configured limit, the pool does not expose it
+            max_overflow=current_app.config['SQLALCHEMY_ENGINE_OPTIONS'].get('max_overflow'),
+            timeout=pool.timeout()
+        )
+    return jsonify(stats)
+
+
+# signuprequests sections, (user_status filter, user_type filter)
+SIGNUPREQUESTS_SECTIONS = (
+    ('pending', 'sponsor'),
+    ('pending', 'editor'),
+)
+
+
+def section_total(user_type, user_status):
+    """Users in a users view section, counted on every miss so a status change shows at once."""
+    return users_section_count_query(user_type, user_status).scalar()
+
+
 @admin_bp.route('/admin/signuprequests', methods=['GET','POST'])
 @login_required
 @admin_permission.require(http_exception=403)
@@ -406,30 +573,31 @@ def signuprequests_admin():
 
 
     """Logged-in Admin List of Users."""
-    
-    # User objects list which includes list of all users which can be broken down into editors and sponsors
-    # get all users
-    user_objects=db.session.query(User.id,User.email,User.user_type,User.user_status,User.name,User.organization).\
-    order_by(User.id)
-
-    # get a count of the user objects
-    user_count = user_objects.count()
-    
-    # blank list to append to
-    user_list=[]
-
-    # loop through user objects
-    for counter in range(0,user_count):
-        user_list.append(user_objects[counter])
 
-    # show list of document names
-    users = user_list
+    # ?user_type= narrows the view down to one section, cursors only make sense within it
+    user_type = request.args.get('user_type')
+    paging = page_args()
+
+    sections = []
+    for status, section_type in SIGNUPREQUESTS_SECTIONS:
+        if user_type is not None and user_type != section_type:
+            continue
+        # each section is its own filtered, indexed query, one page long
+        user_objects = users_section_query(section_type, status)
+        sections.append({
+            'title': 'Pending %ss' % section_type.capitalize(),
+            'filters': {'user_type': section_type},
+            # only queried when the cached sections are missing or outdated
+            'users': Lazy(paginate_keyset, user_objects, User.id, 'id', **paging),
+            'total': Lazy(section_total, section_type, status)
+        })
 
     """Logged-in User Dashboard."""
     return render_template(
         'signuprequests_admin.jinja2',
         title='Signup Requests Dashboard',
-        users=users
+        sections=sections,
+        fragment_key=fragment_cache.key('signuprequests_admin', 'users', user_type=user_type, **paging)
     )
 
 @admin_bp.route('/admin/usersview', methods=['GET','POST'])
@@ -438,33 +606,78 @@ def signuprequests_admin():
 def usersview_admin():
 
     """Logged-in Admin List of Users."""
-    
-    # User objects list which includes list of all users which can be broken down into editors and sponsors
-    # get all users
-    user_objects=db.session.query(User.id,User.email,User.user_type,User.user_status,User.name,User.organization).\
-    order_by(User.id)
-
-    # get a count of the user objects
-    user_count = user_objects.count()
-    
-    # blank list to append to
-    user_list=[]
 
-    # loop through user objects
-    for counter in range(0,user_count):
-        user_list.append(user_objects[counter])
-
-    # show list of document names
-    users = user_list
+    # ?user_type= and ?user_status= narrow the view down to matching sections
+    user_type = request.args.get('user_type')
+    user_status = request.args.get('user_status')
+    # cursors only make sense within a single section
+    paging = page_args()
+
+    sections = []
+    for group, status, section_type in USERSVIEW_SECTIONS:
+        if user_type is not None and user_type != section_type:
+            continue
+        if user_status is not None and user_status != status:
+            continue
+
+        # each section is its own filtered, indexed query, one page long
+        user_objects = users_section_query(section_type, status)
+
+        sections.append({
+            'group': group,
+            'title': '%s %ss' % (group, section_type.capitalize()),
+            'filters': {'user_type': section_type, 'user_status': status},
+            # only queried when the cached sections are missing or outdated
+            'users': Lazy(paginate_keyset, user_objects, User.id, 'id', **paging),
+            'total': Lazy(section_total, section_type, status)
+        })
 
     """Logged-in User Dashboard."""
     return render_template(
         'usersview_admin.jinja2',
-        users=users
+        sections=sections,
+        fragment_key=fragment_cache.key('usersview_admin', 'users', user_type=user_type, user_status=user_status, **paging)
     )
 
 
-@admin_bp.route('/admin/userapprove/<user_id>', methods=['GET','POST'])
+@admin_bp.route('/admin/analytics', methods=['GET'])
+@login_required
+@admin_permission.require(http_exception=403)
+def analytics_admin():
+    """
+    User counts, signup trends and the users view sections, as JSON.
+
+    counts groups users by user_type, user_status and organization,
+    signups buckets the users created in the last ?days= days by ?bucket=
+    day, week or month. Both come from one GROUP BY, reused for
+    ADMIN_ANALYTICS_TTL seconds. Each section carries its total and one
+    page of its users from its own indexed queries, never cached, ?after= /
+    ?before= / ?per_page= page them.
+    """
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in BUCKETS:
+        return jsonify(error='bucket must be one of %s' % ', '.join(BUCKETS)), 400
+    days = request.args.get('days', type=int) or current_app.config['ADMIN_ANALYTICS_DAYS']
+    days = max(1, min(days, 3660))
+    analytics = cached_user_analytics(bucket, days, current_app.config['ADMIN_ANALYTICS_TTL'])
+
+    paging = page_args()
+    sections = []
+    for group, status, section_type in USERSVIEW_SECTIONS:
+        page = paginate_keyset(users_section_query(section_type, status), User.id, 'id', **paging)
+        sections.append({
+            'title': '%s %ss' % (group, section_type.capitalize()),
+            'user_type': section_type,
+            'user_status': status,
+            'total': section_total(section_type, status),
+            'users': [row._asdict() for row in page],
+            'next_cursor': page.next_cursor,
+            'prev_cursor': page.prev_cursor
+        })
+    return jsonify(dict(analytics, sections=sections))
+
+
+@admin_bp.route('/admin/userapprove/<int:user_id>', methods=['GET','POST'])
 @login_required
 @admin_permission.require(http_exception=403)
 def userapprove_admin(user_id):
@@ -472,34 +685,58 @@ def userapprove_admin(user_id):
     """Logged-in Admin List of Users."""
     # take the supplied user_id and use that to access a given user.
 
-    # User objects list which includes list of all users which can be broken down into editors and sponsors
-    # get individual user
-    user = db.session.query(User).filter(User.id==user_id).first() 
-    # update status to approved
-    user.user_status = 'approved'
-    # commit to database
-    db.session.commit()
+    # update status to approved with a single UPDATE, no select first
+    set_user_status('approved', user_ids=[user_id])
 
     return redirect(url_for('admin_bp.usersview_admin'))    
 
 
-@admin_bp.route('/admin/userreject/<user_id>', methods=['GET','POST'])
+@admin_bp.route('/admin/userreject/<int:user_id>', methods=['GET','POST'])
 @login_required
 @admin_permission.require(http_exception=403)
 def userreject_admin(user_id):
     """Logged-in Admin List of Users."""
 
-    # User objects list which includes list of all users which can be broken down into editors and sponsors
-    # get individual user
-    user = db.session.query(User).filter(User.id==user_id).first() 
-    # update status to approved
-    user.user_status = 'rejected'
-    # commit to database
-    db.session.commit()
+    # update status to rejected with a single UPDATE, no select first
+    set_user_status('rejected', user_ids=[user_id])
 
     return redirect(url_for('admin_bp.usersview_admin'))
 
 
+@admin_bp.route('/admin/userstatus', methods=['POST'])
+@login_required
+@admin_permission.require(http_exception=403)
+def userstatus_admin():
+    """
+    Bulk user status change.
+
+    POST a JSON body {"user_status": "approved", "user_ids": [...]} and/or
+    {"filter": {"user_type", "user_status", "organization"}}. Every matching
+    user is updated by one UPDATE statement.
+    """
+    payload = request.get_json(silent=True) or {}
+    new_status = payload.get('user_status')
+    user_ids = payload.get('user_ids')
+    selection = payload.get('filter') or {}
+
+    # validate the request before touching the database
+    if new_status not in USER_STATUSES:
+        return jsonify(error='user_status must be one of %s' % ', '.join(USER_STATUSES)), 400
+    if user_ids is not None and not (isinstance(user_ids, list) and all(isinstance(user_id, int) for user_id in user_ids)):
+        return jsonify(error='user_ids must be a list of integers'), 400
+    if not isinstance(selection, dict) or set(selection) - set(['user_type', 'user_status', 'organization']):
+        return jsonify(error='filter accepts user_type, user_status and organization'), 400
+    # a null filter value would select nothing, and a list or object is no column value
+    if not all(isinstance(value, str) and value for value in selection.values()):
+        return jsonify(error='filter values must be non-empty strings'), 400
+    if user_ids is None and not selection:
+        return jsonify(error='user_ids or filter is required'), 400
+
+    updated_ids = set_user_status(new_status, user_ids=user_ids, **selection)
+
+    return jsonify(updated=len(updated_ids), user_ids=updated_ids, user_status=new_status)
+
+
 # ---------- Page Access Restrictions ----------
 
 # ---------- Error Handling ----------
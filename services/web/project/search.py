@@ -0,0 +1,224 @@
+"""Full-text search over document names and bodies, scoped by retention."""
+from collections import Counter
+import re
+
+from flask import request
+from sqlalchemy import case, distinct, false, func, literal, text
+
+from . import db, body_store
+from .models import Document, DocumentSearch, DocumentSearchTerm
+
+# fields of the inverted index
+NAME = 'n'
+BODY = 'b'
+# longer words are cut, they still match on their first characters
+MAX_TERM_LENGTH = 64
+# longest search accepted, in characters
+MAX_QUERY_LENGTH = 200
+
+WORD = re.compile(r'\w+')
+
+
+class SearchPage(object):
+    """One page of ranked search results, numbered from 1."""
+
+    def __init__(self, items, page, per_page, has_next):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.has_next = has_next
+
+    @property
+    def next_page(self):
+        return self.page + 1 if self.has_next else None
+
+    @property
+    def prev_page(self):
+        return self.page - 1 if self.page > 1 else None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class SearchIndex(object):
+    """Full-text index of document names and bodies.
+
+    On postgresql each document has a tsvector in document_search, name
+    lexemes weighted A and body lexemes B, matched with
+    websearch_to_tsquery through a GIN index and ranked with ts_rank_cd.
+    Elsewhere the index is the inverted index of document_search_terms,
+    words are split out in this process, a document matches when it has
+    every word of the search and ranks by occurrences, a name occurrence
+    counting SEARCH_NAME_WEIGHT times.
+
+    search() adds the match and the rank to a document list query, which
+    already joins the caller's retentions, so results come back matched,
+    scoped, ranked and paged by a single statement. A save re-indexes only
+    the fields it changed, bodies up to SEARCH_BODY_LIMIT characters.
+    """
+
+    def __init__(self, app=None):
+        self.language = 'english'
+        self.body_limit = 500000
+        self.name_weight = 10
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # text search configuration of to_tsvector, postgresql only
+        self.language = app.config.get('SEARCH_LANGUAGE', self.language)
+        self.body_limit = app.config.get('SEARCH_BODY_LIMIT', self.body_limit)
+        self.name_weight = app.config.get('SEARCH_NAME_WEIGHT', self.name_weight)
+
+    @property
+    def uses_tsvector(self):
+        return db.engine.dialect.name == 'postgresql'
+
+    # ---------- indexing ----------
+
+    def update(self, document_id, document_name=None, body=None):
+        """Re-index the name and the body of a document.
+
+        None leaves that field as it was indexed. Runs in the current
+        transaction, the caller commits.
+        """
+        if document_name is None and body is None:
+            return
+        if body is not None:
+            body = body[:self.body_limit]
+        if self.uses_tsvector:
+            self._update_vector(document_id, document_name, body)
+        else:
+            self._update_terms(document_id, document_name, body)
+
+    def update_many(self, documents, batch_size=500):
+        """Index new documents, a list of (document_id, document_name, body)."""
+        if self.uses_tsvector:
+            statement = text(
+                "INSERT INTO document_search (document_id, search_vector) VALUES (:document_id, "
+                "setweight(to_tsvector(:language, :document_name), 'A') || "
+                "setweight(to_tsvector(:language, :body), 'B')) "
+                "ON CONFLICT (document_id) DO UPDATE SET search_vector = EXCLUDED.search_vector"
+            )
+            for start in range(0, len(documents), batch_size):
+                db.session.execute(statement, [
+                    {'document_id': document_id, 'language': self.language,
+                     'document_name': document_name or '', 'body': (body or '')[:self.body_limit]}
+                    for document_id, document_name, body in documents[start:start + batch_size]
+                ])
+            return
+        rows = []
+        for document_id, document_name, body in documents:
+            rows.extend(_term_rows(document_id, NAME, document_name or ''))
+            rows.extend(_term_rows(document_id, BODY, (body or '')[:self.body_limit]))
+            if len(rows) >= batch_size:
+                db.session.execute(DocumentSearchTerm.__table__.insert(), rows)
+                rows = []
+        if rows:
+            db.session.execute(DocumentSearchTerm.__table__.insert(), rows)
+
+    def stored_body(self, document_id):
+        """The stored body, as much of it as is indexed, read chunk by chunk."""
+        parts = []
+        length = 0
+        for chunk in body_store.chunks(document_id):
+            parts.append(chunk.decode('utf-8'))
+            length += len(parts[-1])
+            if length >= self.body_limit:
+                break
+        return ''.join(parts)[:self.body_limit]
+
+    def _update_vector(self, document_id, document_name, body):
+        vectors = []
+        kept = []
+        if document_name is not None:
+            vectors.append("setweight(to_tsvector(:language, :document_name), 'A')")
+        else:
+            kept.append('a')
+        if body is not None:
+            vectors.append("setweight(to_tsvector(:language, :body), 'B')")
+        else:
+            kept.append('b')
+        replacement = 'EXCLUDED.search_vector'
+        if kept:
+            # lexemes of the unchanged field are kept, told apart by their weight
+            replacement += " || ts_filter(document_search.search_vector, '{%s}')" % ','.join(kept)
+        db.session.execute(text(
+            'INSERT INTO document_search (document_id, search_vector) VALUES (:document_id, %s) '
+            'ON CONFLICT (document_id) DO UPDATE SET search_vector = %s' % (' || '.join(vectors), replacement)
+        ), {'document_id': document_id, 'language': self.language, 'document_name': document_name, 'body': body})
+
+    def _update_terms(self, document_id, document_name, body):
+        fields = []
+        if document_name is not None:
+            fields.append((NAME, document_name))
+        if body is not None:
+            fields.append((BODY, body))
+        terms = DocumentSearchTerm.__table__
+        db.session.execute(
+            terms.delete().where(terms.c.document_id == document_id)
+            .where(terms.c.field.in_([field for field, value in fields]))
+        )
+        rows = []
+        for field, value in fields:
+            rows.extend(_term_rows(document_id, field, value))
+        if rows:
+            db.session.execute(terms.insert(), rows)
+
+    # ---------- searching ----------
+
+    def search(self, query, terms):
+        """query narrowed to the documents matching terms, best first.
+
+        query selects from a document list, Document joined to the
+        caller's retentions. A rank column is added to each row.
+        """
+        if self.uses_tsvector:
+            tsquery = func.websearch_to_tsquery(self.language, terms)
+            rank = func.ts_rank_cd(DocumentSearch.search_vector, tsquery)
+            query = query.join(DocumentSearch, DocumentSearch.document_id == Document.id).\
+                filter(DocumentSearch.search_vector.op('@@')(tsquery))
+        else:
+            words = sorted(set(tokenize(terms)))
+            if not words:
+                return query.add_columns(literal(0).label('rank')).filter(false())
+            weight = case([(DocumentSearchTerm.field == NAME, self.name_weight)], else_=1)
+            # documents holding every word, with their weighted occurrences
+            matches = db.session.query(
+                DocumentSearchTerm.document_id.label('document_id'),
+                func.sum(DocumentSearchTerm.count * weight).label('rank')
+            ).filter(DocumentSearchTerm.term.in_(words)).\
+                group_by(DocumentSearchTerm.document_id).\
+                having(func.count(distinct(DocumentSearchTerm.term)) == len(words)).subquery()
+            rank = matches.c.rank
+            query = query.join(matches, matches.c.document_id == Document.id)
+        rank = rank.label('rank')
+        # ordered by the label, the rank is computed once per row
+        return query.add_columns(rank).order_by(rank.desc(), Document.id)
+
+    def page(self, query, terms, page=1, per_page=50):
+        """SearchPage of the documents of query matching terms."""
+        rows = self.search(query, terms).limit(per_page + 1).offset((page - 1) * per_page).all()
+        return SearchPage(rows[:per_page], page, per_page, len(rows) > per_page)
+
+
+def tokenize(value):
+    """Lowercased words of value, cut to MAX_TERM_LENGTH characters."""
+    return [word[:MAX_TERM_LENGTH] for word in WORD.findall(value.lower())]
+
+
+def _term_rows(document_id, field, value):
+    return [
+        {'term': term, 'document_id': document_id, 'field': field, 'count': count}
+        for term, count in Counter(tokenize(value)).items()
+    ]
+
+
+def search_args():
+    """Read q and page from the request query string, q is '' without a search."""
+    terms = (request.args.get('q') or '').strip()[:MAX_QUERY_LENGTH]
+    page = max(request.args.get('page', 1, type=int), 1)
+    return terms, page
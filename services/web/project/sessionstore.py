@@ -0,0 +1,561 @@
+"""Server-side sessions and cached user snapshots on a pluggable backend."""
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import urlparse
+import hashlib
+import json
+import logging
+import os
+import secrets
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+
+from flask import has_request_context, session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from flask_login import user_logged_in
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+logger = logging.getLogger(__name__)
+
+
+# ---------- backends, bytes in and out, every entry has a ttl ----------
+
+class MemoryBackend(object):
+    """Bounded LRU in the worker process, only for a single worker."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def incr(self, key, amount=1):
+        """Add amount to an integer value, keeping its expiry, a missing key counts from 0."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                value, expires = 0, time.monotonic() + 365 * 86400
+            else:
+                value, expires = int(entry[0]), entry[1]
+            value += amount
+            self._entries[key] = (str(value).encode('ascii'), expires)
+            self._entries.move_to_end(key)
+            return value
+
+    def expire(self, key, ttl):
+        """Give an existing key a new ttl, returns False when there is no such key."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                return False
+            self._entries[key] = (entry[0], time.monotonic() + ttl)
+            return True
+
+
+class FilesystemBackend(object):
+    """One file per key in a directory, shared by the workers of a host."""
+
+    # expired files are swept once every this many writes
+    SWEEP_EVERY = 1000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as source:
+                expires = float(source.readline())
+                value = source.read()
+        except (OSError, ValueError):
+            return None
+        if expires < time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        # write then rename, readers never see a partial file
+        handle, temporary = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(handle, 'wb') as output:
+            output.write(('%f\n' % (time.time() + ttl)).encode('ascii'))
+            output.write(value)
+        os.replace(temporary, self._path(key))
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            self.sweep()
+
+    def delete(self, *keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def sweep(self):
+        """Remove every expired file."""
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'rb') as source:
+                    expires = float(source.readline())
+                if expires < now:
+                    os.remove(path)
+            except (OSError, ValueError):
+                continue
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+
+
+class RedisError(Exception):
+    """Error reply from a Redis protocol server."""
+
+
+class RedisBackend(object):
+    """Minimal Redis protocol client, GET, SET EX and DEL, any other command through command().
+
+    Works with Redis, Valkey, KeyDB or LocalRespServer. One connection per
+    thread, reconnected once when a command fails on a dropped connection.
+    """
+
+    def __init__(self, url, timeout=1.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.strip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._local.sock = sock
+        self._local.reader = sock.makefile('rb')
+        # forked workers must not share the parent's socket
+        self._local.pid = os.getpid()
+        if self.password:
+            self._send('AUTH', self.password)
+        if self.db:
+            self._send('SELECT', self.db)
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self._local.sock = None
+
+    def _send(self, *args):
+        return self._send_many([args])[0]
+
+    def _send_many(self, commands):
+        parts = []
+        for args in commands:
+            parts.append(b'*%d\r\n' % len(args))
+            for arg in args:
+                if not isinstance(arg, bytes):
+                    arg = str(arg).encode('utf-8')
+                parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self._local.sock.sendall(b''.join(parts))
+        # every reply is read, so an error reply leaves the connection in step
+        replies = []
+        for args in commands:
+            try:
+                replies.append(_read_reply(self._local.reader))
+            except RedisError as error:
+                replies.append(error)
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def command(self, *args):
+        return self.pipeline(args)[0]
+
+    def pipeline(self, *commands):
+        """Send several commands in one round trip, returns their replies in order."""
+        for attempt in (1, 2):
+            if getattr(self._local, 'sock', None) is None or self._local.pid != os.getpid():
+                self._connect()
+            try:
+                return self._send_many(commands)
+            except (OSError, EOFError):
+                self._close()
+                if attempt == 2:
+                    raise
+
+    def get(self, key):
+        return self.command('GET', key)
+
+    def set(self, key, value, ttl):
+        self.command('SET', key, value, 'EX', max(1, int(ttl)))
+
+    def delete(self, *keys):
+        if keys:
+            self.command('DEL', *keys)
+
+    def clear(self):
+        self.command('FLUSHDB')
+
+
+def _read_reply(reader):
+    line = reader.readline()
+    if not line:
+        raise EOFError('connection closed')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest.decode('utf-8')
+    if kind == b'-':
+        raise RedisError(rest.decode('utf-8'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        count = int(rest)
+        if count < 0:
+            return None
+        return [_read_reply(reader) for n in range(count)]
+    raise RedisError('unexpected reply %r' % line)
+
+
+class LocalRespServer(socketserver.ThreadingTCPServer):
+    """Redis protocol stand-in backed by MemoryBackend, for development.
+
+    Understands PING, GET, SET with EX, DEL, INCR, DECR, PEXPIRE, SELECT,
+    AUTH and FLUSHDB, enough for RedisBackend and the rate limiter's
+    counters. Run it with manage.py session_standin.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), _RespHandler)
+        self.backend = MemoryBackend(maxsize=1000000)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'redis://%s:%d/0' % (host, port)
+
+    def start(self):
+        """Serve on a daemon thread, returns the url to connect to."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.url
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                args = _read_reply(self.rfile)
+            except (EOFError, OSError, RedisError, ValueError):
+                return
+            self.wfile.write(self.server_reply(args))
+
+    def server_reply(self, args):
+        backend = self.server.backend
+        command = args[0].upper() if args else b''
+        if command == b'PING':
+            return b'+PONG\r\n'
+        if command in (b'SELECT', b'AUTH'):
+            return b'+OK\r\n'
+        if command == b'GET':
+            value = backend.get(args[1])
+            return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+        if command == b'SET':
+            ttl = 365 * 86400
+            if len(args) >= 5 and args[3].upper() == b'EX':
+                ttl = int(args[4])
+            backend.set(args[1], args[2], ttl)
+            return b'+OK\r\n'
+        if command == b'DEL':
+            found = sum(1 for key in args[1:] if backend.get(key) is not None)
+            backend.delete(*args[1:])
+            return b':%d\r\n' % found
+        if command in (b'INCR', b'DECR'):
+            try:
+                value = backend.incr(args[1], 1 if command == b'INCR' else -1)
+            except ValueError:
+                return b'-ERR value is not an integer or out of range\r\n'
+            return b':%d\r\n' % value
+        if command == b'PEXPIRE':
+            return b':%d\r\n' % backend.expire(args[1], int(args[2]) / 1000.0)
+        if command == b'FLUSHDB':
+            backend.clear()
+            return b'+OK\r\n'
+        return b'-ERR unknown command\r\n'
+
+
+def make_backend(name, app):
+    """Backend named by SESSION_BACKEND, cookie sessions keep snapshots in memory."""
+    if name in ('memory', 'cookie'):
+        return MemoryBackend(app.config.get('SESSION_STORE_SIZE', 10000))
+    if name == 'filesystem':
+        directory = app.config.get('SESSION_FILE_DIR') or os.path.join(tempfile.gettempdir(), 'project-sessions')
+        return FilesystemBackend(directory)
+    if name == 'redis':
+        return RedisBackend(app.config.get('SESSION_REDIS_URL', 'redis://localhost:6379/0'))
+    raise ValueError('unknown SESSION_BACKEND %r, expected cookie, memory, filesystem or redis' % name)
+
+
+# ---------- server-side sessions ----------
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dict whose contents live in the store, the cookie only holds sid."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps session data in a backend under session:<sid>.
+
+    The cookie carries a random session id signed with SECRET_KEY. Data is
+    written back only when the session was modified, sessions that are not
+    permanent expire SESSION_STORE_TTL seconds after the last write.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='server-side-session')
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        signed = request.cookies.get(app.session_cookie_name)
+        if signed:
+            try:
+                sid = self._signer(app).unsign(signed).decode('ascii')
+            except BadSignature:
+                sid = None
+            if sid is not None:
+                data = self.backend.get('session:' + sid)
+                if data is not None:
+                    return ServerSideSession(self.serializer.loads(data.decode('utf-8')), sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                # emptied, by logout for example, drop the stored data and the cookie
+                self.backend.delete('session:' + session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        response.vary.add('Cookie')
+        if not session.modified:
+            return
+
+        if session.permanent:
+            ttl = app.permanent_session_lifetime.total_seconds()
+        else:
+            ttl = self.ttl
+        self.backend.set('session:' + session.sid, self.serializer.dumps(dict(session)).encode('utf-8'), ttl)
+        response.set_cookie(
+            app.session_cookie_name,
+            self._signer(app).sign(session.sid.encode('ascii')).decode('ascii'),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+
+# ---------- user snapshots ----------
+
+class UserSnapshot(object):
+    """Read-only copy of the User columns a request needs, used as current_user."""
+
+    FIELDS = ('id', 'name', 'email', 'user_type', 'user_status', 'organization')
+    __slots__ = FIELDS
+
+    def __init__(self, **values):
+        for field in self.FIELDS:
+            object.__setattr__(self, field, values.get(field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('UserSnapshot is read-only, load the User to change it')
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(**dict((field, getattr(user, field)) for field in cls.FIELDS))
+
+    def to_json(self):
+        return json.dumps(dict((field, getattr(self, field)) for field in self.FIELDS)).encode('utf-8')
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**json.loads(data.decode('utf-8')))
+
+    # flask_login user interface, same answers as User
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, UserSnapshot) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return '<UserSnapshot %s %s>' % (self.id, self.user_type)
+
+
+class SessionStore(object):
+    """Server-side sessions and user snapshots on one backend.
+
+    SESSION_BACKEND picks cookie (Flask's signed cookie sessions, snapshots
+    in process memory), memory, filesystem or redis. Snapshots are kept for
+    USER_SNAPSHOT_TTL seconds under user:<id>, and dropped on logout and
+    whenever the user's status or type is committed. shared tells whether
+    other processes, the job worker included, see the same backend.
+    """
+
+    def __init__(self, app=None):
+        self.backend = MemoryBackend()
+        self.shared = False
+        self.snapshot_ttl = 60
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config.get('SESSION_BACKEND', 'cookie')
+        self.backend = make_backend(name, app)
+        self.shared = name in ('filesystem', 'redis')
+        self.snapshot_ttl = app.config.get('USER_SNAPSHOT_TTL', self.snapshot_ttl)
+        if name != 'cookie':
+            app.session_interface = ServerSideSessionInterface(self.backend, app.config.get('SESSION_STORE_TTL', 86400))
+        # a session id set before the login must not carry the logged in session
+        user_logged_in.connect(self._logged_in, app)
+
+    def _logged_in(self, app, user=None, **extra):
+        self.rotate()
+
+    def get_user(self, user_id):
+        """Cached snapshot of user_id, or None on a miss."""
+        if self.snapshot_ttl <= 0:
+            return None
+        try:
+            data = self.backend.get('user:%s' % user_id)
+        except (OSError, EOFError, RedisError):
+            # an unreachable store only costs the database query
+            logger.warning('user snapshot store unavailable', exc_info=True)
+            return None
+        return UserSnapshot.from_json(data) if data is not None else None
+
+    def set_user(self, snapshot):
+        if self.snapshot_ttl <= 0:
+            return
+        try:
+            self.backend.set('user:%s' % snapshot.id, snapshot.to_json(), self.snapshot_ttl)
+        except (OSError, EOFError, RedisError):
+            logger.warning('user snapshot store unavailable', exc_info=True)
+
+    def invalidate(self, *user_ids):
+        """Drop the snapshots of the given users."""
+        keys = ['user:%s' % user_id for user_id in user_ids if user_id is not None]
+        try:
+            self.backend.delete(*keys)
+        except (OSError, EOFError, RedisError):
+            logger.warning('user snapshot store unavailable', exc_info=True)
+
+    def clear(self):
+        """Drop every session and snapshot, for reseeded databases."""
+        self.backend.clear()
+
+    def revoke(self, user_id):
+        """Drop the user's snapshot and the stored data of the current session.
+
+        The session gets a fresh id, so the old cookie no longer resolves to
+        anything even if it was copied.
+        """
+        self.invalidate(user_id)
+        self.rotate()
+
+    def rotate(self):
+        """Move the data of the current server-side session to a fresh id.
+
+        The data under the old id is dropped, a cookie holding it no
+        longer resolves to anything. Cookie sessions are left alone.
+        """
+        if not has_request_context():
+            return
+        current = session._get_current_object()
+        if isinstance(current, ServerSideSession):
+            self.backend.delete('session:' + current.sid)
+            current.sid = secrets.token_urlsafe(32)
+            current.modified = True
@@ -0,0 +1,159 @@
+"""Static file serving ahead of Flask, with ETags, ranges, sendfile and precompressed variants."""
+from datetime import datetime
+from threading import Lock
+import hashlib
+import mimetypes
+import os
+
+from werkzeug.http import http_date, is_resource_modified, parse_range_header
+from werkzeug.security import safe_join
+from werkzeug.wrappers import Request, Response
+from werkzeug.wsgi import wrap_file
+
+from .assets import FINGERPRINTED, IMMUTABLE_MAX_AGE
+
+# Content-Encoding of each precompressed sibling, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# bytes read per chunk when a range is streamed without sendfile
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+class StaticFiles(object):
+    """WSGI layer serving the static folder before the request reaches Flask.
+
+    Static requests skip sessions, user loading, identity and the request
+    hooks, and never touch the database. Whole files are handed to the
+    server's wsgi.file_wrapper, which gunicorn sends with sendfile(2).
+    Responses carry a strong ETag, the hash of the bytes sent, and answer
+    If-None-Match and If-Modified-Since with 304 and single byte ranges
+    with 206. A .br or .gz sibling written by manage.py build_assets is sent
+    instead when Accept-Encoding allows it.
+
+    The app keeps its own static route, url_for('static', ...) builds the
+    same urls, and serves them when STATIC_MIDDLEWARE is off.
+    """
+
+    def __init__(self, app=None):
+        self._etags = {}
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.static_folder
+        self.prefix = app.static_url_path.rstrip('/') + '/'
+        self.max_age = app.config.get('STATIC_MAX_AGE', 43200)
+        if app.config.get('STATIC_MIDDLEWARE', True):
+            self.wrapped = app.wsgi_app
+            app.wsgi_app = self
+
+    def __call__(self, environ, start_response):
+        path_info = environ.get('PATH_INFO', '')
+        if not path_info.startswith(self.prefix) or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self.wrapped(environ, start_response)
+        filename = path_info[len(self.prefix):]
+        path = safe_join(self.directory, filename)
+        if path is None or not os.path.isfile(path):
+            # let flask answer with its usual 404 page
+            return self.wrapped(environ, start_response)
+        return self.respond(Request(environ), filename, path)(environ, start_response)
+
+    def respond(self, request, filename, path):
+        """Response for one static file, conditional and ranged as requested."""
+        encoding, served = self._negotiate(request, path)
+        stat = os.stat(served)
+        etag = self._etag(served, stat)
+
+        headers = {
+            'Content-Type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            'ETag': '"%s"' % etag,
+            'Last-Modified': http_date(stat.st_mtime),
+            'Accept-Ranges': 'bytes'
+        }
+        if FINGERPRINTED.match(filename):
+            # the name changes whenever the content does
+            headers['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        else:
+            headers['Cache-Control'] = 'public, max-age=%d' % self.max_age
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        if self._has_variants(path):
+            headers['Vary'] = 'Accept-Encoding'
+
+        last_modified = datetime.utcfromtimestamp(int(stat.st_mtime))
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return Response(status=304, headers=headers)
+
+        size = stat.st_size
+        byte_range = self._range(request, etag, size)
+        if byte_range == 'unsatisfiable':
+            headers['Content-Range'] = 'bytes */%d' % size
+            return Response(status=416, headers=headers)
+
+        if request.method == 'HEAD':
+            headers['Content-Length'] = str(size)
+            return Response(status=200, headers=headers)
+
+        if byte_range is None:
+            headers['Content-Length'] = str(size)
+            # the server's file wrapper, sendfile(2) under gunicorn
+            body = wrap_file(request.environ, open(served, 'rb'))
+            return Response(body, status=200, headers=headers, direct_passthrough=True)
+
+        start, stop = byte_range
+        headers['Content-Length'] = str(stop - start)
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        return Response(_read_range(served, start, stop), status=206, headers=headers, direct_passthrough=True)
+
+    def _negotiate(self, request, path):
+        """(Content-Encoding or None, path of the file to send)."""
+        for encoding, suffix in ENCODINGS:
+            if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+                return encoding, path + suffix
+        return None, path
+
+    def _has_variants(self, path):
+        return any(os.path.isfile(path + suffix) for encoding, suffix in ENCODINGS)
+
+    def _range(self, request, etag, size):
+        """(start, stop) of a single satisfiable range, 'unsatisfiable', or None for the whole file."""
+        ranges = parse_range_header(request.headers.get('Range'))
+        if ranges is None or len(ranges.ranges) != 1:
+            # absent, malformed or multipart, send everything
+            return None
+        if_range = request.headers.get('If-Range')
+        if if_range is not None and if_range.strip() != '"%s"' % etag:
+            # the client's copy is outdated, it needs the whole file
+            return None
+        byte_range = ranges.range_for_length(size)
+        if byte_range is None:
+            return 'unsatisfiable'
+        return byte_range
+
+    def _etag(self, path, stat):
+        """Content hash of path, recomputed only when size or mtime change."""
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._etags.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(RANGE_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        etag = digest.hexdigest()
+        with self._lock:
+            self._etags[path] = (key, etag)
+        return etag
+
+
+def _read_range(path, start, stop):
+    with open(path, 'rb') as source:
+        source.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = source.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
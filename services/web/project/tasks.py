@@ -0,0 +1,88 @@
+"""Side effects of signups and status changes, queued by requests and run by manage.py worker."""
+import logging
+
+from flask import current_app
+
+from . import db, job_queue, session_store
+from .analytics import refresh_user_analytics
+from .models import User
+
+# notifications are delivered as records of this logger, the one place a mailer plugs in
+notifications = logging.getLogger('project.notifications')
+
+# subject and body of the notification sent for each new user_status
+STATUS_MESSAGES = {
+    'approved': ('Your account has been approved', 'You can now log in and use your %s account.'),
+    'rejected': ('Your account request was not approved', 'Your %s account request was reviewed and not approved.'),
+    'pending': ('Your account is waiting for approval', 'Your %s account is waiting for an admin to approve it.'),
+}
+
+
+# ---------- queueing, in the caller's transaction ----------
+
+def enqueue_signup(user_id):
+    """Queue the side effects of a new signup, user_id must already be flushed."""
+    job_queue.enqueue('signup_created', {'user_id': user_id})
+    enqueue_analytics_refresh()
+
+
+def enqueue_status_change(user_ids, user_status):
+    """Queue the side effects of user_status being set on user_ids."""
+    if not user_ids:
+        return
+    job_queue.enqueue('user_status_changed', {'user_ids': sorted(user_ids), 'user_status': user_status})
+    enqueue_analytics_refresh()
+
+
+def enqueue_analytics_refresh():
+    """Queue a refresh of the cached admin analytics, once until it runs.
+
+    The worker is a process of its own, with the cookie and memory
+    backends its cache is not the one the web workers read, so nothing is
+    queued for them.
+    """
+    if session_store.shared:
+        job_queue.enqueue('refresh_user_analytics', unique=True)
+
+
+# ---------- handlers ----------
+
+@job_queue.handler('notify')
+def notify(email, subject, body):
+    """Deliver one notification."""
+    notifications.info(subject, extra={'to': email, 'body': body})
+
+
+@job_queue.handler('signup_created')
+def signup_created(user_id):
+    """Tell every admin about a signup waiting for approval, one notify job each."""
+    user = db.session.query(User.name, User.email, User.user_type, User.organization).\
+        filter(User.id == user_id).first()
+    if user is None:
+        # deleted before the job ran
+        return
+    subject = 'New %s signup waiting for approval' % user.user_type
+    body = '%s <%s> of %s signed up, their %s account is waiting for approval.' % (
+        user.name, user.email, user.organization, user.user_type)
+    for (email,) in db.session.query(User.email).filter(User.user_type == 'admin'):
+        job_queue.enqueue('notify', {'email': email, 'subject': subject, 'body': body})
+
+
+@job_queue.handler('user_status_changed')
+def user_status_changed(user_ids, user_status):
+    """Tell each user about their new status, one notify job each."""
+    message = STATUS_MESSAGES.get(user_status)
+    if message is None:
+        return
+    subject, body = message
+    rows = db.session.query(User.email, User.user_type, User.user_status).filter(User.id.in_(user_ids))
+    for email, user_type, current_status in rows:
+        # changed again before the job ran, that change queued its own job
+        if current_status == user_status:
+            job_queue.enqueue('notify', {'email': email, 'subject': subject, 'body': body % user_type})
+
+
+@job_queue.handler('refresh_user_analytics')
+def refresh_analytics():
+    """Recompute the cached admin analytics, so the next admin page finds them warm."""
+    refresh_user_analytics('day', current_app.config['ADMIN_ANALYTICS_DAYS'], current_app.config['ADMIN_ANALYTICS_TTL'])
@@ -0,0 +1,209 @@
+"""Template bytecode cache, precompilation and per-user fragment caching."""
+import os
+import secrets
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .models import User, Document, Retention
+from .identitycache import _retention_user_ids
+
+
+def precompile_templates(app):
+    """Compile every template of the app and its blueprints.
+
+    Compiled templates land in the bytecode cache, when one is configured,
+    and in the in-memory template cache of this process. Returns the
+    number of templates compiled.
+    """
+    names = app.jinja_env.list_templates(extensions=['jinja2'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache key %}...{% endcache %}, the block is rendered once per key.
+
+    A None key renders the block every time. The body is skipped on a hit,
+    so anything it reads, lazy query results included, is never evaluated.
+    """
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = parser.parse_expression()
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_cached', [key]), [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key, caller):
+        cache = getattr(self.environment, 'fragment_cache', None)
+        if key is None or cache is None:
+            return caller()
+        html = cache.get(key)
+        if html is None:
+            html = caller()
+            cache.set(key, html)
+        return Markup(html)
+
+
+class Lazy(object):
+    """Runs function(*args, **kwargs) the first time the value is used.
+
+    Views pass list pages wrapped in Lazy, a cached fragment never touches
+    them and their query is never sent.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        self._call = (function, args, kwargs)
+        self._value = None
+        self._loaded = False
+
+    def _get(self):
+        if not self._loaded:
+            function, args, kwargs = self._call
+            self._value = function(*args, **kwargs)
+            self._loaded = True
+        return self._value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._get(), name)
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+    def __bool__(self):
+        return bool(self._get())
+
+    def __str__(self):
+        return str(self._get())
+
+
+class FragmentCache(object):
+    """Rendered template fragments, keyed by scope and data version.
+
+    A scope is "user:<id>" for blocks that depend on one user's data, or
+    "users" for admin blocks over the whole users table. Each scope has a
+    version token, bumping it orphans every fragment cached under the old
+    token. Fragments and versions live on the session store backend, so
+    they are shared between workers with the filesystem and redis
+    backends; with a per-process backend other workers pick up changes
+    within FRAGMENT_CACHE_TTL seconds.
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.ttl = 60
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, backend=None):
+        self.ttl = app.config.get('FRAGMENT_CACHE_TTL', self.ttl)
+        self.backend = backend if app.config.get('FRAGMENT_CACHE_ENABLED', True) else None
+
+        # compiled templates are written to and read from TEMPLATE_BYTECODE_DIR
+        if app.config.get('TEMPLATE_BYTECODE_CACHE', True):
+            directory = app.config.get('TEMPLATE_BYTECODE_DIR')
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory or None)
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.fragment_cache = self
+
+    @property
+    def enabled(self):
+        return self.backend is not None and self.ttl > 0
+
+    def version(self, scope):
+        """Current version token of scope, a new one when there is none."""
+        token = self.backend.get('fragver:' + scope)
+        if token is None:
+            # never reuse a token, evicted versions must not revive old fragments
+            token = self._bump(scope)
+        return token.decode('ascii') if isinstance(token, bytes) else token
+
+    def _bump(self, scope):
+        token = secrets.token_hex(8)
+        # versions outlive the fragments cached under them
+        self.backend.set('fragver:' + scope, token.encode('ascii'), self.ttl * 10)
+        return token
+
+    def key(self, name, scope, **parts):
+        """Fragment key for template block name under scope, None when disabled.
+
+        parts are the request arguments the block depends on, page cursors
+        for example.
+        """
+        if not self.enabled:
+            return None
+        args = ','.join('%s=%s' % item for item in sorted(parts.items()))
+        return 'fragment:%s:%s:%s:%s' % (name, scope, self.version(scope), args)
+
+    def get(self, key):
+        html = self.backend.get(key)
+        return html.decode('utf-8') if html is not None else None
+
+    def set(self, key, html):
+        self.backend.set(key, str(html).encode('utf-8'), self.ttl)
+
+    def bump(self, *scopes):
+        """Give every scope a new version."""
+        if self.backend is not None:
+            for scope in scopes:
+                self._bump(scope)
+
+    def invalidate(self, *user_ids):
+        """Drop the fragments of the given users."""
+        self.bump(*['user:%s' % user_id for user_id in user_ids if user_id is not None])
+
+
+# ---------- invalidation ----------
+
+# key in session.info holding scopes to bump once the transaction commits
+_PENDING_KEY = 'fragment_cache_pending'
+
+
+def register_fragment_invalidation(cache):
+    """Bump scopes when users, retentions or retained documents change."""
+
+    @event.listens_for(Session, 'after_flush')
+    def collect_changed_scopes(session, flush_context):
+        pending = session.info.setdefault(_PENDING_KEY, set())
+        document_ids = set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Retention):
+                pending.update('user:%s' % user_id for user_id in _retention_user_ids(obj))
+            elif isinstance(obj, User):
+                if obj in session.new or obj in session.deleted or session.is_modified(obj):
+                    pending.update(('users', 'user:%s' % obj.id))
+            elif isinstance(obj, Document) and obj not in session.new:
+                if obj in session.deleted or session.is_modified(obj):
+                    document_ids.add(obj.id)
+        if document_ids:
+            # a changed document shows up in the lists of its sponsor and editor
+            retentions = Retention.__table__
+            rows = session.execute(
+                retentions.select().with_only_columns([retentions.c.sponsor_id, retentions.c.editor_id])
+                .where(retentions.c.document_id.in_(document_ids))
+            )
+            for row in rows:
+                pending.update('user:%s' % user_id for user_id in row if user_id is not None)
+
+    @event.listens_for(Session, 'after_commit')
+    def bump_changed_scopes(session):
+        pending = session.info.pop(_PENDING_KEY, None)
+        if pending:
+            cache.bump(*pending)
+
+    @event.listens_for(Session, 'after_rollback')
+    def discard_changed_scopes(session):
+        session.info.pop(_PENDING_KEY, None)
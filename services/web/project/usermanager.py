@@ -0,0 +1,64 @@
+"""User status changes, single and in bulk."""
+from . import db, identity_cache, session_store, fragment_cache
+from .models import User
+from .userstats import statuses_changed
+from .tasks import enqueue_status_change
+
+# statuses an admin can set
+USER_STATUSES = ('pending', 'approved', 'rejected')
+
+
+def user_selection(user_ids=None, user_type=None, user_status=None, organization=None):
+    """SQL conditions selecting users by id list and/or attribute filter."""
+    users = User.__table__.c
+    conditions = []
+    if user_ids is not None:
+        conditions.append(users.id.in_(user_ids))
+    if user_type is not None:
+        conditions.append(users.user_type == user_type)
+    if user_status is not None:
+        conditions.append(users.user_status == user_status)
+    if organization is not None:
+        conditions.append(users.organization == organization)
+    return conditions
+
+
+def set_user_status(new_status, **selection):
+    """Set user_status on every selected user with a single UPDATE.
+
+    selection is passed to user_selection, at least one condition is
+    required so a bare call can never update the whole table. Returns the
+    ids of the updated users, whose cached identities are dropped. Their
+    notifications are queued as jobs in the same transaction.
+    """
+    conditions = user_selection(**selection)
+    if not conditions:
+        raise ValueError('set_user_status needs user_ids or a filter')
+
+    users = User.__table__
+
+    if db.engine.dialect.name == 'postgresql':
+        # the update reports the ids it touched and their previous status, one round trip
+        previous = db.select([users.c.id, users.c.user_status.label('old_status')]).\
+            where(db.and_(*conditions)).with_for_update().alias('previous')
+        update = users.update().where(users.c.id == previous.c.id).values(user_status=new_status)
+        rows = db.session.execute(update.returning(users.c.id, previous.c.old_status)).fetchall()
+    else:
+        # no RETURNING, pin the selection to the ids found inside the transaction
+        rows = db.session.execute(db.select([users.c.id, users.c.user_status]).where(db.and_(*conditions))).fetchall()
+        if rows:
+            db.session.execute(users.update().where(users.c.id.in_([row[0] for row in rows])).values(user_status=new_status))
+    user_ids = [row[0] for row in rows]
+    # pending counts on the admin dashboards, in the same transaction
+    statuses_changed([(row[1], new_status) for row in rows])
+    # notifications and the analytics refresh run in the worker, not in the request
+    enqueue_status_change(user_ids, new_status)
+    db.session.commit()
+
+    # the update bypassed the ORM, drop the cached identities by hand
+    identity_cache.invalidate(*user_ids)
+    session_store.invalidate(*user_ids)
+    # admin user lists show the status too
+    fragment_cache.invalidate(*user_ids)
+    fragment_cache.bump('users')
+    return user_ids
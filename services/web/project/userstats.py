@@ -0,0 +1,182 @@
+"""Per-user dashboard counters, kept up to date by the writes that change them."""
+from collections import Counter, namedtuple
+
+from sqlalchemy import case, event, func
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from . import db
+from .models import User, Retention, UserStat
+
+Stats = namedtuple('Stats', ['documents_owned', 'documents_assigned', 'pending_approvals'])
+# shown until the first write or rebuild creates the row of a user
+NO_STATS = Stats(0, 0, 0)
+
+
+def user_stats(user_id):
+    """Dashboard counters of a user, a single primary key lookup."""
+    row = db.session.query(UserStat.documents_owned, UserStat.documents_assigned, UserStat.pending_approvals).\
+        filter(UserStat.user_id == user_id).first()
+    return Stats(*row) if row is not None else NO_STATS
+
+
+# ---------- bulk rebuild ----------
+
+def stats_select(user_ids=None):
+    """SELECT of user_stats rows counted from users and retentions.
+
+    Retentions are grouped once per column, so a full rebuild is three
+    aggregate scans whatever the number of users. user_ids narrows every
+    part to those users.
+    """
+    users = User.__table__
+    retentions = Retention.__table__
+    counted = retentions.c.document_id.isnot(None)
+
+    owned = db.select([retentions.c.sponsor_id.label('user_id'), func.count().label('total')]).\
+        where(counted).group_by(retentions.c.sponsor_id)
+    assigned = db.select([retentions.c.editor_id.label('user_id'), func.count().label('total')]).\
+        where(counted).group_by(retentions.c.editor_id)
+    if user_ids is not None:
+        owned = owned.where(retentions.c.sponsor_id.in_(user_ids))
+        assigned = assigned.where(retentions.c.editor_id.in_(user_ids))
+    owned = owned.alias('owned')
+    assigned = assigned.alias('assigned')
+    pending_users = users.alias('pending_users')
+    pending = db.select([func.count()]).where(pending_users.c.user_status == 'pending').as_scalar()
+
+    select = db.select([
+        users.c.id,
+        func.coalesce(owned.c.total, 0),
+        func.coalesce(assigned.c.total, 0),
+        case([(users.c.user_type == 'admin', pending)], else_=0)
+    ]).select_from(
+        users.outerjoin(owned, owned.c.user_id == users.c.id).outerjoin(assigned, assigned.c.user_id == users.c.id)
+    )
+    if user_ids is not None:
+        select = select.where(users.c.id.in_(user_ids))
+    return select
+
+
+def rebuild_user_stats(user_ids=None):
+    """Recount the rows of user_ids, every user when None, with one INSERT ... SELECT.
+
+    Runs in the current transaction, the caller commits. Returns the number
+    of rows written.
+    """
+    stats = UserStat.__table__
+    delete = stats.delete()
+    if user_ids is not None:
+        if not user_ids:
+            return 0
+        delete = delete.where(stats.c.user_id.in_(user_ids))
+    db.session.execute(delete)
+    insert = stats.insert().from_select(
+        ['user_id', 'documents_owned', 'documents_assigned', 'pending_approvals'], stats_select(user_ids)
+    )
+    return db.session.execute(insert).rowcount
+
+
+# ---------- incremental updates ----------
+
+def apply_deltas(owned=None, assigned=None, pending=0, recount=()):
+    """Add deltas to the counters, in the current transaction.
+
+    owned and assigned map user ids to changes of their counts, pending
+    is the change of the number of pending users, added to every admin.
+    Users in recount, and users without a row yet, are counted from
+    scratch instead.
+    """
+    stats = UserStat.__table__
+    recount = set(recount)
+    owned = owned or Counter()
+    assigned = assigned or Counter()
+    for user_id in set(owned) | set(assigned):
+        if user_id is None or user_id in recount:
+            continue
+        if not owned[user_id] and not assigned[user_id]:
+            continue
+        result = db.session.execute(
+            stats.update().where(stats.c.user_id == user_id).values(
+                documents_owned=stats.c.documents_owned + owned[user_id],
+                documents_assigned=stats.c.documents_assigned + assigned[user_id]
+            )
+        )
+        if result.rowcount == 0:
+            recount.add(user_id)
+    if pending:
+        admins = db.select([User.__table__.c.id]).where(User.__table__.c.user_type == 'admin')
+        update = stats.update().where(stats.c.user_id.in_(admins)).\
+            values(pending_approvals=stats.c.pending_approvals + pending)
+        if recount:
+            update = update.where(stats.c.user_id.notin_(recount))
+        db.session.execute(update)
+    rebuild_user_stats(sorted(recount))
+
+
+def retentions_added(pairs):
+    """Count retentions inserted without the ORM, pairs of (sponsor_id, editor_id)."""
+    owned = Counter(sponsor_id for sponsor_id, editor_id in pairs if sponsor_id is not None)
+    assigned = Counter(editor_id for sponsor_id, editor_id in pairs if editor_id is not None)
+    apply_deltas(owned, assigned)
+
+
+def statuses_changed(changes):
+    """Count user_status changes made without the ORM, pairs of (old status, new status)."""
+    pending = sum(1 for old, new in changes if new == 'pending' and old != 'pending')
+    pending -= sum(1 for old, new in changes if old == 'pending' and new != 'pending')
+    apply_deltas(pending=pending)
+
+
+def _values(obj, names, before):
+    """Attribute values of obj before or after the pending flush."""
+    values = []
+    for name in names:
+        history = get_history(obj, name)
+        found = (history.deleted or history.unchanged) if before else (history.added or history.unchanged)
+        values.append(found[0] if found else None)
+    return values
+
+
+def register_stats_hooks():
+    """Update user_stats in the same transaction as the ORM writes that change them.
+
+    Retention inserts, deletes and changes of sponsor, editor or document
+    move the document counts, a Document deleted through the ORM detaches
+    its retentions and so moves them too. New and deleted users and
+    user_status changes move the pending count of every admin. Core
+    statements bypass these hooks, their callers use retentions_added and
+    statuses_changed.
+    """
+
+    @event.listens_for(Session, 'after_flush')
+    def count_changes(session, flush_context):
+        owned = Counter()
+        assigned = Counter()
+        pending = 0
+        recount = set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Retention):
+                for before, sign in ((True, -1), (False, 1)):
+                    if (before and obj in session.new) or (not before and obj in session.deleted):
+                        continue
+                    sponsor_id, editor_id, document_id = _values(obj, ('sponsor_id', 'editor_id', 'document_id'), before)
+                    if document_id is None:
+                        continue
+                    if sponsor_id is not None:
+                        owned[sponsor_id] += sign
+                    if editor_id is not None:
+                        assigned[editor_id] += sign
+            elif isinstance(obj, User):
+                if obj in session.new:
+                    # counted from scratch, the new row sees this flush already
+                    recount.add(obj.id)
+                    pending += obj.user_status == 'pending'
+                elif obj in session.deleted:
+                    pending -= _values(obj, ('user_status',), True)[0] == 'pending'
+                else:
+                    old, new = _values(obj, ('user_status',), True)[0], _values(obj, ('user_status',), False)[0]
+                    pending += (new == 'pending') - (old == 'pending')
+        if owned or assigned or pending or recount:
+            # session.execute in a flush hook runs on the flushing connection and transaction
+            apply_deltas(owned, assigned, pending, recount)
@@ -0,0 +1,105 @@
+"""Shared fixtures, one app for the whole run on a fresh sqlite schema per test."""
+import os
+import tempfile
+
+# Config reads the environment when project.config is first imported
+TEST_DIR = tempfile.mkdtemp(prefix='project-tests-')
+os.environ.update({
+    'DATABASE_URL_PROD': 'sqlite:///' + os.path.join(TEST_DIR, 'test.sqlite'),
+    'SECRET_KEY': 'test',
+    'LOG_ENABLED': '0',
+    # cheap hashes, every test creates users
+    'PASSWORD_HASH_COST': '1000',
+    'TEMPLATE_PRECOMPILE': '0',
+    'TEMPLATE_BYTECODE_CACHE': '0',
+    'RATE_LIMIT_SHM_PATH': os.path.join(TEST_DIR, 'ratelimit'),
+})
+
+import pytest
+from sqlalchemy import event
+
+from project import (
+    create_app, db, identity_cache, session_store, rate_limiter, request_metrics, revision_store
+)
+from project.models import Document, Retention, User
+
+
+@pytest.fixture(scope='session')
+def app():
+    app = create_app()
+    app.config.update(
+        TESTING=True,
+        WTF_CSRF_ENABLED=False,
+        # bundles link their source files, nothing has to be built
+        ASSETS_DEBUG=True,
+    )
+    return app
+
+
+@pytest.fixture(autouse=True)
+def database(app):
+    """Empty tables and caches for every test."""
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield db
+        db.session.remove()
+    identity_cache.clear()
+    session_store.clear()
+    revision_store.cache.clear()
+    rate_limiter.reset()
+    # the benchmarks turn the limiter off
+    rate_limiter.enabled = app.config['RATE_LIMIT_ENABLED']
+    request_metrics.reset()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+PASSWORD = 'password1'
+
+
+def make_user(email, user_type='sponsor', user_status='approved', name=None, organization='org'):
+    """Add and commit a user, returns its id."""
+    user = User(name=name or email.split('@')[0], email=email, user_type=user_type,
+                user_status=user_status, organization=organization)
+    user.set_password(PASSWORD)
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+
+def add_document(sponsor_id, editor_id=None, name='doc'):
+    """Add and commit a document retained by sponsor_id, returns its id."""
+    document = Document(document_name=name)
+    db.session.add(document)
+    db.session.flush()
+    db.session.add(Retention(sponsor_id=sponsor_id, editor_id=editor_id, document_id=document.id))
+    db.session.commit()
+    return document.id
+
+
+def login(client, email, password=PASSWORD):
+    response = client.post('/login', data={'email': email, 'password': password})
+    assert response.status_code == 302, response.status_code
+    return response
+
+
+class QueryCounter(object):
+    """Counts the statements run on the engine inside a with block."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
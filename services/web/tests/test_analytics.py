@@ -0,0 +1,45 @@
+from project import db
+from project.analytics import cached_user_analytics, user_analytics
+
+from conftest import login, make_user
+
+
+def test_counts_and_totals_come_from_one_group_by():
+    make_user('a@example.com', user_type='admin')
+    make_user('s1@example.com', user_status='pending', organization='one')
+    make_user('s2@example.com', user_status='pending', organization='two')
+    make_user('e@example.com', user_type='editor', user_status=None)
+
+    analytics = user_analytics('day', 30)
+
+    assert analytics['totals'] == {
+        'admin': {'approved': 1}, 'sponsor': {'pending': 2}, 'editor': {'none': 1}}
+    assert {(row['user_type'], row['organization'], row['users']) for row in analytics['counts']} == {
+        ('admin', 'org', 1), ('sponsor', 'one', 1), ('sponsor', 'two', 1), ('editor', 'org', 1)}
+
+
+def test_analytics_are_cached_for_the_ttl():
+    make_user('s@example.com')
+    first = cached_user_analytics('day', 30, ttl=60)
+    make_user('t@example.com')
+    assert cached_user_analytics('day', 30, ttl=60) == first
+
+
+def test_section_totals_follow_a_status_change_at_once(client):
+    make_user('admin@example.com', user_type='admin')
+    pending = [make_user('p%d@example.com' % number, user_status='pending') for number in range(2)]
+    login(client, 'admin@example.com')
+    # fills the analytics cache, the totals must not be read from it
+    assert client.get('/admin/analytics').status_code == 200
+    assert b'Pending Sponsors</a> (2)' in client.get('/admin/signuprequests').data
+    assert b'Approved Sponsors</a> (0)' in client.get('/admin/usersview').data
+
+    response = client.post('/admin/userstatus', json={'user_status': 'approved', 'user_ids': pending[:1]})
+    assert response.status_code == 200
+
+    assert b'Pending Sponsors</a> (1)' in client.get('/admin/signuprequests').data
+    assert b'Approved Sponsors</a> (1)' in client.get('/admin/usersview').data
+    totals = dict(((section['user_type'], section['user_status']), section['total'])
+                  for section in client.get('/admin/analytics').get_json()['sections'])
+    assert totals[('sponsor', 'pending')] == 1
+    assert totals[('sponsor', 'approved')] == 1
@@ -0,0 +1,64 @@
+from project import db
+from project.models import Document
+
+from conftest import QueryCounter, add_document, login, make_user
+
+
+def sponsor_with_documents(client, count):
+    sponsor_id = make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor', name='Eddie')
+    document_ids = [add_document(sponsor_id, editor_id, name='doc %d' % number) for number in range(count)]
+    login(client, 's@example.com')
+    return sponsor_id, editor_id, document_ids
+
+
+def test_sponsor_list_selects_fields_and_pages_by_cursor(client):
+    sponsor_id, editor_id, document_ids = sponsor_with_documents(client, 3)
+
+    body = client.get('/api/v1/sponsor/documents?fields=document_name,editor_name&per_page=2').get_json()
+
+    assert body['fields'] == ['id', 'document_name', 'editor_name']
+    assert [row['document_name'] for row in body['data']] == ['doc 0', 'doc 1']
+    assert set(body['data'][0]) == {'id', 'document_name', 'editor_name'}
+    assert body['data'][0]['editor_name'] == 'Eddie'
+
+    rest = client.get('/api/v1/sponsor/documents?per_page=2&after=%d' % body['next_cursor']).get_json()
+    assert [row['document_id'] for row in rest['data']] == document_ids[2:]
+    assert rest['next_cursor'] is None
+
+
+def test_unknown_fields_are_rejected(client):
+    sponsor_with_documents(client, 1)
+    response = client.get('/api/v1/sponsor/documents?fields=document_body')
+    assert response.status_code == 400
+
+
+def test_unchanged_pages_revalidate_without_queries(client):
+    sponsor_with_documents(client, 2)
+    first = client.get('/api/v1/sponsor/documents')
+
+    with QueryCounter(db.engine) as counter:
+        again = client.get('/api/v1/sponsor/documents', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+    assert counter.count == 0
+
+    # a rename bumps the sponsor's list, the old ETag no longer matches
+    document = Document.query.first()
+    document.document_name = 'renamed'
+    db.session.commit()
+    changed = client.get('/api/v1/sponsor/documents', headers={'If-None-Match': first.headers['ETag']})
+    assert changed.status_code == 200
+    assert 'renamed' in [row['document_name'] for row in changed.get_json()['data']]
+
+
+def test_editors_see_only_their_assignments(client):
+    sponsor_id = make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    other_id = make_user('o@example.com', user_type='editor')
+    mine = add_document(sponsor_id, editor_id, name='mine')
+    add_document(sponsor_id, other_id, name='theirs')
+    login(client, 'e@example.com')
+
+    body = client.get('/api/v1/editor/documents').get_json()
+
+    assert [row['document_id'] for row in body['data']] == [mine]
@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+
+
+def test_importing_the_package_builds_no_app():
+    # project.app is built on first access, see project.__getattr__
+    code = 'import project; assert "app" not in vars(project)'
+    subprocess.check_call([sys.executable, '-c', code], cwd=os.path.join(os.path.dirname(__file__), '..'))
+
+
+def test_responses_carry_the_security_policy(client):
+    assert client.get('/login').headers['Content-Security-Policy'] == "default-src 'self'"
@@ -0,0 +1,43 @@
+import gzip
+import json
+import os
+
+from flask import Flask
+from flask_assets import Environment
+
+from project.assets import FINGERPRINTED, build_static_assets, compile_static_assets, write_compressed
+
+def test_compressed_variants_are_reproducible(tmp_path):
+    path = str(tmp_path / 'main.css')
+    with open(path, 'w') as output:
+        output.write('body { color: red }' * 100)
+
+    written = write_compressed(path)
+    first = open(path + '.gz', 'rb').read()
+    write_compressed(path)
+
+    assert path + '.gz' in written
+    assert open(path + '.gz', 'rb').read() == first
+    assert gzip.decompress(first) == open(path, 'rb').read()
+
+
+def test_bundles_build_to_fingerprinted_names_and_a_manifest(tmp_path):
+    # small stand-ins for the sources the bundles list
+    for source, text in (('css/bootstrap.min.css', 'body {  margin: 0;  }'), ('src/js/main.js', 'var  answer = 42;')):
+        os.makedirs(str(tmp_path / os.path.dirname(source)), exist_ok=True)
+        with open(str(tmp_path / source), 'w') as output:
+            output.write(text)
+    app = Flask('assets_test', static_folder=str(tmp_path))
+    app.config.update(ASSETS_VERSIONS='hash', ASSETS_MANIFEST='json:dist/manifest.json', ASSETS_CACHE=False)
+    assets = Environment(app)
+    compile_static_assets(assets)
+
+    with app.app_context():
+        written = build_static_assets(assets, echo=lambda *args: None)
+
+    bundles = [os.path.relpath(path, str(tmp_path)) for path in written if not path.endswith(('.gz', '.br'))]
+    assert len(bundles) == 3
+    assert all(FINGERPRINTED.match(path) for path in bundles), bundles
+    manifest = json.load(open(str(tmp_path / 'dist' / 'manifest.json')))
+    assert set(manifest) == {'dist/css/landing.%(version)s.css', 'dist/css/account.%(version)s.css',
+                             'dist/js/main.%(version)s.min.js'}
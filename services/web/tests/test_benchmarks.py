@@ -0,0 +1,34 @@
+from project.benchmarks import bench_flow, percentile, summarize
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.50) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile([7], 0.99) == 7
+
+
+def test_summary_groups_samples_by_step():
+    samples = [('login', 302, 0.010, 3), ('login', 302, 0.030, 3), ('dashboard', 500, 0.002, None)]
+
+    summary = summarize(samples, 2.0)
+
+    assert summary['requests'] == 3
+    assert summary['requests_per_second'] == 1.5
+    assert summary['steps']['login']['queries_per_request'] == 3
+    assert summary['steps']['dashboard'] == {
+        'count': 1, 'errors': 1, 'p50_ms': 2.0, 'p95_ms': 2.0, 'p99_ms': 2.0, 'queries_per_request': None}
+
+
+def test_flow_runs_without_errors(app, monkeypatch):
+    # bench_flow turns Server-Timing on, put it back afterwards
+    monkeypatch.setitem(app.config, 'SERVER_TIMING', False)
+
+    summary = bench_flow(app, sponsors=2, editors=2, documents=10, iterations=5, concurrency=1,
+                         echo=lambda *args: None)
+
+    steps = summary['steps']
+    assert set(steps) >= {'login', 'dashboard_sponsor', 'documentlist_sponsor', 'documentedit_sponsor', 'usersview_admin'}
+    assert all(step['errors'] == 0 for step in steps.values()), steps
+    # every measured page reports its query count through Server-Timing
+    assert steps['documentlist_sponsor']['queries_per_request'] is not None
@@ -0,0 +1,82 @@
+import pytest
+
+from project import db, body_store
+from project.bodystore import BadPatch
+from project.models import DocumentBodyChunk
+
+from conftest import add_document, login, make_user
+
+# multibyte characters land on chunk boundaries
+TEXT = ('héllo wörld ✓ ' * 40).strip()
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(body_store, 'chunk_size', 64)
+
+
+def chunk_count(document_id):
+    return DocumentBodyChunk.query.filter_by(document_id=document_id).count()
+
+
+def test_bodies_round_trip_through_small_chunks(small_chunks):
+    document_id = add_document(make_user('s@example.com'))
+
+    size = body_store.write_text(document_id, TEXT)
+    db.session.commit()
+
+    assert size == len(TEXT.encode('utf-8')) == body_store.size(document_id)
+    assert chunk_count(document_id) > 5
+    # every chunk decodes on its own
+    assert all(piece.decode('utf-8') for piece in body_store.chunks(document_id))
+    assert body_store.read_text(document_id) == TEXT
+
+
+def test_patches_rewrite_only_the_chunks_they_touch(small_chunks):
+    document_id = add_document(make_user('s@example.com'))
+    body_store.write_text(document_id, TEXT)
+    db.session.commit()
+    untouched = db.session.query(DocumentBodyChunk.seq, DocumentBodyChunk.data).\
+        filter_by(document_id=document_id).order_by(DocumentBodyChunk.seq).all()[-3:]
+
+    body_store.patch(document_id, [(6, 11, 'there'), (20, 20, 'NEW')])
+    db.session.commit()
+
+    expected = TEXT[:6] + 'there' + TEXT[11:20] + 'NEW' + TEXT[20:]
+    assert body_store.read_text(document_id) == expected
+    after = db.session.query(DocumentBodyChunk.seq, DocumentBodyChunk.data).\
+        filter_by(document_id=document_id).order_by(DocumentBodyChunk.seq).all()[-3:]
+    assert after == untouched
+
+
+def test_patches_past_the_end_are_rejected():
+    document_id = add_document(make_user('s@example.com'))
+    body_store.write_text(document_id, 'short')
+    with pytest.raises(BadPatch):
+        body_store.patch(document_id, [(3, 10, 'x')])
+
+
+def test_body_download_and_upload(client):
+    sponsor_id = make_user('s@example.com')
+    document_id = add_document(sponsor_id)
+    login(client, 's@example.com')
+
+    response = client.put('/api/v1/documents/%d/body' % document_id, data=TEXT.encode('utf-8'))
+    assert response.status_code == 200
+
+    download = client.get('/api/v1/documents/%d/body' % document_id)
+    assert download.get_data().decode('utf-8') == TEXT
+    assert download.headers['ETag'] == response.headers['ETag']
+
+    assert client.put('/api/v1/documents/%d/body' % document_id, data=b'\xff\xfe').status_code == 400
+    assert body_store.read_text(document_id) == TEXT
+
+
+def test_oversized_uploads_are_refused(client, monkeypatch):
+    monkeypatch.setattr(body_store, 'max_size', 10)
+    document_id = add_document(make_user('s@example.com'))
+    login(client, 's@example.com')
+
+    response = client.put('/api/v1/documents/%d/body' % document_id, data=b'x' * 11)
+
+    assert response.status_code == 413
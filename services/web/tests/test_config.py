@@ -0,0 +1,71 @@
+import sqlite3
+
+from sqlalchemy.pool import QueuePool
+
+from project import db
+from project.config import engine_options, env_flag
+
+from conftest import login, make_user
+
+POSTGRES = 'postgresql://user:secret@db/app'
+
+
+def test_flags_read_the_usual_spellings(monkeypatch):
+    monkeypatch.setenv('SOME_FLAG', 'Yes')
+    assert env_flag('SOME_FLAG') is True
+    monkeypatch.setenv('SOME_FLAG', '0')
+    assert env_flag('SOME_FLAG', True) is False
+    monkeypatch.delenv('SOME_FLAG')
+    assert env_flag('SOME_FLAG', True) is True
+
+
+def test_pool_is_sized_from_the_environment(monkeypatch):
+    monkeypatch.setenv('DATABASE_POOL_SIZE', '3')
+    monkeypatch.setenv('DATABASE_MAX_OVERFLOW', '0')
+    monkeypatch.setenv('DATABASE_POOL_PRE_PING', 'off')
+
+    options = engine_options(POSTGRES)
+
+    assert options['pool_size'] == 3
+    assert options['max_overflow'] == 0
+    assert options['pool_pre_ping'] is False
+    assert 'connect_args' not in options
+
+
+def test_statement_timeout_is_left_out_behind_pgbouncer(monkeypatch):
+    monkeypatch.setenv('DATABASE_STATEMENT_TIMEOUT', '5000')
+    assert engine_options(POSTGRES)['connect_args'] == {'options': '-c statement_timeout=5000'}
+
+    monkeypatch.setenv('DATABASE_PGBOUNCER', '1')
+    assert 'connect_args' not in engine_options(POSTGRES)
+
+
+def test_sqlite_has_no_pool_options():
+    assert engine_options('sqlite:///app.sqlite') == {}
+
+
+def test_pool_stats_are_reported_to_admins(client):
+    make_user('admin@example.com', user_type='admin')
+    login(client, 'admin@example.com')
+
+    stats = client.get('/admin/poolstats').get_json()
+
+    assert stats['pool_class']
+    assert 'status' in stats
+
+
+def test_queue_pool_sizing_comes_from_the_config(app, client, monkeypatch):
+    make_user('admin@example.com', user_type='admin')
+    login(client, 'admin@example.com')
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_ENGINE_OPTIONS', {'pool_size': 3, 'max_overflow': 7})
+    pool = QueuePool(lambda: sqlite3.connect(db.engine.url.database, check_same_thread=False),
+                     pool_size=3, max_overflow=7)
+    monkeypatch.setattr(db.engine, 'pool', pool)
+
+    try:
+        stats = client.get('/admin/poolstats').get_json()
+    finally:
+        pool.dispose()
+
+    assert stats['pool_class'] == 'QueuePool'
+    assert (stats['size'], stats['max_overflow'], stats['checked_out']) == (3, 7, 0)
@@ -0,0 +1,69 @@
+from project import db, body_store
+from project.models import Document, Retention
+
+from conftest import login, make_user
+
+
+def test_new_document_is_created_with_its_retention_and_body(client):
+    sponsor_id = make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    login(client, 's@example.com')
+
+    response = client.post('/sponsor/newdocument', data={
+        'document_name': 'plan', 'document_body': 'first draft', 'editorchoice': str(editor_id)})
+
+    assert response.status_code == 302
+    retention = Retention.query.one()
+    assert (retention.sponsor_id, retention.editor_id) == (sponsor_id, editor_id)
+    assert retention.document.document_name == 'plan'
+    assert body_store.read_text(retention.document_id) == 'first draft'
+
+
+def test_bulk_create_inserts_every_document_in_batches(app, client):
+    sponsor_id = make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    login(client, 's@example.com')
+    app.config['BULK_INSERT_BATCH_SIZE'] = 2
+    try:
+        response = client.post('/sponsor/newdocuments', json={'documents': [
+            {'document_name': 'doc %d' % number, 'document_body': 'body %d' % number, 'editor_id': editor_id}
+            for number in range(5)
+        ]})
+    finally:
+        app.config['BULK_INSERT_BATCH_SIZE'] = 500
+
+    assert response.status_code == 201
+    document_ids = response.get_json()['document_ids']
+    assert len(document_ids) == 5
+    names = dict(db.session.query(Document.id, Document.document_name))
+    assert [names[document_id] for document_id in document_ids] == ['doc %d' % number for number in range(5)]
+    assert body_store.read_text(document_ids[3]) == 'body 3'
+    assert Retention.query.filter_by(sponsor_id=sponsor_id, editor_id=editor_id).count() == 5
+
+
+def test_bulk_create_rejects_unknown_editors_before_writing(client):
+    make_user('s@example.com')
+    other_sponsor_id = make_user('t@example.com')
+    login(client, 's@example.com')
+
+    response = client.post('/sponsor/newdocuments', json={'documents': [
+        {'document_name': 'doc', 'editor_id': other_sponsor_id}]})
+
+    assert response.status_code == 400
+    assert Document.query.count() == 0
+
+
+def test_bulk_create_rejects_bad_names_before_writing(client):
+    make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    login(client, 's@example.com')
+
+    for name in (['doc'], 7, 'x' * 101):
+        response = client.post('/sponsor/newdocuments', json={'documents': [
+            {'document_name': 'fine', 'editor_id': editor_id}, {'document_name': name, 'editor_id': editor_id}]})
+        assert response.status_code == 400
+    assert Document.query.count() == 0
+
+    response = client.post('/sponsor/newdocuments', json={'documents': [
+        {'document_name': 'x' * 100, 'editor_id': editor_id}, {'editor_id': editor_id}]})
+    assert response.status_code == 201
@@ -0,0 +1,59 @@
+from project import body_store, revision_store
+
+from conftest import add_document, login, make_user
+
+
+def saved_document(client, body):
+    sponsor_id = make_user('s@example.com')
+    document_id = add_document(sponsor_id)
+    login(client, 's@example.com')
+    client.put('/api/v1/documents/%d/body' % document_id, data=body.encode('utf-8'))
+    return document_id
+
+
+def patch(client, document_id, version, *patches, **fields):
+    body_patches = [{'start': start, 'end': end, 'text': text} for start, end, text in patches]
+    return client.patch('/api/v1/documents/%d' % document_id, json=dict(fields, version=version, body_patches=body_patches))
+
+
+def test_inserts_at_one_offset_keep_the_order_sent(client):
+    document_id = saved_document(client, 'hello world')
+
+    response = patch(client, document_id, 2, (5, 5, ', zebra'), (5, 5, ' and apple'), (0, 0, '>'))
+
+    assert response.status_code == 200
+    expected = '>hello, zebra and apple world'
+    assert body_store.read_text(document_id) == expected
+    # the revision delta is built in the same order
+    assert revision_store.text(document_id, 3) == expected
+
+
+def test_stale_version_is_a_conflict(client):
+    document_id = saved_document(client, 'hello world')
+    assert patch(client, document_id, 2, (0, 5, 'howdy')).status_code == 200
+
+    response = patch(client, document_id, 2, (6, 11, 'there'), document_name='lost')
+
+    assert response.status_code == 409
+    assert response.get_json()['version'] == 3
+    assert body_store.read_text(document_id) == 'howdy world'
+
+
+def test_if_match_guards_body_uploads(client):
+    document_id = saved_document(client, 'hello world')
+
+    stale = client.put('/api/v1/documents/%d/body' % document_id, data=b'overwrite', headers={'If-Match': '"v1"'})
+    fresh = client.put('/api/v1/documents/%d/body' % document_id, data=b'overwrite', headers={'If-Match': '"v2"'})
+
+    assert stale.status_code == 409
+    assert fresh.status_code == 200
+    assert fresh.headers['ETag'] == '"v3"'
+
+
+def test_overlapping_patches_are_rejected(client):
+    document_id = saved_document(client, 'hello world')
+
+    response = patch(client, document_id, 2, (0, 6, 'x'), (4, 8, 'y'))
+
+    assert response.status_code == 400
+    assert body_store.read_text(document_id) == 'hello world'
@@ -0,0 +1,53 @@
+from flask_principal import RoleNeed, UserNeed
+
+from project import db, identity_cache
+from project.identitycache import load_identity_needs
+from project.principalmanager import EditDocumentNeed
+
+from conftest import QueryCounter, add_document, login, make_user
+
+
+def test_needs_come_from_one_query():
+    sponsor_id = make_user('s@example.com')
+    first = add_document(sponsor_id)
+    second = add_document(sponsor_id)
+
+    with QueryCounter(db.engine) as counter:
+        needs = load_identity_needs(sponsor_id)
+
+    assert counter.count == 1
+    assert needs == frozenset([
+        UserNeed(sponsor_id), RoleNeed('sponsor'), RoleNeed('approved'),
+        EditDocumentNeed(str(first)), EditDocumentNeed(str(second)),
+    ])
+
+
+def test_pending_user_is_not_approved():
+    user_id = make_user('p@example.com', user_type='editor', user_status='pending')
+    needs = load_identity_needs(user_id)
+    assert RoleNeed('notapproved') in needs
+    assert RoleNeed('approved') not in needs
+
+
+def test_cached_needs_skip_the_query(client):
+    sponsor_id = make_user('s@example.com')
+    login(client, 's@example.com')
+    assert client.get('/sponsor/dashboard').status_code == 200
+    assert identity_cache.get(sponsor_id) is not None
+
+    # the permission check sees whatever is cached, without the sponsor role
+    # it fails, and the blueprint's 403 handler sends the user to log in
+    identity_cache.set(sponsor_id, frozenset([UserNeed(sponsor_id), RoleNeed('approved')]))
+    response = client.get('/sponsor/dashboard')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/login')
+
+
+def test_retention_commit_drops_cached_needs():
+    sponsor_id = make_user('s@example.com')
+    identity_cache.set(sponsor_id, load_identity_needs(sponsor_id))
+
+    document_id = add_document(sponsor_id)
+
+    assert identity_cache.get(sponsor_id) is None
+    assert EditDocumentNeed(str(document_id)) in load_identity_needs(sponsor_id)
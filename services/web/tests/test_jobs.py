@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from project import db, job_queue, session_store
+from project.jobs import FAILED, QUEUED, RUNNING
+from project.models import Job
+
+from conftest import login, make_user
+
+
+def jobs():
+    db.session.expire_all()
+    return Job.query.order_by(Job.id).all()
+
+
+def names():
+    return [job.name for job in jobs()]
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    """Registers a handler under a name for one test."""
+    def register(name, function):
+        monkeypatch.setitem(job_queue.handlers, name, function)
+    return register
+
+
+def test_signup_queues_one_notification_per_admin(client):
+    make_user('a1@example.com', user_type='admin')
+    make_user('a2@example.com', user_type='admin')
+
+    response = client.post('/signupeditor', data={
+        'name': 'e', 'email': 'e@example.com', 'password': 'password1', 'confirm': 'password1'})
+
+    assert response.status_code == 302
+    assert names() == ['signup_created']
+    assert job_queue.run_pending() == 3
+    assert jobs() == []
+
+
+def test_status_change_notifies_the_changed_users(client):
+    make_user('admin@example.com', user_type='admin')
+    pending = [make_user('p%d@example.com' % number, user_status='pending') for number in range(2)]
+    login(client, 'admin@example.com')
+
+    client.post('/admin/userstatus', json={'user_status': 'approved', 'user_ids': pending})
+
+    assert names() == ['user_status_changed']
+    job_queue.run_pending(limit=1)
+    assert [job.payload for job in jobs()] == [
+        '{"body": "You can now log in and use your sponsor account.", "email": "p%d@example.com", '
+        '"subject": "Your account has been approved"}' % number for number in range(2)]
+
+
+def test_analytics_refresh_is_only_queued_for_a_shared_backend(client, monkeypatch):
+    make_user('admin@example.com', user_type='admin')
+    pending = [make_user('p%d@example.com' % number, user_status='pending') for number in range(2)]
+    login(client, 'admin@example.com')
+    client.post('/admin/userstatus', json={'user_status': 'approved', 'user_ids': pending[:1]})
+    assert 'refresh_user_analytics' not in names()
+
+    monkeypatch.setattr(session_store, 'shared', True)
+    client.post('/admin/userstatus', json={'user_status': 'approved', 'user_ids': pending[:1]})
+    client.post('/admin/userstatus', json={'user_status': 'rejected', 'user_ids': pending[1:]})
+    assert names().count('refresh_user_analytics') == 1
+
+
+def test_failing_job_is_retried_with_backoff_then_kept_as_failed(handler, monkeypatch):
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        raise ValueError('boom')
+
+    handler('flaky', flaky)
+    monkeypatch.setattr(job_queue, 'backoff', 10.0)
+    job_queue.enqueue('flaky', max_attempts=2)
+    db.session.commit()
+
+    assert job_queue.run_pending() == 1
+    job, = jobs()
+    assert job.status == QUEUED and job.attempts == 1
+    assert 'ValueError: boom' in job.last_error
+    # 10 seconds less up to 25% jitter
+    assert timedelta(seconds=7) < job.run_at - datetime.utcnow() <= timedelta(seconds=10)
+    # not due yet
+    assert job_queue.run_pending() == 0
+
+    job.run_at = datetime.utcnow()
+    db.session.commit()
+    assert job_queue.run_pending() == 1
+    job, = jobs()
+    assert job.status == FAILED and job.attempts == 2
+    assert len(calls) == 2
+
+    assert job_queue.retry_failed() == 1
+    job, = jobs()
+    assert job.status == QUEUED and job.attempts == 0
+
+
+def test_retry_delay_doubles_up_to_the_maximum(monkeypatch):
+    monkeypatch.setattr(job_queue, 'backoff', 10.0)
+    monkeypatch.setattr(job_queue, 'backoff_max', 30.0)
+    assert 7.5 <= job_queue.retry_delay(1) <= 10
+    assert 15 <= job_queue.retry_delay(2) <= 20
+    assert 22.5 <= job_queue.retry_delay(5) <= 30
+
+
+def test_unknown_job_fails_without_a_retry():
+    job_queue.enqueue('no such job')
+    db.session.commit()
+
+    job_queue.run_pending()
+
+    job, = jobs()
+    assert job.status == FAILED and job.attempts == 1
+    assert 'UnknownJob' in job.last_error
+
+
+def test_lost_lease_is_claimed_again(handler):
+    runs = []
+    handler('record', lambda: runs.append(1))
+    job_queue.enqueue('record')
+    db.session.commit()
+
+    first, = job_queue.claim('dead worker')
+    assert job_queue.claim('other worker') == []
+    job, = jobs()
+    assert job.status == RUNNING and job.locked_by == 'dead worker'
+
+    # the lease runs out
+    job.run_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    second, = job_queue.claim('other worker')
+    assert second.attempts == 2
+
+    # the first claim no longer holds, its outcome leaves the job alone
+    job_queue.run(first)
+    assert len(jobs()) == 1
+    assert job_queue.run(second)
+    assert jobs() == [] and len(runs) == 2
@@ -0,0 +1,10 @@
+from project.benchmarks import bench_listviews, query_count_regressions
+
+
+def test_list_view_query_counts_do_not_grow_with_the_tables(app):
+    results = bench_listviews(app, sizes=(10, 120), echo=lambda *args: None)
+
+    assert query_count_regressions(results) == []
+    for url, measurements in results.items():
+        # a page of rows, identity and user loading, a handful of statements in all
+        assert all(queries <= 10 for size, queries, elapsed in measurements), (url, measurements)
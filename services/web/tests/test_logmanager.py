@@ -0,0 +1,43 @@
+import threading
+
+import pytest
+from flask import Flask
+
+from project.logmanager import LogManager
+
+
+@pytest.fixture
+def hooks(monkeypatch):
+    """Hooks registered by the managers under test, recorded instead of installed."""
+    registered = []
+    monkeypatch.setattr('atexit.register', lambda function: registered.append(('atexit', function)))
+    monkeypatch.setattr('os.register_at_fork', lambda after_in_child: registered.append(('fork', after_in_child)))
+    return registered
+
+
+def test_repeated_init_app_keeps_one_writer_thread(hooks):
+    app = Flask('logmanager_test')
+    manager = LogManager()
+    before = threading.active_count()
+
+    for _ in range(3):
+        manager.init_app(app)
+
+    assert threading.active_count() == before + 1
+    assert hooks == [('atexit', manager.stop), ('fork', manager.start)]
+    manager.stop()
+    assert threading.active_count() == before
+
+
+def test_disabling_stops_the_writer_thread(hooks):
+    app = Flask('logmanager_test')
+    manager = LogManager(app)
+    before = threading.active_count()
+
+    app.config['LOG_ENABLED'] = False
+    manager.init_app(app)
+
+    assert threading.active_count() == before - 1
+    # what a forked worker runs
+    manager.start()
+    assert manager.listener is None
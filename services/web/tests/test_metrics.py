@@ -0,0 +1,38 @@
+import pytest
+
+from project import request_metrics
+
+from conftest import login, make_user
+
+OUTSIDE = {'REMOTE_ADDR': '203.0.113.7'}
+
+
+@pytest.fixture
+def token():
+    request_metrics.token = 'scrape-token'
+    yield request_metrics.token
+    request_metrics.token = ''
+
+
+def test_requests_are_counted_per_endpoint(client):
+    make_user('s@example.com')
+    login(client, 's@example.com')
+    # recorded once the response is closed, after a streamed body is sent
+    client.get('/sponsor/dashboard').close()
+
+    body = client.get('/metrics').get_data(as_text=True)
+
+    assert 'app_http_requests_total{endpoint="sponsor_bp.dashboard_sponsor",method="GET",status="200"} 1' in body
+    assert 'app_db_queries_per_request_count{endpoint="sponsor_bp.dashboard_sponsor"} 1' in body
+
+
+def test_outside_clients_are_turned_away(client):
+    assert client.get('/metrics', environ_base=OUTSIDE).status_code == 403
+
+
+def test_outside_clients_with_the_token_are_served(client, token):
+    response = client.get('/metrics', environ_base=OUTSIDE, headers={'Authorization': 'Bearer ' + token})
+    assert response.status_code == 200
+
+    wrong = client.get('/metrics', environ_base=OUTSIDE, headers={'Authorization': 'Bearer guess'})
+    assert wrong.status_code == 403
@@ -0,0 +1,39 @@
+from sqlalchemy import text
+
+from project import db, body_store
+from project.indexcheck import check_indexes
+from project.migrations import MIGRATIONS, current_version, document_body_chunks, stamp, upgrade
+from project.models import Document
+
+
+def quiet(*args):
+    pass
+
+
+def test_upgrade_applies_each_migration_once():
+    assert upgrade(echo=quiet) == [migration.version for migration in MIGRATIONS]
+    assert upgrade(echo=quiet) == []
+    assert current_version() == MIGRATIONS[-1].version
+
+
+def test_stamp_marks_a_fresh_schema_up_to_date():
+    stamp()
+    assert upgrade(echo=quiet) == []
+
+
+def test_bodies_move_out_of_the_documents_table():
+    document = Document(document_name='doc')
+    db.session.add(document)
+    db.session.commit()
+    # the column bodies lived in before they were chunked
+    db.session.execute(text('ALTER TABLE documents ADD COLUMN document_body TEXT'))
+    db.session.execute(text("UPDATE documents SET document_body = 'old body' WHERE id = :id"), {'id': document.id})
+    db.session.commit()
+
+    document_body_chunks(batch_size=1)
+
+    assert body_store.read_text(document.id) == 'old body'
+
+
+def test_hot_queries_use_indexes():
+    assert check_indexes(echo=quiet) == []
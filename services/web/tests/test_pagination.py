@@ -0,0 +1,61 @@
+from project import db
+from project.models import User
+from project.pagination import paginate_keyset
+
+from conftest import login, make_user
+
+
+def pages(query, per_page):
+    """Walk query forward page by page, returns the ids of each page and the last page."""
+    ids, page = [], paginate_keyset(query, User.id, 'id', per_page=per_page)
+    ids.append([user.id for user in page])
+    while page.next_cursor is not None:
+        page = paginate_keyset(query, User.id, 'id', after=page.next_cursor, per_page=per_page)
+        ids.append([user.id for user in page])
+    return ids, page
+
+
+def test_pages_cover_every_row_once_in_key_order():
+    user_ids = [make_user('u%d@example.com' % number) for number in range(7)]
+    query = db.session.query(User).order_by(User.name.desc())
+
+    ids, last = pages(query, 3)
+
+    assert ids == [user_ids[0:3], user_ids[3:6], user_ids[6:7]]
+    assert last.has_prev and not last.has_next
+
+
+def test_first_page_has_no_previous_page():
+    for number in range(3):
+        make_user('u%d@example.com' % number)
+    page = paginate_keyset(db.session.query(User), User.id, 'id', per_page=3)
+
+    assert len(page) == 3
+    assert page.prev_cursor is None
+    assert page.next_cursor is None
+
+
+def test_paging_back_returns_the_page_before_in_ascending_order():
+    user_ids = [make_user('u%d@example.com' % number) for number in range(7)]
+    query = db.session.query(User)
+
+    page = paginate_keyset(query, User.id, 'id', before=user_ids[5], per_page=3)
+
+    assert [user.id for user in page] == user_ids[2:5]
+    assert page.has_prev and page.has_next
+    assert page.prev_cursor == user_ids[2]
+    assert page.next_cursor == user_ids[4]
+
+
+def test_list_view_pages_with_cursors(client):
+    make_user('admin@example.com', user_type='admin')
+    editor_ids = [make_user('e%d@example.com' % number, user_type='editor') for number in range(5)]
+    login(client, 'admin@example.com')
+
+    response = client.get('/admin/analytics?per_page=2&after=%d' % editor_ids[0])
+    section = [section for section in response.get_json()['sections']
+               if section['user_type'] == 'editor' and section['user_status'] == 'approved'][0]
+
+    assert [user['id'] for user in section['users']] == editor_ids[1:3]
+    assert section['next_cursor'] == editor_ids[2]
+    assert section['prev_cursor'] == editor_ids[1]
@@ -0,0 +1,58 @@
+import pytest
+from werkzeug.security import generate_password_hash
+
+from project import db, password_hasher
+from project.models import User
+from project.passwordhasher import HasherBusy, PasswordHasher
+
+from conftest import PASSWORD, login, make_user
+
+
+@pytest.mark.parametrize('method, cost', [('pbkdf2:sha256', 1000), ('pbkdf2:sha512', 1000), ('scrypt', 1024)])
+def test_hashes_verify_with_their_own_scheme(method, cost):
+    hasher = PasswordHasher()
+    hasher.configure(method, cost, threads=1)
+
+    pwhash = hasher.hash('secret')
+
+    assert pwhash.startswith(hasher.method_string + '$')
+    assert hasher.check(pwhash, 'secret') == (True, None)
+    assert hasher.check(pwhash, 'wrong') == (False, None)
+    hasher.shutdown()
+
+
+def test_outdated_hashes_are_replaced_after_a_right_password():
+    hasher = PasswordHasher()
+    hasher.configure('pbkdf2:sha256', 1000, threads=0)
+    legacy = generate_password_hash('secret', method='sha256')
+
+    ok, new_hash = hasher.check(legacy, 'secret')
+
+    assert ok and new_hash.startswith('pbkdf2:sha256:1000$')
+    assert not hasher.needs_rehash(new_hash)
+    assert hasher.check(legacy, 'wrong') == (False, None)
+
+
+def test_login_stores_the_upgraded_hash(client):
+    user_id = make_user('s@example.com')
+    legacy = generate_password_hash(PASSWORD, method='sha256')
+    User.query.get(user_id).password = legacy
+    db.session.commit()
+
+    login(client, 's@example.com')
+
+    db.session.expire_all()
+    assert User.query.get(user_id).password.startswith(password_hasher.method_string + '$')
+
+
+def test_full_hashing_pool_turns_logins_away(client, monkeypatch):
+    make_user('s@example.com')
+
+    def busy(pwhash, password):
+        raise HasherBusy()
+    monkeypatch.setattr(password_hasher, 'check', busy)
+
+    response = client.post('/login', data={'email': 's@example.com', 'password': PASSWORD})
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
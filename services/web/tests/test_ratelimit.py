@@ -0,0 +1,118 @@
+import pytest
+
+from project import rate_limiter
+from project.ratelimit import RedisLimitBackend, SharedMemoryBackend, parse_limit
+from project.sessionstore import LocalRespServer
+
+from conftest import make_user
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Sets limits by name for one test."""
+    def set_limits(**values):
+        for name, value in values.items():
+            monkeypatch.setitem(rate_limiter.limits, name, parse_limit(value))
+    return set_limits
+
+
+def post_login(client, email, password='wrong', **kwargs):
+    """A failed log in, sent back to the log-in page with a redirect."""
+    return client.post('/login', data={'email': email, 'password': password}, **kwargs)
+
+
+def test_parse_limit():
+    assert parse_limit('5/300') == (5, 300.0)
+    assert parse_limit('3') == (3, 1.0)
+    assert parse_limit('') is None
+    assert parse_limit('0/60') is None
+
+
+def test_email_limit_answers_429_with_retry_after(client, limits):
+    limits(login_email='2/300')
+    make_user('s@example.com')
+
+    assert [post_login(client, 's@example.com').status_code for _ in range(2)] == [302, 302]
+    response = post_login(client, 'S@example.com ')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '150'
+    # the address still has attempts left for other emails
+    assert post_login(client, 'other@example.com').status_code == 302
+
+
+def test_address_limit_does_not_count_against_the_email(client, limits):
+    limits(login_ip='1/60', login_email='1/300')
+    make_user('s@example.com')
+
+    assert post_login(client, 's@example.com').status_code == 302
+    assert post_login(client, 's@example.com').status_code == 429
+    # a different address still gets the email's one attempt
+    response = post_login(client, 'x@example.com', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert response.status_code == 302
+    assert rate_limiter.counts() == {
+        ('login_ip', 'hit'): 2, ('login_ip', 'reject'): 1,
+        ('login_email', 'hit'): 2}
+
+
+def test_forwarded_address_is_read_past_trusted_proxies(app, monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'trusted_proxies', 1)
+    with app.test_request_context(headers={'X-Forwarded-For': '1.2.3.4, 10.0.0.1'}) as context:
+        assert rate_limiter.client_address(context.request) == '10.0.0.1'
+    with app.test_request_context(environ_base={'REMOTE_ADDR': '127.0.0.1'}) as context:
+        assert rate_limiter.client_address(context.request) == '127.0.0.1'
+
+
+def test_shared_memory_token_bucket(tmp_path):
+    backend = SharedMemoryBackend(str(tmp_path / 'buckets'), slots=16)
+
+    assert backend.hit('k', 2, 10, now=0) == (True, 0.0)
+    assert backend.hit('k', 2, 10, now=0) == (True, 0.0)
+    allowed, retry_after = backend.hit('k', 2, 10, now=0)
+    assert not allowed and retry_after == pytest.approx(5)
+    # one token back after 5 seconds, other keys have their own bucket
+    assert backend.hit('k', 2, 10, now=5)[0]
+    assert backend.hit('other', 2, 10, now=5)[0]
+
+    # a second mapping of the file sees the same buckets
+    assert not SharedMemoryBackend(str(tmp_path / 'buckets'), slots=16).hit('k', 2, 10, now=5)[0]
+    backend.clear()
+    assert backend.hit('k', 2, 10, now=5)[0]
+
+
+def test_redis_sliding_window():
+    server = LocalRespServer()
+    try:
+        backend = RedisLimitBackend(server.start())
+        assert backend.hit('k', 2, 10, now=100) == (True, 0.0)
+        assert backend.hit('k', 2, 10, now=100) == (True, 0.0)
+        assert backend.hit('k', 2, 10, now=100) == (False, 10)
+
+        # half of the previous window still counts, one more attempt fits
+        assert backend.hit('k', 2, 10, now=115) == (True, 0.0)
+        allowed, retry_after = backend.hit('k', 2, 10, now=115)
+        assert not allowed and retry_after == pytest.approx(5)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_unreachable_store_lets_logins_through(client, limits, monkeypatch):
+    class Unreachable(object):
+        def hit(self, *args):
+            raise OSError('connection refused')
+
+    limits(login_ip='1/60')
+    monkeypatch.setattr(rate_limiter, 'backend', Unreachable())
+
+    assert [post_login(client, 's@example.com').status_code for _ in range(2)] == [302, 302]
+    assert rate_limiter.counts()[('login_ip', 'error')] == 2
+
+
+def test_metric_lines(limits):
+    limits(login_ip='1/60')
+    rate_limiter.hit('login_ip', '10.0.0.1')
+    rate_limiter.hit('login_ip', '10.0.0.1')
+
+    lines = rate_limiter.metric_lines()
+    assert 'app_rate_limit_total{limit="login_ip",outcome="hit"} 1' in lines
+    assert 'app_rate_limit_total{limit="login_ip",outcome="reject"} 1' in lines
@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+from project import db, revision_store
+from project.documentmanager import create_document, save_document
+from project.models import DocumentRevision
+from project.revisions import DELTA, SNAPSHOT, RevisionNotFound, apply_delta, text_ops
+
+from conftest import login, make_user
+
+
+@pytest.fixture
+def snapshot_every(monkeypatch):
+    monkeypatch.setattr(revision_store, 'snapshot_every', 3)
+
+
+def test_text_ops_rebuild_the_new_text():
+    generator = random.Random(7)
+    old = '\n'.join('line %d' % number for number in range(50))
+    for _ in range(20):
+        lines = old.split('\n')
+        position = generator.randrange(len(lines))
+        lines[position:position + generator.randrange(3)] = ['changed %d' % generator.randrange(1000)]
+        new = '\n'.join(lines)
+        assert apply_delta(old, text_ops(old, new)) == new
+        old = new
+
+
+def test_every_version_is_rebuilt_from_snapshots_and_deltas(snapshot_every):
+    sponsor_id = make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    document = create_document(sponsor_id, editor_id, 'doc', 'version one')
+    bodies = {1: 'version one'}
+    for version in range(2, 9):
+        if version % 2:
+            save_document(document, version - 1, body='whole body %d' % version)
+            bodies[version] = 'whole body %d' % version
+        else:
+            body = bodies[version - 1]
+            save_document(document, version - 1, body_patches=[(len(body), len(body), ' +%d' % version)])
+            bodies[version] = body + ' +%d' % version
+        db.session.commit()
+
+    kinds = dict(db.session.query(DocumentRevision.version, DocumentRevision.kind).
+                 filter(DocumentRevision.document_id == document.id))
+    assert kinds[1] == SNAPSHOT and DELTA in kinds.values()
+    # never more than snapshot_every - 1 deltas in a row
+    assert all(SNAPSHOT in [kinds[v] for v in range(version, version + 3)] for version in range(1, 7))
+
+    revision_store.cache.clear()
+    # newest first, so older versions are rebuilt without any cached version
+    for version in sorted(bodies, reverse=True):
+        assert revision_store.text(document.id, version) == bodies[version]
+    with pytest.raises(RevisionNotFound):
+        revision_store.text(document.id, 9)
+
+
+def test_revision_endpoints(client):
+    sponsor_id = make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    document_id = create_document(sponsor_id, editor_id, 'doc', 'first').id
+    login(client, 's@example.com')
+    client.patch('/api/v1/documents/%d' % document_id,
+                 json={'version': 1, 'body_patches': [{'start': 0, 'end': 5, 'text': 'second'}]})
+
+    listing = client.get('/api/v1/documents/%d/revisions' % document_id).get_json()
+    first = client.get('/api/v1/documents/%d/revisions/1' % document_id)
+
+    assert [row['version'] for row in listing['data']] == [1, 2]
+    assert listing['current_version'] == 2
+    assert first.get_data(as_text=True) == 'first'
+    assert 'immutable' in first.headers['Cache-Control']
+    assert client.get('/api/v1/documents/%d/revisions/3' % document_id).status_code == 404
@@ -0,0 +1,57 @@
+from project import db
+from project.documentmanager import create_document, save_document
+from project.models import Document
+
+from conftest import login, make_user
+
+
+def documents(client):
+    sponsor_id = make_user('s@example.com')
+    other_id = make_user('t@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    in_body = create_document(sponsor_id, editor_id, 'notes', 'the quarterly budget review').id
+    in_name = create_document(sponsor_id, editor_id, 'Budget review', 'numbers').id
+    create_document(sponsor_id, editor_id, 'budget only', 'nothing else')
+    create_document(other_id, editor_id, 'budget review', 'of someone else')
+    login(client, 's@example.com')
+    return in_body, in_name
+
+
+def search(client, terms, **args):
+    args = ''.join('&%s=%s' % item for item in args.items())
+    return client.get('/api/v1/sponsor/documents?q=%s%s' % (terms, args)).get_json()
+
+
+def test_matches_need_every_word_and_names_rank_first(client):
+    in_body, in_name = documents(client)
+
+    body = search(client, 'budget+review')
+
+    assert [row['document_id'] for row in body['data']] == [in_name, in_body]
+    assert body['data'][0]['rank'] > body['data'][1]['rank']
+
+
+def test_results_stay_within_the_callers_documents(client):
+    documents(client)
+    assert search(client, 'someone')['data'] == []
+
+
+def test_saves_reindex_the_fields_they_change(client):
+    in_body, in_name = documents(client)
+    save_document(Document.query.get(in_body), 1, document_name='renamed', body_patches=[(4, 13, 'annual')])
+    db.session.commit()
+
+    assert search(client, 'quarterly')['data'] == []
+    assert [row['document_id'] for row in search(client, 'annual')['data']] == [in_body]
+    assert [row['document_id'] for row in search(client, 'renamed')['data']] == [in_body]
+
+
+def test_result_pages(client):
+    documents(client)
+
+    first = search(client, 'budget', per_page=2)
+    second = search(client, 'budget', per_page=2, page=2)
+
+    assert (first['next_page'], first['prev_page']) == (2, None)
+    assert len(first['data']) == 2 and len(second['data']) == 1
+    assert second['next_page'] is None
@@ -0,0 +1,72 @@
+from project import db, identity_cache, session_store
+from project.identitycache import load_identity_needs
+from project.models import User
+from project.sessionstore import ServerSideSessionInterface, UserSnapshot
+
+from conftest import QueryCounter, login, make_user
+
+
+def test_status_commit_drops_needs_and_snapshot():
+    user_id = make_user('s@example.com')
+    user = User.query.get(user_id)
+    identity_cache.set(user_id, load_identity_needs(user_id))
+    session_store.set_user(UserSnapshot.from_user(user))
+
+    user.user_status = 'rejected'
+    db.session.commit()
+
+    assert identity_cache.get(user_id) is None
+    assert session_store.get_user(user_id) is None
+
+
+def test_rolled_back_change_keeps_both_cached():
+    user_id = make_user('s@example.com')
+    user = User.query.get(user_id)
+    identity_cache.set(user_id, load_identity_needs(user_id))
+    session_store.set_user(UserSnapshot.from_user(user))
+
+    user.user_status = 'rejected'
+    db.session.flush()
+    db.session.rollback()
+    # the next commit has nothing of the rolled back change to invalidate
+    db.session.commit()
+
+    assert identity_cache.get(user_id) is not None
+    assert session_store.get_user(user_id) is not None
+
+
+def test_logged_in_users_skip_the_login_page_without_queries(client):
+    make_user('e@example.com', user_type='editor')
+    login(client, 'e@example.com')
+    client.get('/editor/dashboard')
+
+    with QueryCounter(db.engine) as counter:
+        response = client.get('/login')
+
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/editor/dashboard')
+    assert counter.count == 0
+
+
+def session_cookie(client):
+    return next(cookie.value for cookie in client.cookie_jar if cookie.name == 'session')
+
+
+def test_login_moves_the_session_to_a_new_id(app, client, monkeypatch):
+    monkeypatch.setattr(app, 'session_interface', ServerSideSessionInterface(session_store.backend, 3600))
+    make_user('s@example.com')
+    # an id planted before the login, with data in the store
+    with client.session_transaction() as stored:
+        stored['planted'] = True
+    planted = session_cookie(client)
+
+    login(client, 's@example.com')
+
+    assert session_cookie(client) != planted
+    with client.session_transaction() as stored:
+        assert stored['planted'] is True
+    assert client.get('/sponsor/dashboard').status_code == 200
+    # whoever kept the planted cookie is not logged in
+    attacker = app.test_client()
+    attacker.set_cookie('localhost', 'session', planted)
+    assert attacker.get('/sponsor/dashboard').status_code == 302
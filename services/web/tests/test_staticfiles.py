@@ -0,0 +1,61 @@
+import gzip
+
+import pytest
+from flask import Flask
+
+from project.staticfiles import StaticFiles
+
+BODY = b'0123456789' * 100
+
+
+@pytest.fixture
+def static_client(tmp_path):
+    (tmp_path / 'app.css').write_bytes(BODY)
+    (tmp_path / 'dist').mkdir()
+    (tmp_path / 'dist' / 'main.1a2b3c4d.css').write_bytes(BODY)
+    (tmp_path / 'dist' / 'main.1a2b3c4d.css.gz').write_bytes(gzip.compress(BODY))
+    app = Flask('static_test', static_folder=str(tmp_path), static_url_path='/static')
+    StaticFiles(app)
+    return app.test_client()
+
+
+def test_etag_revalidation_answers_not_modified(static_client):
+    response = static_client.get('/static/app.css')
+    assert response.status_code == 200
+    assert response.get_data() == BODY
+
+    again = static_client.get('/static/app.css', headers={'If-None-Match': response.headers['ETag']})
+    assert again.status_code == 304
+    assert again.get_data() == b''
+
+
+def test_single_ranges_are_partial(static_client):
+    response = static_client.get('/static/app.css', headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 10-19/1000'
+    assert response.get_data() == BODY[10:20]
+
+    assert static_client.get('/static/app.css', headers={'Range': 'bytes=5000-'}).status_code == 416
+
+
+def test_stale_if_range_gets_the_whole_file(static_client):
+    response = static_client.get('/static/app.css', headers={'Range': 'bytes=0-9', 'If-Range': '"outdated"'})
+    assert response.status_code == 200
+    assert response.get_data() == BODY
+
+
+def test_precompressed_variant_and_immutable_caching(static_client):
+    response = static_client.get('/static/dist/main.1a2b3c4d.css', headers={'Accept-Encoding': 'gzip'})
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert gzip.decompress(response.get_data()) == BODY
+
+    plain = static_client.get('/static/dist/main.1a2b3c4d.css')
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.get_data() == BODY
+
+
+def test_missing_files_fall_through_to_flask(static_client):
+    assert static_client.get('/static/missing.css').status_code == 404
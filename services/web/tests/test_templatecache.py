@@ -0,0 +1,41 @@
+from project import db, fragment_cache
+from project.templatecache import Lazy, precompile_templates
+
+from conftest import QueryCounter, add_document, login, make_user
+
+
+def test_lazy_values_are_computed_once_on_first_use():
+    calls = []
+
+    def load(value):
+        calls.append(value)
+        return [value]
+
+    lazy = Lazy(load, 3)
+    assert calls == []
+    assert list(lazy) == [3] and len(lazy) == 1
+    assert calls == [3]
+
+
+def test_cached_list_skips_its_query_until_the_data_changes(client):
+    assert fragment_cache.enabled
+    sponsor_id = make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    add_document(sponsor_id, editor_id, name='first')
+    login(client, 's@example.com')
+
+    assert 'first' in client.get('/sponsor/documents').get_data(as_text=True)
+    with QueryCounter(db.engine) as miss:
+        client.get('/sponsor/documents?per_page=7').get_data()
+    with QueryCounter(db.engine) as hit:
+        body = client.get('/sponsor/documents?per_page=7').get_data(as_text=True)
+    assert 'first' in body
+    assert hit.count < miss.count
+
+    # a new retention bumps the sponsor's version, the fragment is rendered again
+    add_document(sponsor_id, editor_id, name='second')
+    assert 'second' in client.get('/sponsor/documents?per_page=7').get_data(as_text=True)
+
+
+def test_every_template_compiles(app):
+    assert precompile_templates(app) > 10
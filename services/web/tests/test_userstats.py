@@ -0,0 +1,70 @@
+from project import db
+from project.documentmanager import bulk_create_documents
+from project.models import Retention, User, UserStat
+from project.usermanager import set_user_status
+from project.userstats import Stats, rebuild_user_stats, user_stats
+
+from conftest import add_document, login, make_user
+
+
+def all_stats():
+    return dict((row.user_id, (row.documents_owned, row.documents_assigned, row.pending_approvals))
+                for row in UserStat.query)
+
+
+def assert_matches_a_rebuild():
+    kept = all_stats()
+    rebuild_user_stats()
+    assert kept == all_stats()
+
+
+def test_counters_follow_orm_writes():
+    admin_id = make_user('admin@example.com', user_type='admin')
+    sponsor_id = make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    pending_id = make_user('p@example.com', user_status='pending')
+    first = add_document(sponsor_id, editor_id)
+    add_document(sponsor_id, editor_id)
+
+    assert user_stats(sponsor_id) == Stats(2, 0, 0)
+    assert user_stats(editor_id) == Stats(0, 2, 0)
+    assert user_stats(admin_id) == Stats(0, 0, 1)
+
+    # reassigned, deleted, approved
+    other_editor_id = make_user('o@example.com', user_type='editor')
+    Retention.query.filter_by(document_id=first).one().editor_id = other_editor_id
+    db.session.commit()
+    db.session.delete(Retention.query.filter_by(editor_id=editor_id).one())
+    User.query.get(pending_id).user_status = 'approved'
+    db.session.commit()
+
+    assert user_stats(editor_id) == Stats(0, 0, 0)
+    assert user_stats(other_editor_id) == Stats(0, 1, 0)
+    assert user_stats(sponsor_id) == Stats(1, 0, 0)
+    assert user_stats(admin_id) == Stats(0, 0, 0)
+    assert_matches_a_rebuild()
+
+
+def test_counters_follow_bulk_writes():
+    admin_id = make_user('admin@example.com', user_type='admin')
+    sponsor_id = make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    pending_ids = [make_user('p%d@example.com' % number, user_status='pending') for number in range(3)]
+
+    bulk_create_documents(sponsor_id, [{'document_name': 'doc', 'editor_id': editor_id}] * 4, batch_size=3)
+    set_user_status('rejected', user_ids=pending_ids[:2])
+
+    assert user_stats(sponsor_id) == Stats(4, 0, 0)
+    assert user_stats(editor_id) == Stats(0, 4, 0)
+    assert user_stats(admin_id) == Stats(0, 0, 1)
+    assert_matches_a_rebuild()
+
+
+def test_dashboards_read_the_counters(client):
+    sponsor_id = make_user('s@example.com')
+    editor_id = make_user('e@example.com', user_type='editor')
+    for _ in range(3):
+        add_document(sponsor_id, editor_id)
+    login(client, 's@example.com')
+
+    assert 'Documents: 3' in client.get('/sponsor/dashboard').get_data(as_text=True)
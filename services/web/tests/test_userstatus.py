@@ -0,0 +1,73 @@
+from project import db
+from project.models import User
+
+from conftest import QueryCounter, login, make_user
+
+
+def statuses():
+    return dict(db.session.query(User.email, User.user_status))
+
+
+def test_filter_updates_every_matching_user(client):
+    make_user('admin@example.com', user_type='admin')
+    pending_ids = [make_user('e%d@example.com' % number, user_type='editor', user_status='pending')
+                   for number in range(3)]
+    make_user('s@example.com', user_status='pending')
+    login(client, 'admin@example.com')
+
+    response = client.post('/admin/userstatus', json={
+        'user_status': 'approved', 'filter': {'user_type': 'editor', 'user_status': 'pending'}})
+
+    assert response.status_code == 200
+    assert sorted(response.get_json()['user_ids']) == pending_ids
+    db.session.expire_all()
+    assert statuses() == {
+        'admin@example.com': 'approved', 'e0@example.com': 'approved', 'e1@example.com': 'approved',
+        'e2@example.com': 'approved', 's@example.com': 'pending'}
+
+
+def test_status_changes_take_a_fixed_number_of_queries(client):
+    make_user('admin@example.com', user_type='admin')
+    warm_up = make_user('w@example.com', user_status='pending')
+    few = [make_user('a%d@example.com' % number, user_status='pending') for number in range(2)]
+    many = [make_user('b%d@example.com' % number, user_status='pending') for number in range(20)]
+    login(client, 'admin@example.com')
+    # loads and caches the admin's identity, queues the jobs queued once
+    client.post('/admin/userstatus', json={'user_status': 'rejected', 'user_ids': [warm_up]})
+
+    counts = []
+    for user_ids in (few, many):
+        with QueryCounter(db.engine) as counter:
+            response = client.post('/admin/userstatus', json={'user_status': 'rejected', 'user_ids': user_ids})
+        assert response.get_json()['updated'] == len(user_ids)
+        counts.append(counter.count)
+
+    assert counts[0] == counts[1]
+
+
+def test_bad_requests_change_nothing(client):
+    make_user('admin@example.com', user_type='admin')
+    make_user('s@example.com', user_status='pending')
+    login(client, 'admin@example.com')
+
+    assert client.post('/admin/userstatus', json={'user_status': 'gone', 'user_ids': [2]}).status_code == 400
+    assert client.post('/admin/userstatus', json={'user_status': 'approved'}).status_code == 400
+    assert client.post('/admin/userstatus', json={
+        'user_status': 'approved', 'filter': {'email': 's@example.com'}}).status_code == 400
+    # values that would leave no condition, or are no column value at all
+    for value in (None, '', ['sponsor'], {'in': 'sponsor'}, 1):
+        assert client.post('/admin/userstatus', json={
+            'user_status': 'approved', 'filter': {'user_type': value}}).status_code == 400
+    assert client.post('/admin/userstatus', json={'user_status': 'approved', 'filter': {}}).status_code == 400
+    assert statuses()['s@example.com'] == 'pending'
+
+
+def test_only_admins_change_statuses(client):
+    make_user('s@example.com')
+    pending_id = make_user('p@example.com', user_status='pending')
+    login(client, 's@example.com')
+
+    response = client.post('/admin/userstatus', json={'user_status': 'approved', 'user_ids': [pending_id]})
+
+    assert response.status_code == 302
+    assert statuses()['p@example.com'] == 'pending'
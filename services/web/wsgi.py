@@ -0,0 +1,6 @@
+# WSGI entry point for gunicorn, "gunicorn wsgi:app"
+# importing the project package builds nothing, the app is built here once,
+# in the master when gunicorn runs with preload_app
+from project import create_app
+
+app = create_app()